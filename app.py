@@ -1,22 +1,37 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, abort, jsonify
+from flask import Flask, render_template, redirect, url_for, request, flash, abort, jsonify, send_file, has_request_context
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user, UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, or_, case, cast, update, insert, exists, select, event, text, literal_column, literal
+from sqlalchemy.orm import Session, joinedload, selectinload
 # Importaciones añadidas para manejo de errores de DB
 from sqlalchemy.exc import OperationalError, IntegrityError 
+from sqlalchemy import inspect as sa_inspect
 from datetime import datetime, date, timedelta, time
 import os
 import json
-import barcode
-from barcode.writer import ImageWriter
+from codigos_barras import (FORMATOS as FORMATOS_BARCODE, configurar_cache_disco, obtener_barcode,
+                            obtener_barcodes, generar_pdf_etiquetas)
 from io import BytesIO
 from collections import defaultdict
-import base64
 import locale
 import pytz
 import traceback 
+import threading
+import re
+from time import monotonic
 import pandas as pd # Importado para manejo de Excel
+import numpy as np
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
+import click
+import uuid
+import multiprocessing
+import zipfile
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy.dialects import postgresql, sqlite
 
 # =================================================================
 # CONFIGURACIÓN Y BASE DE DATOS
@@ -70,23 +85,95 @@ def obtener_rango_turno_colombia():
 
     return fecha_comercial, inicio_utc, fin_utc
 
+def rango_utc_fecha_comercial(fecha_comercial):
+    """(inicio, fin) en UTC naive de una fecha comercial: de las 6:00 AM de ese día a las 6:00 AM del siguiente."""
+    inicio_local = TIMEZONE_CO.localize(datetime.combine(fecha_comercial, time(6, 0, 0)))
+    inicio_utc = inicio_local.astimezone(pytz.UTC).replace(tzinfo=None)
+    return inicio_utc, inicio_utc + timedelta(days=1)
+
+def fecha_comercial_de(momento_utc):
+    """Fecha comercial (regla de las 6:00 AM) de un datetime UTC naive, como los de Venta.fecha."""
+    if momento_utc.tzinfo is None:
+        momento_utc = pytz.utc.localize(momento_utc)
+    momento_co = momento_utc.astimezone(TIMEZONE_CO)
+    if momento_co.hour < 6:
+        return momento_co.date() - timedelta(days=1)
+    return momento_co.date()
+
 # =================================================================
-# CLASE AUXILIAR PARA MANEJO DE ERRORES DE DB
+# PAGINACIÓN POR CURSOR (KEYSET)
 # =================================================================
-class EmptyPagination: 
-    """Objeto dummy para evitar errores de Jinja2 cuando la paginación falla por DB."""
-    items = []
-    has_prev = False
-    has_next = False
-    prev_num = None
-    next_num = None
-    page = 1
-    pages = 1
-    total = 0
-    
-    # Esta función se añade para satisfacer el llamado `ventas_paginadas.iter_pages()`
-    def iter_pages(self, left_edge=1, right_edge=1, left_current=2, right_current=2):
-        yield 1
+class PaginaKeyset:
+    """
+    Página de resultados obtenida por cursor sobre una columna única (normalmente el ID),
+    en orden descendente. A diferencia de OFFSET, la página 500 cuesta lo mismo que la 1.
+    `despues` y `antes` son los cursores que se pasan en la URL.
+    """
+    def __init__(self, items=None, per_page=50, has_prev=False, has_next=False,
+                 prev_cursor=None, next_cursor=None, total=None, total_aproximado=False):
+        self.items = items or []
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.total = total
+        self.total_aproximado = total_aproximado
+
+
+def contar_aproximado(query, tope=1000):
+    """
+    Total aproximado para mostrar junto a la paginación, sin recorrer toda la tabla:
+    en PostgreSQL sin filtros usa la estimación del planificador (pg_class.reltuples);
+    en otro caso cuenta hasta `tope` + 1 filas. Devuelve (total, es_aproximado).
+    """
+    tabla = query.column_descriptions[0]['entity'].__table__
+    if db.session.get_bind().dialect.name == 'postgresql' and query.whereclause is None:
+        estimado = db.session.execute(
+            text("SELECT reltuples FROM pg_class WHERE relname = :tabla"), {'tabla': tabla.name}
+        ).scalar()
+        if estimado is not None and estimado >= 0:
+            return int(estimado), True
+
+    contados = db.session.query(func.count()).select_from(
+        query.order_by(None).limit(tope + 1).subquery()
+    ).scalar()
+    if contados > tope:
+        return tope, True
+    return contados, False
+
+
+def paginar_keyset(query, columna, per_page, despues=None, antes=None, contar=True):
+    """Aplica paginación keyset descendente sobre `columna` y devuelve una PaginaKeyset."""
+    base = query.order_by(None)
+
+    if antes is not None:
+        # Hacia atrás: los `per_page` valores inmediatamente mayores, devueltos en orden descendente
+        filas = base.filter(columna > antes).order_by(columna.asc()).limit(per_page + 1).all()
+        has_prev = len(filas) > per_page
+        items = list(reversed(filas[:per_page]))
+        has_next = True
+    else:
+        consulta = base.order_by(columna.desc())
+        if despues is not None:
+            consulta = consulta.filter(columna < despues)
+        filas = consulta.limit(per_page + 1).all()
+        has_next = len(filas) > per_page
+        items = filas[:per_page]
+        has_prev = despues is not None
+
+    clave = columna.key
+    pagina = PaginaKeyset(
+        items=items,
+        per_page=per_page,
+        has_prev=has_prev and bool(items),
+        has_next=has_next and bool(items),
+        prev_cursor=getattr(items[0], clave) if items else None,
+        next_cursor=getattr(items[-1], clave) if items else None
+    )
+    if contar:
+        pagina.total, pagina.total_aproximado = contar_aproximado(query)
+    return pagina
 
 # =================================================================
 # FILTROS Y CONTEXTO
@@ -171,24 +258,57 @@ class Producto(db.Model):
     valor_venta = db.Column(db.Float)
     valor_interno = db.Column(db.Float)
     stock_minimo = db.Column(db.Integer, default=5)
+    # Versión del catálogo en la que cambió por última vez (sincronización por deltas)
+    version = db.Column(db.BigInteger, nullable=False, default=0, index=True)
+    # Los productos que salen de la lista de precios se desactivan (no se borran: tienen ventas)
+    activo = db.Column(db.Boolean, nullable=False, default=True)
 
 
-class Venta(db.Model):
+class ProductoBaja(db.Model):
+    """Registro de productos eliminados, para que los terminales los quiten de su copia local."""
     id = db.Column(db.Integer, primary_key=True)
+    producto_id = db.Column(db.Integer, nullable=False)
+    version = db.Column(db.BigInteger, nullable=False, index=True)
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ContadorVersion(db.Model):
+    """
+    Contadores monotónicos: 'catalogo' versiona los cambios de Producto y 'epoca_catalogo'
+    cambia cuando el catálogo se reemplaza entero (los IDs pueden reutilizarse).
+    """
+    nombre = db.Column(db.String(50), primary_key=True)
+    valor = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class Venta(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    fecha = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Fecha comercial (regla de las 6:00 AM), asignada al insertar; los turnos filtran por igualdad
+    fecha_comercial = db.Column(db.Date, index=True)
     total = db.Column(db.Float)
-    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
-    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'))
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), index=True)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), index=True)
     tipo_pago = db.Column(db.String(50))
     detalle_pago = db.Column(db.Text)
     
     vendedor = db.relationship('Usuario', backref='ventas_realizadas', lazy=True)
+    pagos = db.relationship('VentaPago', backref='venta', lazy=True, cascade='all, delete-orphan')
+
+
+class VentaPago(db.Model):
+    """Un renglón por método de pago de la venta (reemplaza el desglose del JSON detalle_pago)."""
+    id = db.Column(db.Integer, primary_key=True)
+    venta_id = db.Column(db.Integer, db.ForeignKey('venta.id'), nullable=False, index=True)
+    metodo = db.Column(db.String(50), nullable=False, index=True)
+    monto = db.Column(db.Float, nullable=False, default=0)
+    referencia = db.Column(db.String(100))
 
 
 class VentaDetalle(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    venta_id = db.Column(db.Integer, db.ForeignKey('venta.id'))
-    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'))
+    venta_id = db.Column(db.Integer, db.ForeignKey('venta.id'), index=True)
+    producto_id = db.Column(db.Integer, db.ForeignKey('producto.id'), index=True)
     cantidad = db.Column(db.Integer)
     precio_unitario = db.Column(db.Float)
     subtotal = db.Column(db.Float)
@@ -198,7 +318,7 @@ class VentaDetalle(db.Model):
 
 class CierreCaja(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    fecha_cierre = db.Column(db.Date)
+    fecha_cierre = db.Column(db.Date, index=True)
     hora_ejecucion = db.Column(db.DateTime, default=datetime.utcnow, name='hora_cierre') 
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'))
     total_venta = db.Column(db.Float)
@@ -207,6 +327,1386 @@ class CierreCaja(db.Model):
     detalles_json = db.Column(db.Text)
 
     usuario = db.relationship('Usuario', backref='cierres_caja', lazy=True) 
+    metodos = db.relationship('CierreCajaMetodo', backref='cierre', lazy=True, cascade='all, delete-orphan')
+    vendedores = db.relationship('CierreCajaVendedor', backref='cierre', lazy=True, cascade='all, delete-orphan',
+                                 order_by='CierreCajaVendedor.total.desc()')
+
+    @property
+    def montos_por_metodo(self):
+        return {m.metodo: m.monto for m in self.metodos}
+
+
+class CierreCajaMetodo(db.Model):
+    """Total por método de pago de un cierre (versión consultable de detalles_json['metodos'])."""
+    cierre_id = db.Column(db.Integer, db.ForeignKey('cierre_caja.id'), primary_key=True)
+    metodo = db.Column(db.String(50), primary_key=True)
+    monto = db.Column(db.Float, nullable=False, default=0)
+
+
+class CierreCajaVendedor(db.Model):
+    """Total, efectivo y número de ventas de cada vendedor en un cierre (detalles_json['vendedores'])."""
+    cierre_id = db.Column(db.Integer, db.ForeignKey('cierre_caja.id'), primary_key=True)
+    vendedor = db.Column(db.String(100), primary_key=True)
+    total = db.Column(db.Float, nullable=False, default=0)
+    efectivo = db.Column(db.Float, nullable=False, default=0)
+    ventas = db.Column(db.Integer)
+
+
+class ResumenVentas(db.Model):
+    """
+    Acumulado de ventas por fecha comercial, vendedor y método de pago.
+    Las filas con metodo = RESUMEN_TOTAL guardan la suma de Venta.total y el número de ventas;
+    el resto guarda la suma de VentaPago.monto de ese método.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    fecha_comercial = db.Column(db.Date, nullable=False)
+    usuario_id = db.Column(db.Integer, nullable=False, default=0) # 0 = venta sin vendedor
+    metodo = db.Column(db.String(50), nullable=False)
+    monto = db.Column(db.Float, nullable=False, default=0)
+    num_ventas = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('fecha_comercial', 'usuario_id', 'metodo', name='uq_resumen_ventas_clave'),
+    )
+
+
+class MovimientoInventario(db.Model):
+    """Kardex: cada cambio de stock queda como una fila (solo se inserta, nunca se modifica)."""
+    id = db.Column(db.Integer, primary_key=True)
+    # Sin clave foránea: el historial se conserva aunque el producto se elimine
+    producto_id = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    motivo = db.Column(db.String(30), nullable=False)
+    referencia = db.Column(db.String(100))
+    usuario_id = db.Column(db.Integer)
+    fecha = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index('ix_movimiento_inventario_producto_fecha', 'producto_id', 'fecha'),
+    )
+
+
+class SaldoInventario(db.Model):
+    """Foto del stock de cada producto al cierre de una fecha comercial."""
+    fecha_comercial = db.Column(db.Date, primary_key=True)
+    producto_id = db.Column(db.Integer, primary_key=True)
+    cantidad = db.Column(db.Integer, nullable=False)
+
+
+class RecepcionInventario(db.Model):
+    """Lote de mercancía recibida con el escáner y registrado en un solo envío."""
+    id = db.Column(db.Integer, primary_key=True)
+    # Identificador generado por el navegador: un reintento del mismo envío no suma dos veces
+    id_envio = db.Column(db.String(36), unique=True, nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    fecha = db.Column(db.DateTime, default=datetime.utcnow)
+    lineas = db.Column(db.Integer, nullable=False, default=0)
+    unidades = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ConteoInventario(db.Model):
+    """Sesión de conteo físico: lo contado se acumula aparte y se concilia con el stock al aplicar."""
+    id = db.Column(db.Integer, primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='abierto')  # abierto | aplicado | cancelado
+    # Completo: lo que no se contó se toma como 0. Parcial: solo se ajustan los productos contados.
+    completo = db.Column(db.Boolean, nullable=False, default=False)
+    nota = db.Column(db.String(200))
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    cerrado = db.Column(db.DateTime)
+    productos_ajustados = db.Column(db.Integer, nullable=False, default=0)
+    unidades_ajustadas = db.Column(db.Integer, nullable=False, default=0)
+
+    usuario = db.relationship('Usuario')
+
+
+class ConteoInventarioLinea(db.Model):
+    """Cantidad contada de un producto en una sesión (una fila por producto)."""
+    conteo_id = db.Column(db.Integer, db.ForeignKey('conteo_inventario.id'), primary_key=True)
+    # Sin clave foránea a producto, igual que el kardex: eliminar un producto no choca con un conteo
+    producto_id = db.Column(db.Integer, primary_key=True)
+    cantidad = db.Column(db.Integer, nullable=False, default=0)
+
+
+class ConteoInventarioEnvio(db.Model):
+    """Lotes de lecturas ya recibidos: un reintento del mismo lote no cuenta dos veces."""
+    conteo_id = db.Column(db.Integer, db.ForeignKey('conteo_inventario.id'), primary_key=True)
+    id_envio = db.Column(db.String(36), primary_key=True)
+
+
+class TrabajoImportacion(db.Model):
+    """Importación de Excel ejecutada en segundo plano; la pantalla consulta su avance."""
+    id = db.Column(db.String(32), primary_key=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=False)
+    modo = db.Column(db.String(20), nullable=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, procesando, completado, error
+    filas_totales = db.Column(db.Integer)  # estimado según las dimensiones de la hoja
+    filas_procesadas = db.Column(db.Integer, nullable=False, default=0)
+    filas_rechazadas = db.Column(db.Integer, nullable=False, default=0)
+    nuevos = db.Column(db.Integer, nullable=False, default=0)
+    modificados = db.Column(db.Integer, nullable=False, default=0)
+    sin_cambios = db.Column(db.Integer, nullable=False, default=0)
+    desactivados = db.Column(db.Integer, nullable=False, default=0)
+    rechazos = db.Column(db.String(32))  # identificador del reporte de filas rechazadas
+    # Rango de versiones del catálogo que escribió (para imprimir etiquetas de lo importado)
+    version_inicial = db.Column(db.BigInteger)
+    version_final = db.Column(db.BigInteger)
+    mensaje = db.Column(db.Text)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    inicio = db.Column(db.DateTime)
+    fin = db.Column(db.DateTime)
+    actualizado = db.Column(db.DateTime)  # último avance registrado; sin avance reciente se da por interrumpido
+
+# =================================================================
+# PAGOS DE VENTA (TABLA VentaPago)
+# =================================================================
+METODOS_PAGO = ['Efectivo', 'Nequi', 'Transferencia', 'Daviplata', 'Tarjeta/Bold']
+
+
+def _referencias_desde_codigo(ref_codigo):
+    """Convierte 'Nequi:ABC | Daviplata:XYZ' en {'Nequi': 'ABC', 'Daviplata': 'XYZ'}."""
+    referencias = {}
+    for parte in (ref_codigo or '').split('|'):
+        metodo, sep, codigo = parte.partition(':')
+        if sep and metodo.strip() in METODOS_PAGO:
+            referencias[metodo.strip()] = codigo.strip()
+    return referencias
+
+
+def _filas_pago(venta_id, detalle_pago_dict, referencias=None):
+    """Filas de VentaPago (como dicts) para los métodos con monto positivo."""
+    ref_general = str(detalle_pago_dict.get('Ref_Codigo') or '').strip()
+    por_metodo = _referencias_desde_codigo(ref_general)
+    por_metodo.update(referencias or {})
+
+    filas = []
+    for metodo in METODOS_PAGO:
+        try:
+            monto = float(detalle_pago_dict.get(metodo) or 0)
+        except (TypeError, ValueError):
+            continue
+        if monto <= 0:
+            continue
+        referencia = '' if metodo == 'Efectivo' else (por_metodo.get(metodo) or ref_general)
+        filas.append({
+            'venta_id': venta_id,
+            'metodo': metodo,
+            'monto': monto,
+            'referencia': referencia[:100] or None
+        })
+    return filas
+
+
+def registrar_pagos_venta(venta, detalle_pago_dict, referencias=None, reemplazar=True):
+    """
+    Escribe los pagos de la venta (debe tener ID) a partir del diccionario de pagos.
+    Con reemplazar=True se borran antes los pagos que ya tuviera (edición).
+    """
+    if reemplazar:
+        VentaPago.query.filter_by(venta_id=venta.id).delete(synchronize_session='fetch')
+    filas = _filas_pago(venta.id, detalle_pago_dict, referencias)
+    if filas:
+        db.session.execute(insert(VentaPago), filas)
+    return filas
+
+
+def totales_por_metodo(fecha_comercial):
+    """Suma de cada método de pago para las ventas de la fecha comercial, en un solo GROUP BY."""
+    filas = db.session.query(
+        VentaPago.metodo,
+        func.sum(VentaPago.monto)
+    ).join(Venta, Venta.id == VentaPago.venta_id).filter(
+        Venta.fecha_comercial == fecha_comercial
+    ).group_by(VentaPago.metodo).all()
+
+    totales = {metodo: float(total or 0) for metodo, total in filas}
+    orden = {metodo: i for i, metodo in enumerate(METODOS_PAGO)}
+    return dict(sorted(totales.items(), key=lambda kv: orden.get(kv[0], len(orden))))
+
+
+def totales_por_vendedor(fecha_comercial):
+    """
+    Total vendido, efectivo y número de ventas por vendedor en la fecha comercial, en una consulta:
+    el efectivo de cada venta se suma aparte (subconsulta) para no duplicar Venta.total al unir pagos.
+    """
+    efectivo = db.session.query(
+        VentaPago.venta_id, func.sum(VentaPago.monto).label('monto')
+    ).join(Venta, Venta.id == VentaPago.venta_id).filter(
+        Venta.fecha_comercial == fecha_comercial, VentaPago.metodo == 'Efectivo'
+    ).group_by(VentaPago.venta_id).subquery()
+
+    vendedor = func.coalesce(Usuario.username, 'N/A')
+    filas = db.session.query(
+        vendedor,
+        func.coalesce(func.sum(Venta.total), 0),
+        func.coalesce(func.sum(efectivo.c.monto), 0),
+        func.count(Venta.id)
+    ).select_from(Venta).outerjoin(Usuario, Usuario.id == Venta.usuario_id).outerjoin(
+        efectivo, efectivo.c.venta_id == Venta.id
+    ).filter(Venta.fecha_comercial == fecha_comercial).group_by(vendedor).order_by(vendedor).all()
+
+    return {
+        nombre: {'total': float(total), 'efectivo': float(en_efectivo), 'ventas': int(cantidad)}
+        for nombre, total, en_efectivo, cantidad in filas
+    }
+
+
+def backfill_venta_pagos(lote=1000):
+    """
+    Migra el JSON histórico de Venta.detalle_pago a la tabla VentaPago.
+    Es idempotente: solo procesa ventas que aún no tienen filas de pago.
+    """
+    sin_pagos = ~exists().where(VentaPago.venta_id == Venta.id)
+    ultimo_id = 0
+    migradas = 0
+    while True:
+        ventas = db.session.query(Venta.id, Venta.detalle_pago).filter(
+            Venta.id > ultimo_id,
+            Venta.detalle_pago.isnot(None),
+            sin_pagos
+        ).order_by(Venta.id).limit(lote).all()
+        if not ventas:
+            break
+
+        filas = []
+        for venta_id, detalle_pago in ventas:
+            try:
+                filas.extend(_filas_pago(venta_id, json.loads(detalle_pago)))
+            except (ValueError, TypeError, AttributeError):
+                continue
+        if filas:
+            db.session.execute(insert(VentaPago), filas)
+        db.session.commit()
+
+        ultimo_id = ventas[-1][0]
+        migradas += len(filas)
+    return migradas
+
+# =================================================================
+# FECHA COMERCIAL DE LA VENTA (COLUMNA MATERIALIZADA)
+# =================================================================
+@event.listens_for(Venta, 'before_insert')
+@event.listens_for(Venta, 'before_update')
+def _asignar_fecha_comercial(mapper, connection, venta):
+    if venta.fecha is None:
+        venta.fecha = datetime.utcnow()
+    venta.fecha_comercial = fecha_comercial_de(venta.fecha)
+
+
+def backfill_fecha_comercial_ventas(lote=5000):
+    """Asigna fecha_comercial a las ventas anteriores a la columna, por lotes de `lote` (idempotente)."""
+    total = 0
+    while True:
+        filas = db.session.query(Venta.id, Venta.fecha).filter(
+            Venta.fecha_comercial.is_(None), Venta.fecha.isnot(None)
+        ).order_by(Venta.id).limit(lote).all()
+        if not filas:
+            return total
+        db.session.execute(update(Venta), [
+            {'id': venta_id, 'fecha_comercial': fecha_comercial_de(fecha)} for venta_id, fecha in filas
+        ])
+        db.session.commit()
+        total += len(filas)
+
+# =================================================================
+# CIERRES DE CAJA (DETALLE CONSULTABLE)
+# =================================================================
+POR_PAGINA_CIERRES = 30
+
+
+def guardar_detalle_cierre(cierre_id, metodos, vendedores):
+    """
+    Reescribe las filas de CierreCajaMetodo y CierreCajaVendedor del cierre a partir del snapshot:
+    `metodos` es {metodo: monto} y `vendedores` es {vendedor: {'total', 'efectivo', 'ventas'}}.
+    """
+    db.session.query(CierreCajaMetodo).filter(CierreCajaMetodo.cierre_id == cierre_id).delete()
+    db.session.query(CierreCajaVendedor).filter(CierreCajaVendedor.cierre_id == cierre_id).delete()
+
+    filas_metodos = [
+        {'cierre_id': cierre_id, 'metodo': metodo, 'monto': float(monto or 0)}
+        for metodo, monto in metodos.items()
+    ]
+    filas_vendedores = [
+        {
+            'cierre_id': cierre_id,
+            'vendedor': str(vendedor)[:100],
+            'total': float(datos.get('total') or 0),
+            'efectivo': float(datos.get('efectivo') or 0),
+            'ventas': datos.get('ventas')
+        }
+        for vendedor, datos in vendedores.items()
+    ]
+    if filas_metodos:
+        db.session.execute(insert(CierreCajaMetodo), filas_metodos)
+    if filas_vendedores:
+        db.session.execute(insert(CierreCajaVendedor), filas_vendedores)
+
+
+def backfill_detalle_cierres():
+    """Pasa a las tablas de detalle el JSON de los cierres anteriores a ellas (idempotente)."""
+    sin_detalle = and_(
+        ~exists().where(CierreCajaMetodo.cierre_id == CierreCaja.id),
+        ~exists().where(CierreCajaVendedor.cierre_id == CierreCaja.id)
+    )
+    cierres = db.session.query(CierreCaja.id, CierreCaja.detalles_json).filter(
+        CierreCaja.detalles_json.isnot(None), sin_detalle
+    ).all()
+
+    migrados = 0
+    for cierre_id, detalles_json in cierres:
+        try:
+            snapshot = json.loads(detalles_json)
+            guardar_detalle_cierre(cierre_id, snapshot.get('metodos') or {}, snapshot.get('vendedores') or {})
+        except (ValueError, TypeError, AttributeError):
+            continue
+        migrados += 1
+    db.session.commit()
+    return migrados
+
+
+def filtro_rango_cierres(desde=None, hasta=None):
+    """Condiciones sobre CierreCaja.fecha_cierre para el rango (cualquiera de los extremos puede faltar)."""
+    condiciones = []
+    if desde:
+        condiciones.append(CierreCaja.fecha_cierre >= desde)
+    if hasta:
+        condiciones.append(CierreCaja.fecha_cierre <= hasta)
+    return condiciones
+
+
+def resumen_cierres(desde=None, hasta=None):
+    """Totales de los cierres del rango, por método y por vendedor, agregados en SQL."""
+    rango = filtro_rango_cierres(desde, hasta)
+
+    num_cierres, total_venta, total_efectivo, total_electronico = db.session.query(
+        func.count(CierreCaja.id),
+        func.coalesce(func.sum(CierreCaja.total_venta), 0),
+        func.coalesce(func.sum(CierreCaja.total_efectivo), 0),
+        func.coalesce(func.sum(CierreCaja.total_electronico), 0)
+    ).filter(*rango).one()
+
+    filas_metodos = db.session.query(
+        CierreCajaMetodo.metodo, func.sum(CierreCajaMetodo.monto)
+    ).join(CierreCaja, CierreCaja.id == CierreCajaMetodo.cierre_id).filter(*rango).group_by(
+        CierreCajaMetodo.metodo
+    ).all()
+    orden = {metodo: i for i, metodo in enumerate(METODOS_PAGO)}
+    metodos = sorted(
+        ((metodo, float(monto or 0)) for metodo, monto in filas_metodos),
+        key=lambda kv: orden.get(kv[0], len(orden))
+    )
+
+    total_vendedor = func.sum(CierreCajaVendedor.total)
+    vendedores = db.session.query(
+        CierreCajaVendedor.vendedor,
+        total_vendedor,
+        func.sum(CierreCajaVendedor.efectivo),
+        func.sum(CierreCajaVendedor.ventas)
+    ).join(CierreCaja, CierreCaja.id == CierreCajaVendedor.cierre_id).filter(*rango).group_by(
+        CierreCajaVendedor.vendedor
+    ).order_by(total_vendedor.desc()).all()
+
+    return {
+        'cierres': int(num_cierres),
+        'total_venta': float(total_venta),
+        'total_efectivo': float(total_efectivo),
+        'total_electronico': float(total_electronico),
+        'metodos': metodos,
+        'vendedores': [
+            {'vendedor': nombre, 'total': float(total or 0), 'efectivo': float(efectivo or 0),
+             'ventas': int(ventas) if ventas is not None else None}
+            for nombre, total, efectivo, ventas in vendedores
+        ]
+    }
+
+# =================================================================
+# RESUMEN DE VENTAS (ACUMULADO INCREMENTAL)
+# =================================================================
+RESUMEN_TOTAL = 'Total'
+
+
+def aportes_resumen(venta, pagos=None):
+    """
+    Aporte de una venta al resumen: {(fecha_comercial, usuario_id, metodo): (monto, num_ventas)}.
+    `pagos` son dicts con 'metodo' y 'monto'; si no se pasan se leen de VentaPago.
+    """
+    if pagos is None:
+        pagos = [
+            {'metodo': metodo, 'monto': monto}
+            for metodo, monto in db.session.query(VentaPago.metodo, VentaPago.monto).filter(VentaPago.venta_id == venta.id)
+        ]
+
+    fecha = venta.fecha_comercial or fecha_comercial_de(venta.fecha)
+    usuario_id = venta.usuario_id or 0
+    aportes = {(fecha, usuario_id, RESUMEN_TOTAL): (venta.total or 0.0, 1)}
+    for pago in pagos:
+        clave = (fecha, usuario_id, pago['metodo'])
+        monto_previo, _ = aportes.get(clave, (0.0, 0))
+        aportes[clave] = (monto_previo + (pago['monto'] or 0.0), 0)
+    return aportes
+
+
+def aportes_resumen_ventas(venta_ids):
+    """Aporte conjunto de varias ventas (mismo formato que aportes_resumen) con dos GROUP BY."""
+    usuario = func.coalesce(Venta.usuario_id, 0)
+    aportes = {}
+    totales = db.session.query(
+        Venta.fecha_comercial, usuario, func.sum(Venta.total), func.count(Venta.id)
+    ).filter(Venta.id.in_(venta_ids)).group_by(Venta.fecha_comercial, usuario)
+    for fecha, usuario_id, monto, num_ventas in totales:
+        aportes[(fecha, usuario_id, RESUMEN_TOTAL)] = (float(monto or 0), int(num_ventas))
+
+    pagos = db.session.query(
+        Venta.fecha_comercial, usuario, VentaPago.metodo, func.sum(VentaPago.monto)
+    ).join(Venta, Venta.id == VentaPago.venta_id).filter(Venta.id.in_(venta_ids)).group_by(
+        Venta.fecha_comercial, usuario, VentaPago.metodo
+    )
+    for fecha, usuario_id, metodo, monto in pagos:
+        aportes[(fecha, usuario_id, metodo)] = (float(monto or 0), 0)
+    return aportes
+
+
+def acumular_resumen(aportes, signo=1):
+    """
+    Suma (signo=1) o resta (signo=-1) los aportes en ResumenVentas dentro de la transacción
+    en curso, con un único upsert atómico (INSERT ... ON CONFLICT DO UPDATE).
+    """
+    filas = [
+        {
+            'fecha_comercial': fecha,
+            'usuario_id': usuario_id,
+            'metodo': metodo,
+            'monto': signo * monto,
+            'num_ventas': signo * num_ventas
+        }
+        for (fecha, usuario_id, metodo), (monto, num_ventas) in aportes.items()
+    ]
+    if not filas:
+        return
+
+    dialecto = db.session.get_bind().dialect.name
+    if dialecto in ('postgresql', 'sqlite'):
+        upsert = postgresql.insert if dialecto == 'postgresql' else sqlite.insert
+        stmt = upsert(ResumenVentas).values(filas)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['fecha_comercial', 'usuario_id', 'metodo'],
+            set_={
+                'monto': ResumenVentas.monto + stmt.excluded.monto,
+                'num_ventas': ResumenVentas.num_ventas + stmt.excluded.num_ventas
+            }
+        )
+        db.session.execute(stmt)
+    else:
+        # Otros motores: actualización fila a fila
+        for fila in filas:
+            actualizado = db.session.execute(
+                update(ResumenVentas).where(
+                    ResumenVentas.fecha_comercial == fila['fecha_comercial'],
+                    ResumenVentas.usuario_id == fila['usuario_id'],
+                    ResumenVentas.metodo == fila['metodo']
+                ).values(
+                    monto=ResumenVentas.monto + fila['monto'],
+                    num_ventas=ResumenVentas.num_ventas + fila['num_ventas']
+                )
+            )
+            if actualizado.rowcount == 0:
+                db.session.execute(insert(ResumenVentas), [fila])
+
+    if signo < 0:
+        # Las claves que quedaron en cero se eliminan para que el resumen coincida con una reconstrucción
+        fechas = {fila['fecha_comercial'] for fila in filas}
+        db.session.query(ResumenVentas).filter(
+            ResumenVentas.fecha_comercial.in_(fechas),
+            ResumenVentas.num_ventas == 0,
+            func.abs(ResumenVentas.monto) < 0.005
+        ).delete(synchronize_session=False)
+
+
+def reconstruir_resumen_ventas(lote=2000):
+    """Regenera ResumenVentas completo a partir del historial de Venta y VentaPago."""
+    acumulado = defaultdict(lambda: [0.0, 0])
+
+    ventas = db.session.query(Venta.fecha_comercial, Venta.usuario_id, Venta.total).execution_options(yield_per=lote)
+    for fecha, usuario_id, total in ventas:
+        if fecha is None:
+            continue
+        fila = acumulado[(fecha, usuario_id or 0, RESUMEN_TOTAL)]
+        fila[0] += total or 0.0
+        fila[1] += 1
+
+    pagos = db.session.query(
+        Venta.fecha_comercial, Venta.usuario_id, VentaPago.metodo, VentaPago.monto
+    ).join(VentaPago, VentaPago.venta_id == Venta.id).execution_options(yield_per=lote)
+    for fecha, usuario_id, metodo, monto in pagos:
+        if fecha is None:
+            continue
+        acumulado[(fecha, usuario_id or 0, metodo)][0] += monto or 0.0
+
+    db.session.query(ResumenVentas).delete()
+    filas = [
+        {'fecha_comercial': f, 'usuario_id': u, 'metodo': m, 'monto': monto, 'num_ventas': n}
+        for (f, u, m), (monto, n) in acumulado.items()
+    ]
+    if filas:
+        db.session.execute(insert(ResumenVentas), filas)
+    db.session.commit()
+    return len(filas)
+
+
+def total_vendido_resumen(desde, hasta):
+    """Suma de Venta.total entre dos fechas comerciales (inclusive), leída del resumen."""
+    total = db.session.query(func.sum(ResumenVentas.monto)).filter(
+        ResumenVentas.metodo == RESUMEN_TOTAL,
+        ResumenVentas.fecha_comercial >= desde,
+        ResumenVentas.fecha_comercial <= hasta
+    ).scalar()
+    return float(total or 0)
+
+
+@app.cli.command('reconstruir-resumen')
+def reconstruir_resumen_command():
+    """Regenera la tabla de resumen de ventas desde el historial."""
+    filas = reconstruir_resumen_ventas()
+    click.echo(f"✅ Resumen de ventas reconstruido: {filas} filas.")
+
+# =================================================================
+# SERIES DE TIEMPO DE VENTAS (GRÁFICOS DE REPORTES)
+# =================================================================
+GRANULARIDADES_SERIE = ('dia', 'semana', 'mes', 'hora')
+DESGLOSES_SERIE = ('metodo', 'vendedor')
+MAX_DIAS_SERIE = 1100  # ~3 años a nivel diario
+NOMBRES_MES = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
+
+
+def inicio_periodo(fecha, granularidad):
+    """Primer día del periodo (semana desde el lunes, o mes) que contiene a `fecha`."""
+    if granularidad == 'semana':
+        return fecha - timedelta(days=fecha.weekday())
+    if granularidad == 'mes':
+        return fecha.replace(day=1)
+    return fecha
+
+
+def siguiente_periodo(fecha, granularidad):
+    if granularidad == 'semana':
+        return fecha + timedelta(days=7)
+    if granularidad == 'mes':
+        return (fecha.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return fecha + timedelta(days=1)
+
+
+def restar_meses(fecha, meses):
+    """Primer día del mes que está `meses` antes del de `fecha`."""
+    indice = fecha.year * 12 + fecha.month - 1 - meses
+    return date(indice // 12, indice % 12 + 1, 1)
+
+
+def _expresion_periodo(columna, granularidad):
+    """Expresión SQL que lleva una fecha comercial al inicio de su día, semana (lunes) o mes."""
+    if granularidad == 'dia':
+        return columna
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # Literales en el SQL (no parámetros): la expresión del SELECT y la del GROUP BY deben ser idénticas
+        unidad = literal_column("'week'" if granularidad == 'semana' else "'month'")
+        return cast(func.date_trunc(unidad, columna), db.Date)
+    # SQLite: 'weekday 0' avanza al domingo; seis días antes está el lunes de esa semana
+    if granularidad == 'semana':
+        return func.date(columna, literal_column("'weekday 0'"), literal_column("'-6 days'"))
+    return func.date(columna, literal_column("'start of month'"))
+
+
+def _hora_colombia(columna):
+    """Hora local de Colombia (0-23) de un datetime UTC naive, calculada en SQL."""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        zona = literal_column(f"'{TIMEZONE_CO.zone}'")
+        return cast(func.extract('hour', func.timezone(zona, func.timezone(literal_column("'UTC'"), columna))), db.Integer)
+    # SQLite no maneja zonas horarias; Colombia no tiene horario de verano, así que el desfase es fijo
+    desfase = int(obtener_hora_colombia().utcoffset().total_seconds() // 3600)
+    return cast(func.strftime(literal_column("'%H'"), columna, literal_column(f"'{desfase} hours'")), db.Integer)
+
+
+def _como_fecha(valor):
+    """Normaliza lo que devuelve el motor (date, datetime o texto ISO en SQLite) a date."""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, str):
+        return date.fromisoformat(valor[:10])
+    return valor
+
+
+def _etiqueta_periodo(fecha, granularidad):
+    if granularidad == 'mes':
+        return f'{NOMBRES_MES[fecha.month - 1]} {fecha.year}'
+    if granularidad == 'semana':
+        return f'Sem {fecha.strftime("%d/%m")}'
+    return fecha.strftime('%d/%m')
+
+
+def serie_ventas(desde, hasta, granularidad='dia', desglose=None):
+    """
+    Ventas entre dos fechas comerciales (inclusive) agrupadas por día, semana o mes en una
+    consulta sobre ResumenVentas. Devuelve un dict listo para Chart.js con una serie 'Ventas'
+    y, si se pide `desglose`, una serie por método de pago o por vendedor.
+    """
+    if granularidad == 'hora':
+        return serie_ventas_por_hora(desde, hasta)
+
+    periodos = []
+    periodo_actual = inicio_periodo(desde, granularidad)
+    while periodo_actual <= hasta:
+        periodos.append(periodo_actual)
+        periodo_actual = siguiente_periodo(periodo_actual, granularidad)
+    posicion = {p: i for i, p in enumerate(periodos)}
+
+    periodo = _expresion_periodo(ResumenVentas.fecha_comercial, granularidad).label('periodo')
+    en_rango = [ResumenVentas.fecha_comercial >= desde, ResumenVentas.fecha_comercial <= hasta]
+
+    ventas, num_ventas = [0.0] * len(periodos), [0] * len(periodos)
+    for valor, monto, cantidad in db.session.query(
+        periodo, func.sum(ResumenVentas.monto), func.sum(ResumenVentas.num_ventas)
+    ).filter(*en_rango, ResumenVentas.metodo == RESUMEN_TOTAL).group_by(periodo):
+        i = posicion[_como_fecha(valor)]
+        ventas[i], num_ventas[i] = float(monto or 0), int(cantidad or 0)
+    series = [{'nombre': 'Ventas', 'data': ventas}]
+
+    if desglose:
+        if desglose == 'metodo':
+            consulta = db.session.query(periodo, ResumenVentas.metodo, func.sum(ResumenVentas.monto)).filter(
+                *en_rango, ResumenVentas.metodo != RESUMEN_TOTAL
+            ).group_by(periodo, ResumenVentas.metodo)
+        else:
+            nombre = func.coalesce(Usuario.username, 'Sin vendedor')
+            consulta = db.session.query(periodo, nombre, func.sum(ResumenVentas.monto)).outerjoin(
+                Usuario, Usuario.id == ResumenVentas.usuario_id
+            ).filter(*en_rango, ResumenVentas.metodo == RESUMEN_TOTAL).group_by(periodo, nombre)
+
+        por_nombre = defaultdict(lambda: [0.0] * len(periodos))
+        for valor, clave, monto in consulta:
+            por_nombre[clave][posicion[_como_fecha(valor)]] += float(monto or 0)
+        orden = {m: i for i, m in enumerate(METODOS_PAGO)} if desglose == 'metodo' else {}
+        for clave in sorted(por_nombre, key=lambda c: (orden.get(c, len(orden)), -sum(por_nombre[c]))):
+            series.append({'nombre': clave, 'data': por_nombre[clave]})
+
+    return {
+        'granularidad': granularidad,
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'labels': [_etiqueta_periodo(p, granularidad) for p in periodos],
+        'periodos': [p.isoformat() for p in periodos],
+        'series': series,
+        'num_ventas': num_ventas,
+        'total': sum(ventas),
+    }
+
+
+def serie_ventas_por_hora(desde, hasta):
+    """Ventas del rango agrupadas por hora local, en el orden de la jornada (6:00 AM a 5:00 AM)."""
+    hora = _hora_colombia(Venta.fecha).label('hora')
+    filas = db.session.query(hora, func.sum(Venta.total), func.count(Venta.id)).filter(
+        Venta.fecha_comercial >= desde, Venta.fecha_comercial <= hasta
+    ).group_by(hora).all()
+
+    horas = [(6 + i) % 24 for i in range(24)]
+    posicion = {h: i for i, h in enumerate(horas)}
+    ventas, num_ventas = [0.0] * 24, [0] * 24
+    for valor, monto, cantidad in filas:
+        i = posicion[int(valor)]
+        ventas[i], num_ventas[i] = float(monto or 0), int(cantidad or 0)
+
+    return {
+        'granularidad': 'hora',
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'labels': [f'{h:02d}:00' for h in horas],
+        'periodos': horas,
+        'series': [{'nombre': 'Ventas', 'data': ventas}],
+        'num_ventas': num_ventas,
+        'total': sum(ventas),
+    }
+
+# =================================================================
+# ANALÍTICA DE PRODUCTOS (VENTAS, MARGEN, ABC Y STOCK SIN MOVIMIENTO)
+# =================================================================
+TOP_ANALITICA = 20
+UMBRALES_ABC = (0.80, 0.95)  # participación acumulada en ingresos que cierra las clases A y B
+
+
+def analitica_productos(desde, hasta):
+    """
+    Indicadores por producto entre dos fechas comerciales (inclusive) con dos consultas:
+    las ventas agrupadas por producto en SQL y el catálogo completo; el resto se calcula
+    con pandas sobre esos dos DataFrames.
+    El costo usa el valor_interno actual del producto (VentaDetalle no guarda el costo histórico).
+    Devuelve (productos, marcas): un DataFrame por producto y otro agregado por marca.
+    """
+    ventas = pd.DataFrame(db.session.execute(
+        select(
+            VentaDetalle.producto_id,
+            func.sum(VentaDetalle.cantidad),
+            func.sum(VentaDetalle.subtotal),
+            func.count(func.distinct(VentaDetalle.venta_id)),
+        ).join(Venta, Venta.id == VentaDetalle.venta_id)
+        .where(Venta.fecha_comercial >= desde, Venta.fecha_comercial <= hasta, VentaDetalle.producto_id.isnot(None))
+        .group_by(VentaDetalle.producto_id)
+    ).all(), columns=['id', 'unidades', 'ingresos', 'num_ventas'])
+
+    catalogo = pd.DataFrame(db.session.execute(
+        select(Producto.id, Producto.codigo, Producto.nombre, Producto.marca,
+               Producto.cantidad, Producto.valor_interno, Producto.valor_venta, Producto.activo)
+    ).all(), columns=['id', 'codigo', 'nombre', 'marca', 'stock', 'valor_interno', 'valor_venta', 'activo'])
+
+    productos = catalogo.merge(ventas, on='id', how='left')
+    productos[['unidades', 'num_ventas']] = productos[['unidades', 'num_ventas']].fillna(0).astype('int64')
+    productos['ingresos'] = productos['ingresos'].fillna(0.0).astype(float)
+    productos['stock'] = productos['stock'].fillna(0).astype('int64')
+    productos['valor_interno'] = productos['valor_interno'].fillna(0.0).astype(float)
+    productos['marca'] = productos['marca'].fillna('Sin marca')
+
+    productos['costo'] = productos['unidades'] * productos['valor_interno']
+    productos['margen'] = productos['ingresos'] - productos['costo']
+    productos['margen_pct'] = (productos['margen'] / productos['ingresos'].where(productos['ingresos'] > 0)).fillna(0.0) * 100
+    productos['valor_stock'] = productos['stock'].clip(lower=0) * productos['valor_interno']
+
+    # Clasificación ABC por participación acumulada en los ingresos del periodo
+    productos = productos.sort_values(['ingresos', 'unidades'], ascending=False, ignore_index=True)
+    total_ingresos = productos['ingresos'].sum()
+    acumulado = productos['ingresos'].cumsum() / total_ingresos if total_ingresos > 0 else productos['ingresos'] * 0
+    # Se clasifica por la participación acumulada ANTES de sumar el producto: el que cruza el umbral queda en la clase
+    previo = acumulado - (productos['ingresos'] / total_ingresos if total_ingresos > 0 else 0)
+    productos['clase_abc'] = np.select(
+        [productos['ingresos'] <= 0, previo < UMBRALES_ABC[0], previo < UMBRALES_ABC[1]],
+        ['Sin ventas', 'A', 'B'], default='C'
+    )
+
+    marcas = productos.groupby('marca', as_index=False).agg(
+        productos=('id', 'count'),
+        unidades=('unidades', 'sum'),
+        ingresos=('ingresos', 'sum'),
+        costo=('costo', 'sum'),
+        valor_stock=('valor_stock', 'sum'),
+    )
+    marcas['margen'] = marcas['ingresos'] - marcas['costo']
+    marcas['margen_pct'] = (marcas['margen'] / marcas['ingresos'].where(marcas['ingresos'] > 0)).fillna(0.0) * 100
+    marcas = marcas.sort_values('ingresos', ascending=False, ignore_index=True)
+    return productos, marcas
+
+
+def resumen_analitica(productos, marcas, top=TOP_ANALITICA):
+    """Extractos del análisis listos para la plantilla o para JSON."""
+    columnas = ['id', 'codigo', 'nombre', 'marca', 'unidades', 'ingresos', 'costo', 'margen', 'margen_pct', 'stock', 'clase_abc']
+    vendidos = productos[productos['unidades'] > 0]
+    sin_movimiento = productos[(productos['unidades'] == 0) & (productos['stock'] > 0)]
+    registros = lambda df: json.loads(df.to_json(orient='records'))
+
+    return {
+        'totales': {
+            'ingresos': float(productos['ingresos'].sum()),
+            'costo': float(productos['costo'].sum()),
+            'margen': float(productos['margen'].sum()),
+            'unidades': int(productos['unidades'].sum()),
+            'productos_vendidos': int(len(vendidos)),
+        },
+        'abc': {
+            clase: {'productos': int(len(grupo)), 'ingresos': float(grupo['ingresos'].sum())}
+            for clase, grupo in productos.groupby('clase_abc')
+        },
+        'top_unidades': registros(vendidos.nlargest(top, 'unidades')[columnas]),
+        'top_ingresos': registros(vendidos.nlargest(top, 'ingresos')[columnas]),
+        'menor_margen': registros(vendidos.nsmallest(top, 'margen_pct')[columnas]),
+        'marcas': registros(marcas),
+        'sin_movimiento': {
+            'productos': int(len(sin_movimiento)),
+            'unidades': int(sin_movimiento['stock'].sum()),
+            'valor': float(sin_movimiento['valor_stock'].sum()),
+            'detalle': registros(sin_movimiento.nlargest(top, 'valor_stock')[columnas + ['valor_stock']]),
+        },
+    }
+
+
+def rango_analitica_desde_parametros():
+    """(desde, hasta) de la URL; por defecto los últimos 30 días comerciales. Lanza ValueError si no es válido."""
+    hoy, _, _ = obtener_rango_turno_colombia()
+    hasta = _fecha_parametro('hasta') or hoy
+    desde = _fecha_parametro('desde') or hasta - timedelta(days=29)
+    if desde > hasta:
+        raise ValueError('La fecha inicial no puede ser posterior a la final.')
+    if (hasta - desde).days > MAX_DIAS_SERIE:
+        raise ValueError(f'El rango máximo es de {MAX_DIAS_SERIE} días.')
+    return desde, hasta
+
+# =================================================================
+# REPOSICIÓN: SUGERENCIAS DE COMPRA SEGÚN LA VELOCIDAD DE VENTA
+# =================================================================
+VENTANA_REPOSICION_DIAS = 90
+PLAZO_ENTREGA_DIAS = 7       # días desde que se pide hasta que llega la mercancía
+COBERTURA_DIAS = 14          # días de venta que debe cubrir cada pedido
+FACTOR_SERVICIO = 1.65       # z para ~95% de probabilidad de no quedarse sin stock
+_cache_reposicion = {}       # {(fecha_comercial, ventana): DataFrame de estadísticas}
+_cache_reposicion_lock = threading.Lock()
+
+
+def calcular_velocidad_ventas(hasta, ventana=VENTANA_REPOSICION_DIAS):
+    """
+    Venta diaria media y su desviación por producto en los `ventana` días comerciales que
+    terminan en `hasta`. Las unidades por producto y día se suman en SQL; media y desviación
+    se calculan con NumPy sobre la matriz producto x día (los días sin venta cuentan como 0).
+    """
+    desde = hasta - timedelta(days=ventana - 1)
+    lineas = pd.DataFrame(db.session.execute(
+        select(VentaDetalle.producto_id, Venta.fecha_comercial, func.sum(VentaDetalle.cantidad))
+        .join(Venta, Venta.id == VentaDetalle.venta_id)
+        .where(Venta.fecha_comercial >= desde, Venta.fecha_comercial <= hasta,
+               VentaDetalle.producto_id.isnot(None))
+        .group_by(VentaDetalle.producto_id, Venta.fecha_comercial)
+    ).all(), columns=['producto_id', 'dia', 'cantidad'])
+    if lineas.empty:
+        return pd.DataFrame(columns=['venta_diaria', 'desviacion', 'dias_con_venta']).rename_axis('id')
+
+    diario = lineas.pivot(index='producto_id', columns='dia', values='cantidad').fillna(0)
+    matriz = diario.to_numpy(dtype=float)
+    suma = matriz.sum(axis=1)
+    media = suma / ventana
+    # Varianza sobre la ventana completa: los días ausentes de la matriz son ceros
+    varianza = ((matriz ** 2).sum(axis=1) - ventana * media ** 2) / max(ventana - 1, 1)
+
+    return pd.DataFrame({
+        'venta_diaria': media,
+        'desviacion': np.sqrt(np.clip(varianza, 0, None)),
+        'dias_con_venta': (matriz > 0).sum(axis=1),
+    }, index=pd.Index(diario.index.astype('int64'), name='id'))
+
+
+def estadisticas_reposicion(ventana=VENTANA_REPOSICION_DIAS):
+    """Estadísticas de venta hasta ayer, calculadas una vez por fecha comercial y proceso."""
+    hoy, _, _ = obtener_rango_turno_colombia()
+    clave = (hoy, ventana)
+    with _cache_reposicion_lock:
+        if clave in _cache_reposicion:
+            return _cache_reposicion[clave]
+
+    estadisticas = calcular_velocidad_ventas(hoy - timedelta(days=1), ventana)
+    with _cache_reposicion_lock:
+        # Solo se conserva el día en curso
+        for vieja in [c for c in _cache_reposicion if c[0] != hoy]:
+            del _cache_reposicion[vieja]
+        _cache_reposicion[clave] = estadisticas
+    return estadisticas
+
+
+def sugerencias_reposicion(ventana=VENTANA_REPOSICION_DIAS, plazo=PLAZO_ENTREGA_DIAS,
+                           cobertura=COBERTURA_DIAS, solo_pedir=True):
+    """
+    Punto de reorden y cantidad sugerida por producto activo con ventas en la ventana:
+        stock de seguridad = z * desviación * raíz(plazo)
+        punto de reorden   = venta diaria * plazo + stock de seguridad
+        sugerido           = venta diaria * (plazo + cobertura) + stock de seguridad - stock
+    Las estadísticas salen de la caché diaria; el stock se lee en el momento.
+    """
+    estadisticas = estadisticas_reposicion(ventana)
+    catalogo = pd.DataFrame(db.session.execute(
+        select(Producto.id, Producto.codigo, Producto.nombre, Producto.marca, Producto.cantidad,
+               Producto.stock_minimo, Producto.valor_interno).where(Producto.activo.is_(True))
+    ).all(), columns=['id', 'codigo', 'nombre', 'marca', 'stock', 'stock_minimo', 'valor_interno'])
+
+    productos = catalogo.join(estadisticas, on='id', how='inner')
+    productos = productos[productos['venta_diaria'] > 0].copy()
+    productos['stock'] = productos['stock'].fillna(0).astype('int64')
+    productos['valor_interno'] = productos['valor_interno'].fillna(0.0)
+    productos['marca'] = productos['marca'].fillna('Sin marca')
+
+    seguridad = FACTOR_SERVICIO * productos['desviacion'] * np.sqrt(plazo)
+    productos['stock_seguridad'] = np.ceil(seguridad).astype('int64')
+    productos['punto_reorden'] = np.ceil(productos['venta_diaria'] * plazo + seguridad).astype('int64')
+    objetivo = np.ceil(productos['venta_diaria'] * (plazo + cobertura) + seguridad)
+    productos['sugerido'] = np.where(
+        productos['stock'] <= productos['punto_reorden'],
+        np.clip(objetivo - productos['stock'], 0, None), 0
+    ).astype('int64')
+    productos['dias_de_stock'] = (productos['stock'].clip(lower=0) / productos['venta_diaria']).round(1)
+    productos['costo_estimado'] = productos['sugerido'] * productos['valor_interno']
+
+    if solo_pedir:
+        productos = productos[productos['sugerido'] > 0]
+    return productos.sort_values(['marca', 'dias_de_stock', 'nombre'], ignore_index=True)
+
+
+def parametros_reposicion():
+    """Ventana, plazo y cobertura de la URL (acotados) con los valores por defecto del negocio."""
+    acotar = lambda nombre, defecto, minimo, maximo: min(max(request.args.get(nombre, defecto, type=int), minimo), maximo)
+    return {
+        'ventana': acotar('ventana', VENTANA_REPOSICION_DIAS, 14, 365),
+        'plazo': acotar('plazo', PLAZO_ENTREGA_DIAS, 1, 90),
+        'cobertura': acotar('cobertura', COBERTURA_DIAS, 1, 180),
+    }
+
+# =================================================================
+# DASHBOARD: MÉTRICAS EN UNA CONSULTA + CACHÉ CORTA
+# =================================================================
+DASHBOARD_CACHE_TTL = 30 # segundos; acota el desfase entre workers de gunicorn
+_cache_dashboard = {'datos': None, 'clave': None, 'expira': 0.0}
+_cache_dashboard_lock = threading.Lock()
+
+
+def invalidar_cache_dashboard():
+    """Solo afecta a este proceso; los demás workers lo notan por la versión del catálogo o el TTL."""
+    with _cache_dashboard_lock:
+        _cache_dashboard['datos'] = None
+
+
+def calcular_metricas_dashboard(fecha_comercial):
+    """Todos los indicadores del dashboard en una sola sentencia SQL (solo productos activos)."""
+    inicio_mes = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0)
+    cantidad = func.coalesce(Producto.cantidad, 0)
+
+    ventas_hoy = select(func.coalesce(func.sum(ResumenVentas.monto), 0)).where(
+        ResumenVentas.fecha_comercial == fecha_comercial,
+        ResumenVentas.metodo == RESUMEN_TOTAL
+    ).scalar_subquery()
+    clientes_nuevos = select(func.count(Cliente.id)).where(
+        Cliente.fecha_registro >= inicio_mes
+    ).scalar_subquery()
+
+    fila = db.session.execute(select(
+        func.count(case((Producto.cantidad <= Producto.stock_minimo, 1))),
+        func.coalesce(func.sum(cantidad), 0),
+        func.coalesce(func.sum(func.coalesce(Producto.valor_interno, 0) * cantidad), 0),
+        func.coalesce(func.sum(func.coalesce(Producto.valor_venta, 0) * cantidad), 0),
+        ventas_hoy,
+        clientes_nuevos
+    ).select_from(Producto).where(Producto.activo.is_(True))).one()
+
+    return {
+        'productos_stock_bajo': int(fila[0] or 0),
+        'total_inventario': int(fila[1] or 0),
+        'valor_interno_total': float(fila[2] or 0),
+        'valor_venta_total': float(fila[3] or 0),
+        'ventas_hoy': float(fila[4] or 0),
+        'clientes_nuevos_mes': int(fila[5] or 0)
+    }
+
+
+def obtener_metricas_dashboard():
+    """
+    Métricas del dashboard desde la caché del proceso. La caché va por fecha comercial y versión
+    del catálogo: cualquier venta, anulación o cambio de stock confirmado en otro worker sube la
+    versión y fuerza el recálculo. Lo que no toca productos (clientes nuevos, cambios de método
+    de pago) solo se invalida en el proceso que lo hizo; en los demás espera al TTL.
+    """
+    fecha_comercial, _, _ = obtener_rango_turno_colombia()
+    clave = (fecha_comercial, version_catalogo_actual())
+    with _cache_dashboard_lock:
+        if (_cache_dashboard['datos'] is not None
+                and _cache_dashboard['clave'] == clave
+                and _cache_dashboard['expira'] > monotonic()):
+            return dict(_cache_dashboard['datos'])
+
+    datos = calcular_metricas_dashboard(fecha_comercial)
+    fecha_cierre, momento_cierre = cierre_mes_anterior()
+    datos['unidades_cierre_mes'], datos['valor_cierre_mes'] = valor_inventario_en(momento_cierre)
+    datos['fecha_cierre_mes'] = fecha_cierre.isoformat()
+    with _cache_dashboard_lock:
+        _cache_dashboard.update(datos=datos, clave=clave, expira=monotonic() + DASHBOARD_CACHE_TTL)
+    return dict(datos)
+
+
+@event.listens_for(Session, 'after_flush')
+def _marcar_cambios_flush(session, flush_context):
+    if session.new or session.dirty or session.deleted:
+        session.info['invalidar_dashboard'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _marcar_cambios_dml(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['invalidar_dashboard'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidar_tras_commit(session):
+    if session.info.pop('invalidar_dashboard', False):
+        invalidar_cache_dashboard()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _descartar_marca_cambios(session):
+    session.info.pop('invalidar_dashboard', None)
+
+# =================================================================
+# BÚSQUEDA DE PRODUCTOS (pg_trgm EN POSTGRESQL, FTS5 EN SQLITE)
+# =================================================================
+_busqueda_productos = {'motor': 'ilike'}
+
+# Debe coincidir textualmente con la expresión del índice GIN para que PostgreSQL lo use
+_EXPR_BUSQUEDA_PG = (
+    "(coalesce(nombre, '') || ' ' || coalesce(codigo, '') || ' ' || "
+    "coalesce(marca, '') || ' ' || coalesce(descripcion, ''))"
+)
+
+
+def escapar_like(texto):
+    """Escapa los comodines de LIKE (% y _) para usar el texto literal con escape='\\'."""
+    return texto.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_')
+
+
+_DDL_BUSQUEDA_SQLITE = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS producto_fts USING fts5(
+        nombre, codigo, marca, descripcion,
+        content='producto', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS producto_fts_ai AFTER INSERT ON producto BEGIN
+        INSERT INTO producto_fts(rowid, nombre, codigo, marca, descripcion)
+        VALUES (new.id, new.nombre, new.codigo, new.marca, new.descripcion);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS producto_fts_ad AFTER DELETE ON producto BEGIN
+        INSERT INTO producto_fts(producto_fts, rowid, nombre, codigo, marca, descripcion)
+        VALUES ('delete', old.id, old.nombre, old.codigo, old.marca, old.descripcion);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS producto_fts_au AFTER UPDATE OF nombre, codigo, marca, descripcion ON producto BEGIN
+        INSERT INTO producto_fts(producto_fts, rowid, nombre, codigo, marca, descripcion)
+        VALUES ('delete', old.id, old.nombre, old.codigo, old.marca, old.descripcion);
+        INSERT INTO producto_fts(rowid, nombre, codigo, marca, descripcion)
+        VALUES (new.id, new.nombre, new.codigo, new.marca, new.descripcion);
+    END""",
+]
+
+
+def preparar_busqueda_productos():
+    """
+    Crea (si faltan) los índices de búsqueda: trigramas en PostgreSQL o una tabla FTS5
+    sincronizada por triggers en SQLite. Si no es posible, la búsqueda sigue con ILIKE.
+    """
+    dialecto = db.engine.dialect.name
+    try:
+        if dialecto == 'postgresql':
+            with db.engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_producto_busqueda_trgm ON producto "
+                    f"USING gin ({_EXPR_BUSQUEDA_PG} gin_trgm_ops)"
+                ))
+            _busqueda_productos['motor'] = 'pg_trgm'
+        elif dialecto == 'sqlite':
+            with db.engine.begin() as conn:
+                nueva = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'producto_fts'")).first() is None
+                for ddl in _DDL_BUSQUEDA_SQLITE:
+                    conn.execute(text(ddl))
+                if nueva:
+                    conn.execute(text("INSERT INTO producto_fts(producto_fts) VALUES ('rebuild')"))
+            _busqueda_productos['motor'] = 'fts5'
+    except Exception as e:
+        print(f"❌ Advertencia: búsqueda indexada no disponible, se usará ILIKE. Detalle: {e}")
+        _busqueda_productos['motor'] = 'ilike'
+
+
+def buscar_productos(termino, ordenar=True):
+    """
+    Consulta de Producto filtrada por `termino` y ordenada por relevancia.
+    El producto cuyo código de barras es exactamente `termino` siempre está incluido y va primero.
+    Con ordenar=False solo se aplica el filtro (útil para paginar por ID).
+    """
+    termino = (termino or '').strip()
+    if not termino:
+        return Producto.query.order_by(Producto.id.desc())
+
+    motor = _busqueda_productos['motor']
+    palabras = re.findall(r'\w+', termino)
+    exacto = Producto.codigo == termino
+    primero_exacto = case((exacto, 0), else_=1)
+
+    if motor == 'pg_trgm':
+        expr = literal_column(_EXPR_BUSQUEDA_PG)
+        contiene = and_(*[expr.ilike(literal(f'%{escapar_like(p)}%'), escape='\\') for p in termino.split()])
+        query = Producto.query.filter(or_(exacto, contiene, expr.op('%>')(literal(termino))))
+        if not ordenar:
+            return query
+        return query.order_by(primero_exacto, func.word_similarity(termino, expr).desc(), Producto.nombre)
+
+    if motor == 'fts5' and palabras:
+        consulta_fts = ' '.join(f'"{p}"*' for p in palabras)
+        # El código exacto entra por el índice único de codigo, sin recorrer la tabla
+        coincidencias = text(
+            "SELECT id, min(rango) AS rango FROM ("
+            " SELECT rowid AS id, bm25(producto_fts) AS rango FROM producto_fts WHERE producto_fts MATCH :q"
+            " UNION ALL SELECT id, NULL FROM producto WHERE codigo = :codigo"
+            ") GROUP BY id"
+        ).bindparams(q=consulta_fts, codigo=termino).columns(id=db.Integer, rango=db.Float).subquery()
+        query = Producto.query.join(coincidencias, coincidencias.c.id == Producto.id)
+        if not ordenar:
+            return query
+        return query.order_by(primero_exacto, coincidencias.c.rango, Producto.nombre)
+
+    patron = f'%{escapar_like(termino)}%'
+    query = Producto.query.filter(
+        exacto |
+        (Producto.nombre.ilike(patron, escape='\\')) |
+        (Producto.codigo.ilike(patron, escape='\\')) |
+        (Producto.descripcion.ilike(patron, escape='\\')) |
+        (Producto.marca.ilike(patron, escape='\\'))
+    )
+    if not ordenar:
+        return query.order_by(Producto.id.desc())
+    return query.order_by(primero_exacto, Producto.id.desc())
+
+# =================================================================
+# VERSIÓN DEL CATÁLOGO (SINCRONIZACIÓN POR DELTAS)
+# =================================================================
+CONTADOR_CATALOGO = 'catalogo'
+CONTADOR_EPOCA = 'epoca_catalogo'
+
+
+def version_catalogo(session=None):
+    """
+    Versión que reciben los cambios de productos de la transacción en curso (una por transacción).
+    Es provisional: un número negativo propio de la transacción, que ninguna consulta de cambios
+    alcanza. Al confirmar, _confirmar_version_catalogo la cambia por la definitiva.
+    """
+    session = session or db.session()
+    if 'version_catalogo' not in session.info:
+        session.info['version_catalogo'] = -(uuid.uuid4().int >> 66) - 1
+    return session.info['version_catalogo']
+
+
+@event.listens_for(Session, 'before_commit')
+def _confirmar_version_catalogo(session):
+    """
+    Toma el siguiente valor del contador y lo asigna a las filas con la versión provisional.
+    La fila del contador queda bloqueada solo desde aquí hasta el commit. Durante la transacción
+    las ventas simultáneas no se esperan entre sí. Además, el contador siempre se bloquea
+    después de las filas de producto, en todas las transacciones, así que el orden no produce
+    bloqueos cruzados. Las versiones siguen el orden de commit, que es lo que necesita
+    api_cambios_productos.
+    """
+    if session.in_nested_transaction():
+        return
+    session.flush()  # los cambios aún pendientes también reciben la versión provisional
+    provisional = session.info.get('version_catalogo')
+    if provisional is None:
+        return
+    tabla = ContadorVersion.__table__
+    conn = session.connection()
+    conn.execute(tabla.update().where(tabla.c.nombre == CONTADOR_CATALOGO).values(valor=tabla.c.valor + 1))
+    definitiva = conn.execute(select(tabla.c.valor).where(tabla.c.nombre == CONTADOR_CATALOGO)).scalar_one()
+    for modelo in (Producto, ProductoBaja):
+        conn.execute(
+            update(modelo.__table__).where(modelo.__table__.c.version == provisional).values(version=definitiva)
+        )
+
+
+def version_catalogo_actual():
+    valor = db.session.query(ContadorVersion.valor).filter_by(nombre=CONTADOR_CATALOGO).scalar()
+    return int(valor or 0)
+
+
+def epoca_catalogo_actual():
+    valor = db.session.query(ContadorVersion.valor).filter_by(nombre=CONTADOR_EPOCA).scalar()
+    return int(valor or 0)
+
+
+def nueva_epoca_catalogo():
+    """Invalida las copias locales del catálogo: al ver otra época el cliente lo recarga completo."""
+    tabla = ContadorVersion.__table__
+    db.session.execute(tabla.update().where(tabla.c.nombre == CONTADOR_EPOCA).values(valor=tabla.c.valor + 1))
+
+
+def registrar_bajas_productos(query):
+    """Deja constancia (ProductoBaja) de los productos de `query` antes de un borrado masivo."""
+    db.session.execute(insert(ProductoBaja).from_select(
+        ['producto_id', 'version'],
+        query.with_entities(Producto.id, literal(version_catalogo(), db.BigInteger))
+    ))
+
+
+@event.listens_for(Session, 'before_flush')
+def _versionar_productos(session, flush_context, instances):
+    for obj in session.new:
+        if isinstance(obj, Producto):
+            obj.version = version_catalogo(session)
+    for obj in session.dirty:
+        if isinstance(obj, Producto) and session.is_modified(obj, include_collections=False):
+            obj.version = version_catalogo(session)
+    for obj in session.deleted:
+        if isinstance(obj, Producto):
+            session.add(ProductoBaja(producto_id=obj.id, version=version_catalogo(session)))
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _liberar_version_catalogo(session):
+    session.info.pop('version_catalogo', None)
+
+# =================================================================
+# STOCK: BLOQUEO Y AJUSTES EN LOTE
+# =================================================================
+class StockInsuficienteError(Exception):
+    """Error de stock con el detalle de cada línea que no se puede despachar."""
+    def __init__(self, errores):
+        self.errores = list(errores)
+        super().__init__(' | '.join(self.errores))
+
+
+def bloquear_productos(ids):
+    """
+    Carga en una sola consulta los productos indicados y bloquea sus filas
+    (SELECT ... FOR UPDATE) en orden de ID para evitar bloqueos cruzados entre cajas.
+    Devuelve un diccionario {id: Producto} con los valores leídos bajo el bloqueo, aunque los
+    objetos ya estuvieran cargados en la sesión.
+    """
+    ids = sorted(set(ids))
+    if not ids:
+        return {}
+    productos = Producto.query.filter(Producto.id.in_(ids)).order_by(Producto.id).with_for_update().populate_existing().all()
+    return {p.id: p for p in productos}
+
+
+def aplicar_deltas_stock(deltas, motivo, referencia=None, movimientos=None):
+    """
+    Aplica las variaciones {producto_id: delta} con un único UPDATE condicional
+    y las deja en el kardex con `motivo` y `referencia`.
+    Si el ajuste reúne varias operaciones, `movimientos` [(producto_id, delta, referencia)]
+    reemplaza a `deltas` como detalle del kardex (la suma por producto debe coincidir).
+    Las filas con delta negativo solo se actualizan si el stock alcanza; si alguna
+    no cumple (p. ej. otra caja vendió primero) se lanza StockInsuficienteError.
+    """
+    deltas = {int(pid): int(d) for pid, d in deltas.items() if d}
+    if not deltas:
+        return
+
+    delta_expr = case(deltas, value=Producto.id)
+    stock_actual = func.coalesce(Producto.cantidad, 0)
+    resultado = db.session.execute(
+        update(Producto)
+        .where(Producto.id.in_(deltas.keys()), or_(delta_expr >= 0, stock_actual + delta_expr >= 0))
+        .values(cantidad=stock_actual + delta_expr, version=version_catalogo())
+        .execution_options(synchronize_session='fetch')
+    )
+
+    if resultado.rowcount != len(deltas):
+        raise StockInsuficienteError([
+            'El stock cambió mientras se procesaba la operación. Recargue e intente de nuevo.'
+        ])
+    if movimientos is None:
+        registrar_movimientos(deltas, motivo, referencia)
+    else:
+        registrar_movimientos_desglosados(movimientos, motivo)
+
+# =================================================================
+# KARDEX: MOVIMIENTOS DE INVENTARIO Y FOTOS DIARIAS DE SALDO
+# =================================================================
+MAX_DIAS_SNAPSHOT = 400
+
+
+def registrar_movimientos(deltas, motivo, referencia=None, usuario_id=None):
+    """Agrega al kardex una fila por producto con delta distinto de cero (un solo INSERT en lote)."""
+    registrar_movimientos_desglosados(
+        [(pid, delta, referencia) for pid, delta in deltas.items()], motivo, usuario_id
+    )
+
+
+def registrar_movimientos_desglosados(movimientos, motivo, usuario_id=None):
+    """Como registrar_movimientos, pero con una referencia por fila: [(producto_id, delta, referencia)]."""
+    if usuario_id is None and has_request_context() and current_user.is_authenticated:
+        usuario_id = current_user.id
+    fecha = datetime.utcnow()
+    filas = [
+        {'producto_id': int(pid), 'delta': int(delta), 'motivo': motivo,
+         'referencia': referencia, 'usuario_id': usuario_id, 'fecha': fecha}
+        for pid, delta, referencia in movimientos if delta
+    ]
+    if filas:
+        db.session.execute(insert(MovimientoInventario), filas)
+
+
+def tomar_snapshots_inventario():
+    """
+    Guarda el saldo al cierre de cada fecha comercial terminada que aún no tenga foto.
+    El saldo de un día pasado es el stock actual menos los movimientos posteriores a su cierre.
+    Devuelve la cantidad de fechas registradas.
+    """
+    hoy, _, _ = obtener_rango_turno_colombia()
+    ayer = hoy - timedelta(days=1)
+    ultima = db.session.query(func.max(SaldoInventario.fecha_comercial)).scalar()
+    desde = ultima + timedelta(days=1) if ultima else ayer
+    desde = max(desde, ayer - timedelta(days=MAX_DIAS_SNAPSHOT))
+
+    fechas = 0
+    fecha = desde
+    while fecha <= ayer:
+        _, fin = rango_utc_fecha_comercial(fecha)
+        posteriores = select(
+            MovimientoInventario.producto_id, func.sum(MovimientoInventario.delta).label('total')
+        ).where(MovimientoInventario.fecha >= fin).group_by(MovimientoInventario.producto_id).subquery()
+        db.session.execute(insert(SaldoInventario).from_select(
+            ['fecha_comercial', 'producto_id', 'cantidad'],
+            select(
+                literal(fecha, db.Date), Producto.id,
+                func.coalesce(Producto.cantidad, 0) - func.coalesce(posteriores.c.total, 0)
+            ).select_from(Producto).outerjoin(posteriores, posteriores.c.producto_id == Producto.id)
+        ))
+        fechas += 1
+        fecha += timedelta(days=1)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otro worker tomó la misma foto al mismo tiempo
+        db.session.rollback()
+        return 0
+    return fechas
+
+
+def consulta_saldos_en(momento_utc):
+    """
+    Subconsulta (producto_id, cantidad) con el stock de cada producto en `momento_utc`:
+    la última foto diaria anterior más los movimientos entre su cierre y `momento_utc`.
+    Sin foto previa, se parte del stock actual y se descuentan los movimientos posteriores.
+    """
+    limite = fecha_comercial_de(momento_utc) - timedelta(days=1)
+    foto = db.session.query(func.max(SaldoInventario.fecha_comercial)).filter(
+        SaldoInventario.fecha_comercial <= limite
+    ).scalar()
+
+    if foto is None:
+        partes = select(Producto.id.label('producto_id'), func.coalesce(Producto.cantidad, 0).label('cantidad')).union_all(
+            select(MovimientoInventario.producto_id, -MovimientoInventario.delta)
+            .where(MovimientoInventario.fecha >= momento_utc)
+        )
+    else:
+        _, cierre_foto = rango_utc_fecha_comercial(foto)
+        partes = select(SaldoInventario.producto_id, SaldoInventario.cantidad).where(
+            SaldoInventario.fecha_comercial == foto
+        ).union_all(
+            select(MovimientoInventario.producto_id, MovimientoInventario.delta).where(
+                MovimientoInventario.fecha >= cierre_foto, MovimientoInventario.fecha < momento_utc
+            )
+        )
+    partes = partes.subquery()
+    return select(
+        partes.c.producto_id, func.sum(partes.c.cantidad).label('cantidad')
+    ).group_by(partes.c.producto_id).subquery()
+
+
+def valor_inventario_en(momento_utc):
+    """(unidades, valor a costo interno) del inventario en `momento_utc`, con los costos actuales."""
+    saldos = consulta_saldos_en(momento_utc)
+    fila = db.session.execute(select(
+        func.coalesce(func.sum(saldos.c.cantidad), 0),
+        func.coalesce(func.sum(saldos.c.cantidad * func.coalesce(Producto.valor_interno, 0)), 0)
+    ).select_from(saldos).join(Producto, Producto.id == saldos.c.producto_id)).one()
+    return int(fila[0] or 0), float(fila[1] or 0)
+
+
+def cierre_mes_anterior():
+    """Última fecha comercial del mes anterior y el momento UTC de su cierre."""
+    hoy, _, _ = obtener_rango_turno_colombia()
+    fecha = hoy.replace(day=1) - timedelta(days=1)
+    return fecha, rango_utc_fecha_comercial(fecha)[1]
+
+
+@app.cli.command('snapshot-inventario')
+def snapshot_inventario_command():
+    """Toma las fotos diarias de saldo pendientes (para programar con cron)."""
+    fechas = tomar_snapshots_inventario()
+    click.echo(f'✅ Fotos de inventario registradas: {fechas} fecha(s).')
 # =================================================================
 # RUTAS Y LÓGICA
 # =================================================================
@@ -256,56 +1756,40 @@ def logout():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    fecha_comercial, inicio_utc, fin_utc = obtener_rango_turno_colombia()
-
     try:
-        productos_bajos = Producto.query.filter(Producto.cantidad <= Producto.stock_minimo).count()
+        metricas = obtener_metricas_dashboard()
     except OperationalError: # Manejo específico de error de DB
-        productos_bajos = 0
+        metricas = {}
         flash('Advertencia: Problema de conexión/tabla de base de datos.', 'warning')
     except Exception:
-        productos_bajos = 0
-
-    try:
-        total_inventario_query = db.session.query(func.sum(Producto.cantidad)).scalar()
-        total_inventario = int(total_inventario_query) if total_inventario_query is not None else 0
-    except Exception:
-        total_inventario = 0
-
-    try:
-        ventas_hoy_query = db.session.query(func.sum(Venta.total)).filter(
-            and_(Venta.fecha >= inicio_utc, Venta.fecha <= fin_utc)
-        ).scalar()
-        ventas_hoy = ventas_hoy_query if ventas_hoy_query is not None else 0.00
-    except Exception:
-        ventas_hoy = 0.00
-
-    try:
-        inicio_mes = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0)
-        clientes_nuevos_mes = Cliente.query.filter(Cliente.fecha_registro >= inicio_mes).count()
-    except Exception:
-        clientes_nuevos_mes = 0
-
-            # ===================== VALOR TOTAL DEL INVENTARIO =====================
-    try:
-        productos_lista = Producto.query.all()
-        valor_interno_total = sum((p.valor_interno or 0) * (p.cantidad or 0) for p in productos_lista)
-        valor_venta_total = sum((p.valor_venta or 0) * (p.cantidad or 0) for p in productos_lista)
-    except Exception:
-        valor_interno_total = 0
-        valor_venta_total = 0
-
+        metricas = {}
 
     return render_template(
     'dashboard.html',
     current_user=current_user,
-    productos_stock_bajo=productos_bajos,
-    total_inventario=total_inventario,
-    ventas_hoy=ventas_hoy,
-    clientes_nuevos_mes=clientes_nuevos_mes,
-    valor_interno_total=valor_interno_total,
-    valor_venta_total=valor_venta_total
+    productos_stock_bajo=metricas.get('productos_stock_bajo', 0),
+    total_inventario=metricas.get('total_inventario', 0),
+    ventas_hoy=metricas.get('ventas_hoy', 0.00),
+    clientes_nuevos_mes=metricas.get('clientes_nuevos_mes', 0),
+    valor_interno_total=metricas.get('valor_interno_total', 0),
+    valor_venta_total=metricas.get('valor_venta_total', 0),
+    valor_cierre_mes=metricas.get('valor_cierre_mes', 0),
+    fecha_cierre_mes=metricas.get('fecha_cierre_mes')
 )
+
+@app.route('/api/dashboard/metricas', methods=['GET'])
+@login_required
+def api_metricas_dashboard():
+    try:
+        metricas = obtener_metricas_dashboard()
+    except OperationalError:
+        return jsonify({'error': 'Error de base de datos.'}), 500
+
+    if current_user.rol.lower() != 'administrador':
+        metricas.pop('valor_interno_total', None)
+        metricas.pop('valor_venta_total', None)
+        metricas.pop('valor_cierre_mes', None)
+    return jsonify(metricas)
 # -------------------- RUTAS CLIENTES --------------------
 @app.route('/clientes')
 @login_required
@@ -388,30 +1872,32 @@ def editar_cliente(cliente_id):
 @app.route('/inventario')
 @login_required
 def inventario():
-    page = request.args.get('page', 1, type=int)
+    despues = request.args.get('despues', type=int)
+    antes = request.args.get('antes', type=int)
     per_page = 50
     
     search_query = request.args.get('search', '').strip()
-    query = Producto.query.order_by(Producto.id.desc())
-    
-    if search_query:
-        query = query.filter(
-            (Producto.nombre.ilike(f'%{search_query}%')) |
-            (Producto.codigo.ilike(f'%{search_query}%')) |
-            (Producto.descripcion.ilike(f'%{search_query}%'))
-        )
-    
-    # Se eliminó la definición interna de EmptyPagination y se usa la global.
 
     try:
-        productos_paginados = query.paginate(page=page, per_page=per_page, error_out=False)
+        # El listado se pagina por ID (más recientes primero), también al buscar. Un código
+        # escaneado va fijo al inicio de la primera página y queda fuera del resto del paginado
+        query = buscar_productos(search_query, ordenar=False)
+        exacto = Producto.query.filter(Producto.codigo == search_query).first() if search_query else None
+        if exacto:
+            query = query.filter(Producto.id != exacto.id)
+        productos_paginados = paginar_keyset(query, Producto.id, per_page, despues=despues, antes=antes)
+        if exacto:
+            if productos_paginados.total is not None:
+                productos_paginados.total += 1
+            if not productos_paginados.has_prev:
+                productos_paginados.items.insert(0, exacto)
     except OperationalError as e:
         # Mensaje de error si la tabla no existe o es inaccesible
         flash(f'❌ Error de Base de Datos: La tabla de productos es inaccesible. Detalle: {e}', 'danger')
-        productos_paginados = EmptyPagination()
+        productos_paginados = PaginaKeyset(per_page=per_page)
     except Exception as e:
         flash(f'❌ Error de paginación o consulta de inventario: {e}', 'danger')
-        productos_paginados = EmptyPagination()
+        productos_paginados = PaginaKeyset(per_page=per_page)
 
 
     return render_template('productos.html', 
@@ -448,6 +1934,7 @@ def agregar_producto():
         )
         db.session.add(nuevo_producto)
         db.session.flush() # Obtiene el ID antes del commit
+        registrar_movimientos({nuevo_producto.id: nuevo_producto.cantidad}, 'alta_producto')
 
         if nuevo_producto.codigo is None:
             # Genera un código basado en el ID, asegurando un formato de 12 dígitos
@@ -456,11 +1943,8 @@ def agregar_producto():
         db.session.commit()
         flash('Producto agregado exitosamente!', 'success')
         
-        # Redirige a la última página donde estará el producto nuevo
-        total_productos = Producto.query.count()
-        per_page = 50
-        last_page = (total_productos + per_page - 1) // per_page if per_page > 0 else 1
-        return redirect(url_for('inventario', page=last_page))
+        # El inventario se ordena por ID descendente: el producto nuevo queda en la primera página
+        return redirect(url_for('inventario'))
 
     except IntegrityError:
         db.session.rollback()
@@ -477,11 +1961,21 @@ def eliminar_producto(producto_id):
     if current_user.rol.lower() != 'administrador':
         flash('Permiso denegado. Solo administradores pueden eliminar productos.', 'danger')
         return redirect(url_for('inventario'))
+    Producto.query.get_or_404(producto_id)
     try:
-        producto = Producto.query.get_or_404(producto_id)
-        db.session.delete(producto)
-        db.session.commit()
-        flash('Producto eliminado correctamente.', 'success')
+        producto = bloquear_productos([producto_id])[producto_id]
+        if db.session.query(VentaDetalle.id).filter_by(producto_id=producto.id).first():
+            # Con ventas registradas no se puede borrar sin perder el historial: se desactiva
+            # (conserva su stock; las terminales lo reciben como cambio con activo = false)
+            producto.activo = False
+            db.session.commit()
+            flash(f'{producto.nombre} tiene ventas registradas: se desactivó en lugar de eliminarse.', 'warning')
+        else:
+            # El stock que se va queda en el kardex; el borrado deja su ProductoBaja (_versionar_productos)
+            registrar_movimientos({producto.id: -(producto.cantidad or 0)}, 'baja_producto')
+            db.session.delete(producto)
+            db.session.commit()
+            flash('Producto eliminado correctamente.', 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'Error al eliminar producto: {e}', 'danger')
@@ -502,12 +1996,22 @@ def editar_producto(producto_id):
             if codigo_editado is None and producto.codigo:
                   flash('Error: No puedes dejar el código de barras en blanco si ya tiene uno.', 'danger')
                   return redirect(url_for('editar_producto', producto_id=producto_id))
-
+            cantidad_nueva = int(request.form.get('cantidad') or 0)
+            if cantidad_nueva < 0:
+                flash('Error: La cantidad no puede ser negativa.', 'danger')
+                return redirect(url_for('editar_producto', producto_id=producto_id))
+
+            # Se aplica la diferencia respecto al stock que vio el formulario sobre la fila bloqueada:
+            # una venta confirmada mientras se editaba no se pierde y el kardex registra el ajuste real
+            producto = bloquear_productos([producto.id])[producto.id]
+            cantidad_original = request.form.get('cantidad_original', type=int)
+            if cantidad_original is None:
+                cantidad_original = producto.cantidad or 0
             producto.codigo = codigo_editado
             producto.nombre = request.form.get('nombre')
             producto.descripcion = request.form.get('descripcion')
             producto.marca = request.form.get('marca', '').strip() or None
-            producto.cantidad = int(request.form.get('cantidad') or 0)
+            aplicar_deltas_stock({producto.id: cantidad_nueva - cantidad_original}, 'ajuste_manual')
             producto.valor_venta = float(request.form.get('valor_venta') or 0)
             producto.valor_interno = float(request.form.get('valor_interno') or 0)
             db.session.commit()
@@ -520,7 +2024,7 @@ def editar_producto(producto_id):
             db.session.rollback()
         return redirect(url_for('inventario'))
 
-    barcode_img = generar_barcode_base64(producto.codigo)
+    barcode_img = url_for('imagen_barcode', formato='png', codigo=producto.codigo) if producto.codigo else None
     return render_template('editar_producto.html', producto=producto, barcode_img=barcode_img)
 
 @app.route('/inventario/agregar_stock', methods=['POST'])
@@ -543,14 +2047,16 @@ def agregar_stock_por_codigo():
             flash('Error: La cantidad a agregar debe ser positiva.', 'danger')
             return redirect(url_for('inventario'))
 
-        producto = Producto.query.filter_by(codigo=codigo).first()
+        producto_id = db.session.query(Producto.id).filter_by(codigo=codigo).scalar()
+        producto = bloquear_productos([producto_id]).get(producto_id) if producto_id else None
         if not producto:
             flash(f'Error: Producto con código {codigo} no encontrado.', 'danger')
             return redirect(url_for('inventario'))
 
-        producto.cantidad += cantidad_a_agregar
+        # Mismo camino que la recepción: UPDATE atómico sobre la fila bloqueada y movimiento en el kardex
+        aplicar_deltas_stock({producto.id: cantidad_a_agregar}, 'ingreso_manual')
         db.session.commit()
-        flash(f'Stock de {producto.nombre} actualizado (+{cantidad_a_agregar}).', 'success')
+        flash(f'Stock de {producto.nombre} actualizado (+{cantidad_a_agregar}). Stock actual: {producto.cantidad}.', 'success')
 
     except ValueError:
         flash('Error: La cantidad debe ser un número entero válido.', 'danger')
@@ -559,47 +2065,688 @@ def agregar_stock_por_codigo():
         flash(f'Error al agregar stock: {e}', 'danger')
 
     return redirect(url_for('inventario'))
+
+
+MAX_LINEAS_RECEPCION = 1000
+
+
+def agrupar_items_escaneados(items, permitir_cero=False):
+    """
+    Suma por código las lecturas [{"codigo": ..., "cantidad": ...}] (un producto puede
+    escanearse varias veces). Devuelve ({codigo: cantidad}, [lecturas inválidas]).
+    """
+    solicitado, invalidos = defaultdict(int), []
+    for item in items:
+        codigo = str((item or {}).get('codigo') or '').strip()
+        try:
+            cantidad = int((item or {}).get('cantidad') or 0)
+        except (TypeError, ValueError):
+            cantidad = -1
+        if not codigo or cantidad < 0 or (cantidad == 0 and not permitir_cero):
+            invalidos.append({'codigo': codigo, 'cantidad': (item or {}).get('cantidad'),
+                              'motivo': 'Código vacío o cantidad no válida'})
+            continue
+        solicitado[codigo] += cantidad
+    return solicitado, invalidos
+
+
+def ids_por_codigo(codigos):
+    """Resuelve los códigos de barras a IDs de producto con un solo IN: {codigo: id}."""
+    if not codigos:
+        return {}
+    return {
+        codigo: pid for pid, codigo in
+        db.session.query(Producto.id, Producto.codigo).filter(Producto.codigo.in_(list(codigos)))
+    }
+
+
+@app.route('/api/inventario/recepcion', methods=['POST'])
+@login_required
+def api_recepcion_inventario():
+    """
+    Registra de una vez lo escaneado en una recepción de mercancía.
+    Cuerpo JSON: {"id_envio": "<uuid>", "items": [{"codigo": "...", "cantidad": 3}, ...]}.
+    Resuelve todos los códigos con un solo IN, suma todo con un único UPDATE y devuelve
+    los códigos desconocidos o inválidos para que se corrijan y se envíen de nuevo.
+    """
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado. Solo administradores pueden modificar inventario.'}), 403
+
+    datos = request.get_json(silent=True) or {}
+    id_envio = str(datos.get('id_envio') or '').strip()
+    items = datos.get('items')
+    if not id_envio or len(id_envio) > 36:
+        return jsonify({'error': 'Falta el identificador del envío (id_envio).'}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'No hay productos para registrar.'}), 400
+    if len(items) > MAX_LINEAS_RECEPCION:
+        return jsonify({'error': f'Máximo {MAX_LINEAS_RECEPCION} líneas por envío.'}), 400
+
+    previa = RecepcionInventario.query.filter_by(id_envio=id_envio).first()
+    if previa:
+        return jsonify({'error': 'Este envío ya fue registrado.', 'recepcion_id': previa.id}), 409
+
+    solicitado, invalidos = agrupar_items_escaneados(items)
+    encontrados = ids_por_codigo(solicitado)
+    desconocidos = [{'codigo': c, 'cantidad': q} for c, q in solicitado.items() if c not in encontrados]
+
+    deltas = {encontrados[c]: q for c, q in solicitado.items() if c in encontrados}
+    if not deltas:
+        return jsonify({'error': 'Ningún código corresponde a un producto.',
+                        'desconocidos': desconocidos, 'invalidos': invalidos}), 422
+
+    try:
+        recepcion = RecepcionInventario(
+            id_envio=id_envio, usuario_id=current_user.id,
+            lineas=len(deltas), unidades=sum(deltas.values())
+        )
+        db.session.add(recepcion)
+        db.session.flush()
+        aplicar_deltas_stock(deltas, 'recepcion', f'Recepción #{recepcion.id}')
+        actualizados = [{
+            'id': p.id, 'codigo': p.codigo, 'nombre': p.nombre,
+            'agregado': deltas[p.id], 'cantidad': p.cantidad
+        } for p in db.session.query(Producto.id, Producto.codigo, Producto.nombre, Producto.cantidad)
+                              .filter(Producto.id.in_(list(deltas)))]
+        db.session.commit()
+    except IntegrityError:
+        # Dos envíos simultáneos con el mismo id_envio: solo uno se aplica
+        db.session.rollback()
+        return jsonify({'error': 'Este envío ya fue registrado.'}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Error al registrar la recepción: {e}'}), 500
+
+    return jsonify({
+        'recepcion_id': recepcion.id,
+        'lineas': recepcion.lineas,
+        'unidades': recepcion.unidades,
+        'actualizados': actualizados,
+        'desconocidos': desconocidos,
+        'invalidos': invalidos
+    })
+
+
+def _fecha_parametro(nombre):
+    """Lee un parámetro YYYY-MM-DD de la URL; None si falta. Lanza ValueError si es inválido."""
+    valor = request.args.get(nombre, '').strip()
+    return datetime.strptime(valor, '%Y-%m-%d').date() if valor else None
+
+
+@app.route('/api/inventario/kardex/<int:producto_id>')
+@login_required
+def api_kardex_producto(producto_id):
+    """
+    Movimientos de un producto entre dos fechas comerciales (?desde=&hasta=, por defecto los
+    últimos 30 días), con el saldo inicial y el saldo después de cada movimiento.
+    """
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+    try:
+        hoy, _, _ = obtener_rango_turno_colombia()
+        hasta = _fecha_parametro('hasta') or hoy
+        desde = _fecha_parametro('desde') or hasta - timedelta(days=30)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas. Use el formato AAAA-MM-DD.'}), 400
+    if desde > hasta:
+        return jsonify({'error': 'La fecha inicial no puede ser posterior a la final.'}), 400
+
+    inicio, _ = rango_utc_fecha_comercial(desde)
+    _, fin = rango_utc_fecha_comercial(hasta)
+    saldos = consulta_saldos_en(inicio)
+    saldo = db.session.execute(
+        select(saldos.c.cantidad).where(saldos.c.producto_id == producto_id)
+    ).scalar() or 0
+    saldo_inicial = int(saldo)
+
+    filas = db.session.execute(
+        select(MovimientoInventario, Usuario.nombre)
+        .outerjoin(Usuario, Usuario.id == MovimientoInventario.usuario_id)
+        .where(MovimientoInventario.producto_id == producto_id,
+               MovimientoInventario.fecha >= inicio, MovimientoInventario.fecha < fin)
+        .order_by(MovimientoInventario.fecha, MovimientoInventario.id)
+    ).all()
+
+    movimientos = []
+    for movimiento, usuario in filas:
+        saldo += movimiento.delta
+        movimientos.append({
+            'fecha': pytz.utc.localize(movimiento.fecha).astimezone(TIMEZONE_CO).strftime('%Y-%m-%d %H:%M'),
+            'motivo': movimiento.motivo,
+            'referencia': movimiento.referencia,
+            'usuario': usuario,
+            'delta': movimiento.delta,
+            'saldo': int(saldo)
+        })
+
+    return jsonify({
+        'producto_id': producto_id,
+        'desde': desde.isoformat(),
+        'hasta': hasta.isoformat(),
+        'saldo_inicial': saldo_inicial,
+        'saldo_final': int(saldo),
+        'movimientos': movimientos
+    })
+
+
+@app.route('/api/inventario/saldos')
+@login_required
+def api_saldos_inventario():
+    """Stock de cada producto y valuación a costo al cierre de la fecha comercial ?fecha= (por defecto, ayer)."""
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+    try:
+        hoy, _, _ = obtener_rango_turno_colombia()
+        fecha = _fecha_parametro('fecha') or hoy - timedelta(days=1)
+    except ValueError:
+        return jsonify({'error': 'Fecha inválida. Use el formato AAAA-MM-DD.'}), 400
+
+    _, cierre = rango_utc_fecha_comercial(fecha)
+    saldos = consulta_saldos_en(cierre)
+    filas = db.session.execute(
+        select(Producto.id, Producto.codigo, Producto.nombre, saldos.c.cantidad, Producto.valor_interno)
+        .join(saldos, saldos.c.producto_id == Producto.id)
+        .order_by(Producto.nombre)
+    ).all()
+    unidades, valor = valor_inventario_en(cierre)
+
+    return jsonify({
+        'fecha': fecha.isoformat(),
+        'unidades': unidades,
+        'valor_interno': valor,
+        'productos': [
+            {'id': pid, 'codigo': codigo, 'nombre': nombre, 'cantidad': int(cantidad or 0),
+             'valor_interno': float((cantidad or 0) * (costo or 0))}
+            for pid, codigo, nombre, cantidad, costo in filas
+        ]
+    })
+
+# -------------------- REPOSICIÓN (LISTA DE COMPRAS) --------------------
+@app.route('/inventario/reposicion')
+@login_required
+def vista_reposicion():
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado.', 'danger')
+        return redirect(url_for('inventario'))
+
+    parametros = parametros_reposicion()
+    try:
+        sugerencias = sugerencias_reposicion(**parametros)
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al calcular la reposición: {e}', 'danger')
+        return redirect(url_for('inventario'))
+
+    marcas = [
+        {
+            'marca': marca,
+            'productos': json.loads(grupo.to_json(orient='records')),
+            'unidades': int(grupo['sugerido'].sum()),
+            'costo': float(grupo['costo_estimado'].sum()),
+        }
+        for marca, grupo in sugerencias.groupby('marca', sort=True)
+    ]
+    return render_template('reposicion.html', marcas=marcas, parametros=parametros,
+                           total_unidades=int(sugerencias['sugerido'].sum()),
+                           total_costo=float(sugerencias['costo_estimado'].sum()))
+
+
+@app.route('/inventario/reposicion/exportar')
+@login_required
+def exportar_reposicion():
+    """Lista de compras en Excel, agrupada por marca."""
+    if current_user.rol.lower() != 'administrador':
+        abort(403)
+    sugerencias = sugerencias_reposicion(**parametros_reposicion())
+    columnas = ['marca', 'codigo', 'nombre', 'stock', 'venta_diaria', 'dias_de_stock', 'punto_reorden',
+                'sugerido', 'valor_interno', 'costo_estimado']
+    archivo = BytesIO()
+    sugerencias[columnas].round({'venta_diaria': 2}).to_excel(archivo, sheet_name='Reposición', index=False)
+    archivo.seek(0)
+    hoy, _, _ = obtener_rango_turno_colombia()
+    return send_file(archivo, as_attachment=True, download_name=f'reposicion_{hoy.isoformat()}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+
+@app.route('/inventario/reposicion/stock_minimo', methods=['POST'])
+@login_required
+def actualizar_stock_minimo_reposicion():
+    """Guarda el punto de reorden calculado como stock_minimo de cada producto con ventas (un UPDATE en lote)."""
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado.', 'danger')
+        return redirect(url_for('inventario'))
+
+    parametros = parametros_reposicion()  # vienen en la URL del formulario, igual que en la vista
+    try:
+        productos = sugerencias_reposicion(**parametros, solo_pedir=False)
+        cambios = productos[productos['punto_reorden'] != productos['stock_minimo']]
+        if not cambios.empty:
+            version = version_catalogo()
+            db.session.execute(update(Producto), [
+                {'id': int(pid), 'stock_minimo': int(punto), 'version': version}
+                for pid, punto in zip(cambios['id'], cambios['punto_reorden'])
+            ])
+        db.session.commit()
+        flash(f'Stock mínimo actualizado en {len(cambios)} productos según su velocidad de venta.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al actualizar el stock mínimo: {e}', 'danger')
+    return redirect(url_for('vista_reposicion', **parametros))
+
+# -------------------- CONTEO FÍSICO DE INVENTARIO --------------------
+MAX_LECTURAS_ENVIO_CONTEO = 10000
+LOTE_UPSERT_CONTEO = 1000  # filas por sentencia; acota los parámetros enlazados
+
+
+def consulta_diferencias_conteo(conteo):
+    """
+    Una sola consulta con las diferencias entre lo contado y Producto.cantidad.
+    En un conteo completo, los productos activos que no se contaron figuran con 0 contado.
+    """
+    linea = ConteoInventarioLinea
+    sistema = func.coalesce(Producto.cantidad, 0)
+    contado = func.coalesce(linea.cantidad, 0)
+    consulta = (
+        select(Producto.id, Producto.codigo, Producto.nombre, Producto.marca, Producto.valor_interno,
+               sistema.label('sistema'), contado.label('contado'), linea.producto_id.label('contado_id'))
+        .select_from(Producto)
+        .outerjoin(linea, and_(linea.producto_id == Producto.id, linea.conteo_id == conteo.id))
+        .where(contado != sistema)
+        .order_by(Producto.nombre)
+    )
+    if conteo.completo:
+        return consulta.where(or_(Producto.activo.is_(True), linea.producto_id.isnot(None)))
+    return consulta.where(linea.producto_id.isnot(None))
+
+
+def resumen_diferencias(filas):
+    """Totales del reporte de diferencias (sobrantes, faltantes y su valor a costo interno)."""
+    sobrantes = sum(f.contado - f.sistema for f in filas if f.contado > f.sistema)
+    faltantes = sum(f.sistema - f.contado for f in filas if f.contado < f.sistema)
+    valor = sum((f.contado - f.sistema) * (f.valor_interno or 0) for f in filas)
+    return {
+        'productos_con_diferencia': len(filas),
+        'unidades_sobrantes': sobrantes,
+        'unidades_faltantes': faltantes,
+        'valor_diferencia': float(valor),
+    }
+
+
+@app.route('/inventario/conteos')
+@login_required
+def vista_conteos():
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado. Solo administradores pueden hacer conteos de inventario.', 'danger')
+        return redirect(url_for('inventario'))
+
+    conteos = ConteoInventario.query.order_by(ConteoInventario.id.desc()).limit(50).all()
+    lineas = dict(
+        db.session.query(ConteoInventarioLinea.conteo_id, func.count())
+        .filter(ConteoInventarioLinea.conteo_id.in_([c.id for c in conteos]))
+        .group_by(ConteoInventarioLinea.conteo_id).all()
+    ) if conteos else {}
+    return render_template('conteos_inventario.html', conteos=conteos, lineas=lineas)
+
+
+@app.route('/inventario/conteos/nuevo', methods=['POST'])
+@login_required
+def crear_conteo():
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado. Solo administradores pueden hacer conteos de inventario.', 'danger')
+        return redirect(url_for('inventario'))
+
+    try:
+        conteo = ConteoInventario(
+            usuario_id=current_user.id,
+            completo=request.form.get('completo') == '1',
+            nota=(request.form.get('nota') or '').strip()[:200] or None
+        )
+        db.session.add(conteo)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al crear el conteo: {e}', 'danger')
+        return redirect(url_for('vista_conteos'))
+    return redirect(url_for('vista_conteo', conteo_id=conteo.id))
+
+
+@app.route('/inventario/conteos/<int:conteo_id>')
+@login_required
+def vista_conteo(conteo_id):
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado. Solo administradores pueden hacer conteos de inventario.', 'danger')
+        return redirect(url_for('inventario'))
+
+    # El reporte de diferencias lo pide la página a api_diferencias_conteo (se refresca tras cada envío)
+    conteo = ConteoInventario.query.get_or_404(conteo_id)
+    return render_template('conteo_inventario.html', conteo=conteo)
+
+
+@app.route('/api/inventario/conteos/<int:conteo_id>/lecturas', methods=['POST'])
+@login_required
+def api_lecturas_conteo(conteo_id):
+    """
+    Recibe un lote de lecturas del escáner (acumuladas en el navegador) y las suma al conteo.
+    Cuerpo JSON: {"id_envio": "<uuid>", "modo": "sumar" | "reemplazar", "items": [{"codigo", "cantidad"}]}.
+    Con "reemplazar" la cantidad enviada sustituye a la contada (para corregir un producto).
+    """
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+
+    conteo = db.session.get(ConteoInventario, conteo_id)
+    if not conteo:
+        return jsonify({'error': 'Conteo no encontrado.'}), 404
+    if conteo.estado != 'abierto':
+        return jsonify({'error': f'El conteo ya está {conteo.estado}.'}), 409
+
+    datos = request.get_json(silent=True) or {}
+    id_envio = str(datos.get('id_envio') or '').strip()
+    modo = datos.get('modo') or 'sumar'
+    items = datos.get('items')
+    if not id_envio or len(id_envio) > 36:
+        return jsonify({'error': 'Falta el identificador del envío (id_envio).'}), 400
+    if modo not in ('sumar', 'reemplazar'):
+        return jsonify({'error': 'Modo no válido.'}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'No hay lecturas para registrar.'}), 400
+    if len(items) > MAX_LECTURAS_ENVIO_CONTEO:
+        return jsonify({'error': f'Máximo {MAX_LECTURAS_ENVIO_CONTEO} lecturas por envío.'}), 400
+    if db.session.get(ConteoInventarioEnvio, (conteo.id, id_envio)):
+        return jsonify({'error': 'Este envío ya fue registrado.'}), 409
+
+    contado, invalidos = agrupar_items_escaneados(items, permitir_cero=(modo == 'reemplazar'))
+    encontrados = ids_por_codigo(contado)
+    desconocidos = [{'codigo': c, 'cantidad': q} for c, q in contado.items() if c not in encontrados]
+    filas = [
+        {'conteo_id': conteo.id, 'producto_id': encontrados[c], 'cantidad': q}
+        for c, q in contado.items() if c in encontrados
+    ]
+
+    try:
+        db.session.add(ConteoInventarioEnvio(conteo_id=conteo.id, id_envio=id_envio))
+        dialecto = db.session.get_bind().dialect.name
+        upsert = postgresql.insert if dialecto == 'postgresql' else sqlite.insert
+        for inicio in range(0, len(filas), LOTE_UPSERT_CONTEO):
+            stmt = upsert(ConteoInventarioLinea).values(filas[inicio:inicio + LOTE_UPSERT_CONTEO])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['conteo_id', 'producto_id'],
+                set_={'cantidad': stmt.excluded.cantidad if modo == 'reemplazar'
+                      else ConteoInventarioLinea.cantidad + stmt.excluded.cantidad}
+            )
+            db.session.execute(stmt)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'Este envío ya fue registrado.'}), 409
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'Error al registrar las lecturas: {e}'}), 500
+
+    return jsonify({'registrados': len(filas), 'desconocidos': desconocidos, 'invalidos': invalidos})
+
+
+@app.route('/api/inventario/conteos/<int:conteo_id>/diferencias')
+@login_required
+def api_diferencias_conteo(conteo_id):
+    """Reporte de diferencias del conteo contra el stock actual (JSON)."""
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+    conteo = db.session.get(ConteoInventario, conteo_id)
+    if not conteo:
+        return jsonify({'error': 'Conteo no encontrado.'}), 404
+
+    filas = db.session.execute(consulta_diferencias_conteo(conteo)).all()
+    contados = db.session.query(func.count(), func.coalesce(func.sum(ConteoInventarioLinea.cantidad), 0)).filter(
+        ConteoInventarioLinea.conteo_id == conteo.id
+    ).one()
+    return jsonify({
+        'conteo_id': conteo.id,
+        'estado': conteo.estado,
+        'productos_contados': int(contados[0]),
+        'unidades_contadas': int(contados[1]),
+        'resumen': resumen_diferencias(filas),
+        'diferencias': [{
+            'id': f.id, 'codigo': f.codigo, 'nombre': f.nombre, 'marca': f.marca,
+            'sistema': int(f.sistema), 'contado': int(f.contado), 'diferencia': int(f.contado - f.sistema),
+            'contado_en_sesion': f.contado_id is not None
+        } for f in filas]
+    })
+
+
+@app.route('/inventario/conteos/<int:conteo_id>/aplicar', methods=['POST'])
+@login_required
+def aplicar_conteo(conteo_id):
+    """Ajusta el stock de todos los productos con diferencia en una sola transacción."""
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado. Solo administradores pueden hacer conteos de inventario.', 'danger')
+        return redirect(url_for('inventario'))
+
+    try:
+        # Cierre condicional: dos clics (o dos pestañas) no aplican el mismo conteo dos veces
+        cerrado = db.session.execute(
+            update(ConteoInventario)
+            .where(ConteoInventario.id == conteo_id, ConteoInventario.estado == 'abierto')
+            .values(estado='aplicado', cerrado=datetime.utcnow())
+        )
+        if cerrado.rowcount != 1:
+            db.session.rollback()
+            flash('El conteo no existe o ya fue cerrado.', 'warning')
+            return redirect(url_for('vista_conteos'))
+        conteo = db.session.get(ConteoInventario, conteo_id)
+
+        # Las filas de producto quedan bloqueadas: una venta simultánea espera al ajuste
+        filas = db.session.execute(consulta_diferencias_conteo(conteo).with_for_update(of=Producto)).all()
+        deltas = {f.id: int(f.contado - f.sistema) for f in filas}
+        if filas:
+            version = version_catalogo()
+            db.session.execute(update(Producto), [
+                {'id': f.id, 'cantidad': int(f.contado), 'version': version} for f in filas
+            ])
+            registrar_movimientos(deltas, 'conteo', f'Conteo #{conteo.id}')
+        conteo.productos_ajustados = len(deltas)
+        conteo.unidades_ajustadas = sum(deltas.values())
+        db.session.commit()
+        flash(f'Conteo aplicado: {len(deltas)} productos ajustados '
+              f'({conteo.unidades_ajustadas:+d} unidades).', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al aplicar el conteo: {e}', 'danger')
+    return redirect(url_for('vista_conteo', conteo_id=conteo_id))
+
+
+@app.route('/inventario/conteos/<int:conteo_id>/cancelar', methods=['POST'])
+@login_required
+def cancelar_conteo(conteo_id):
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado. Solo administradores pueden hacer conteos de inventario.', 'danger')
+        return redirect(url_for('inventario'))
+
+    conteo = ConteoInventario.query.get_or_404(conteo_id)
+    if conteo.estado != 'abierto':
+        flash('El conteo ya fue cerrado.', 'warning')
+        return redirect(url_for('vista_conteos'))
+    try:
+        conteo.estado = 'cancelado'
+        conteo.cerrado = datetime.utcnow()
+        db.session.commit()
+        flash(f'Conteo #{conteo.id} cancelado; el stock no se modificó.', 'info')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al cancelar el conteo: {e}', 'danger')
+    return redirect(url_for('vista_conteos'))
+
 # -------------------- GENERAR BARRA POR ID --------------------
+# Las imágenes se cachean en memoria (LRU) y en disco (ver codigos_barras.py)
+configurar_cache_disco(os.path.join(app.instance_path, 'barcodes'))
+
+
 @app.route('/barcode/<int:producto_id>')
 @login_required
 def generar_barcode_api(producto_id):
+    """Datos de la etiqueta; la imagen se pide aparte a `imagen_barcode` (cacheable por el navegador)."""
+    producto = db.session.get(Producto, producto_id)
+    if not producto:
+        return jsonify({"error": "Producto no encontrado"}), 404
+
+    codigo = producto.codigo or str(producto.id)
+    return jsonify({
+        "id": producto.id,
+        "nombre": producto.nombre,
+        "marca": producto.marca or "Sin marca",
+        "codigo": codigo,
+        "precio": producto.valor_venta,
+        "imagen_png": url_for('imagen_barcode', formato='png', codigo=codigo),
+        "imagen_svg": url_for('imagen_barcode', formato='svg', codigo=codigo)
+    })
+
+
+@app.route('/barcode/imagen/<formato>/<path:codigo>')
+@login_required
+def imagen_barcode(formato, codigo):
+    """Imagen Code128 en PNG o SVG, con ETag para que las vistas repetidas respondan 304."""
+    if formato not in FORMATOS_BARCODE:
+        abort(404)
     try:
-        producto = Producto.query.get(producto_id)
-        if not producto:
-            return jsonify({"error": "Producto no encontrado"}), 404
+        datos, clave = obtener_barcode(codigo, formato)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        codigo = producto.codigo or str(producto.id)
+    etag = f'barcode-{clave}'
+    if request.if_none_match.contains(etag):
+        respuesta = app.response_class(status=304)
+    else:
+        respuesta = app.response_class(datos, mimetype=FORMATOS_BARCODE[formato])
+    respuesta.set_etag(etag)
+    # La imagen depende solo del código: el navegador puede reutilizarla sin preguntar por un día
+    respuesta.headers['Cache-Control'] = 'private, max-age=86400'
+    return respuesta
 
-        # Generar código de barras
-        code128 = barcode.get_barcode_class('code128')
-        instance = code128(codigo, writer=ImageWriter())
 
-        buffer = BytesIO()
-        instance.write(buffer)
-        img64 = base64.b64encode(buffer.getvalue()).decode()
+# -------------------- ETIQUETAS EN LOTE (PDF) --------------------
+MAX_ETIQUETAS_PDF = 5000
+MAX_COPIAS_ETIQUETA = 100
+_pool_etiquetas = None
+_pool_etiquetas_lock = threading.Lock()
 
-        return jsonify({
-            "id": producto.id,
-            "nombre": producto.nombre,
-            "marca": producto.marca or "Sin marca",
-            "codigo": codigo,
-            "precio": producto.valor_venta,
-            "barcode": img64
-        })
 
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+def pool_etiquetas():
+    """
+    Pool de procesos (creado una vez por worker) para dibujar los códigos que no están en caché.
+    Usa 'spawn': los hijos no heredan conexiones ni locks del padre. Con `python app.py` re-ejecutan
+    este archivo como __mp_main__, pero la inicialización de la base de datos queda fuera (ver el final
+    del archivo); con gunicorn solo importan codigos_barras.
+    """
+    global _pool_etiquetas
+    with _pool_etiquetas_lock:
+        if _pool_etiquetas is None:
+            _pool_etiquetas = ProcessPoolExecutor(
+                max_workers=min(4, os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _pool_etiquetas
+
+
+def descartar_pool_etiquetas():
+    """Olvida un pool roto (p. ej. un hijo murió); el siguiente uso crea uno nuevo."""
+    global _pool_etiquetas
+    with _pool_etiquetas_lock:
+        _pool_etiquetas = None
+
+
+def _ids_desde_parametros(valores):
+    """Acepta ids repetidos (?ids=1&ids=2) o separados por comas (?ids=1,2)."""
+    ids = []
+    for valor in valores:
+        ids.extend(int(parte) for parte in valor.split(',') if parte.strip().isdigit())
+    return ids
+
+
+@app.route('/etiquetas/pdf', methods=['GET', 'POST'])
+@login_required
+def etiquetas_pdf():
+    """
+    Hoja de etiquetas con código de barras para muchos productos a la vez.
+    Selección: ids (lista), marca, stock_bajo=1, importacion=<id de trabajo>|ultima.
+    Cantidad: copias=N por producto, o por_stock=1 para una etiqueta por unidad en existencia.
+    """
+    parametros = request.values
+    query = Producto.query.filter(Producto.activo.is_(True))
+    filtrado = False
+
+    ids = _ids_desde_parametros(parametros.getlist('ids'))
+    if ids:
+        query = query.filter(Producto.id.in_(ids))
+        filtrado = True
+
+    marca = parametros.get('marca', '').strip()
+    if marca:
+        query = query.filter(func.lower(Producto.marca) == marca.lower())
+        filtrado = True
+
+    if parametros.get('stock_bajo', type=int):
+        query = query.filter(Producto.cantidad <= Producto.stock_minimo)
+        filtrado = True
+
+    importacion = parametros.get('importacion', '').strip()
+    if importacion:
+        trabajos = TrabajoImportacion.query.filter(TrabajoImportacion.estado == 'completado')
+        if importacion == 'ultima':
+            trabajo = trabajos.order_by(TrabajoImportacion.fin.desc()).first()
+        else:
+            trabajo = trabajos.filter(TrabajoImportacion.id == importacion).first()
+        if not trabajo or trabajo.version_final is None:
+            flash('No se encontró una importación completada para imprimir sus etiquetas.', 'danger')
+            return redirect(url_for('inventario'))
+        query = query.filter(Producto.version > trabajo.version_inicial,
+                             Producto.version <= trabajo.version_final)
+        filtrado = True
+
+    if not filtrado:
+        flash('Seleccione productos o un filtro (marca, stock bajo o importación) para las etiquetas.', 'danger')
+        return redirect(url_for('inventario'))
+
+    copias = min(max(parametros.get('copias', 1, type=int) or 1, 1), MAX_COPIAS_ETIQUETA)
+    por_stock = bool(parametros.get('por_stock', type=int))
+
+    productos = query.order_by(Producto.marca, Producto.nombre).with_entities(
+        Producto.id, Producto.codigo, Producto.nombre, Producto.valor_venta, Producto.cantidad
+    ).all()
+    etiquetas = []
+    for p in productos:
+        repeticiones = min(max(p.cantidad or 0, 0), MAX_COPIAS_ETIQUETA) if por_stock else copias
+        etiquetas.extend([{'codigo': p.codigo or str(p.id), 'nombre': p.nombre, 'precio': p.valor_venta}] * repeticiones)
+
+    if not etiquetas:
+        flash('No hay productos (o existencias) que coincidan con la selección.', 'warning')
+        return redirect(url_for('inventario'))
+    if len(etiquetas) > MAX_ETIQUETAS_PDF:
+        flash(f'Demasiadas etiquetas ({len(etiquetas)}). El máximo por hoja es {MAX_ETIQUETAS_PDF}; refine el filtro.', 'danger')
+        return redirect(url_for('inventario'))
+
+    codigos = [e['codigo'] for e in etiquetas]
+    try:
+        imagenes = obtener_barcodes(codigos, pool=pool_etiquetas())
+    except BrokenProcessPool:
+        # Un proceso del pool murió: se descarta el pool y se dibuja en este proceso
+        descartar_pool_etiquetas()
+        imagenes = obtener_barcodes(codigos)
+
+    # El PDF se escribe en un archivo temporal (en memoria si es pequeño) y se envía por partes
+    salida = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    generar_pdf_etiquetas(etiquetas, imagenes, salida)
+    salida.seek(0)
+    return send_file(salida, mimetype='application/pdf', as_attachment=False,
+                     download_name=f'etiquetas_{len(etiquetas)}.pdf')
 
 
 # -------------------- RUTAS VENTAS --------------------
 @app.route('/ventas/nueva', methods=['GET', 'POST'])
 @login_required
 def nueva_venta():
-    productos = Producto.query.filter(Producto.cantidad > 0).all()
-    clientes = Cliente.query.all()
-
     if request.method == 'GET':
-        return render_template('nueva_venta.html', productos=productos, clientes=clientes)
+        # Productos y clientes se consultan bajo demanda desde la página (APIs de catálogo)
+        cliente_generico = db.session.get(Cliente, 1)
+        return render_template('nueva_venta.html', cliente_generico=cliente_generico)
 
     if request.method == 'POST':
         try:
@@ -662,6 +2809,13 @@ def nueva_venta():
             db.session.add(nueva_venta)
             db.session.flush()
 
+            try:
+                referencias_pago = json.loads(request.form.get('referencias_pago_json') or '{}')
+            except ValueError:
+                referencias_pago = {}
+            filas_pago = registrar_pagos_venta(nueva_venta, detalle_pago_dict, referencias_pago, reemplazar=False)
+            acumular_resumen(aportes_resumen(nueva_venta, filas_pago))
+
             productos_vendidos_json = request.form.get('productos_vendidos_json', '[]')
             productos_vendidos = json.loads(productos_vendidos_json)
             
@@ -669,6 +2823,7 @@ def nueva_venta():
                 raise Exception("No se especificaron productos para la venta.")
 
             # --- Proceso de Detalle y Stock ---
+            lineas = []
             for item in productos_vendidos:
                 item_id = int(item.get('id', 0))
                 cantidad_vendida = int(item.get('cantidad', 0))
@@ -677,30 +2832,53 @@ def nueva_venta():
                 
                 if cantidad_vendida <= 0 or precio_unitario < 0:
                     continue 
-                
-                producto = db.session.get(Producto, item_id)
-                
+                lineas.append((item_id, cantidad_vendida, precio_unitario, subtotal))
+
+            # Una sola consulta para todo el carrito, con las filas bloqueadas en orden de ID
+            productos_carrito = bloquear_productos(item_id for item_id, *_ in lineas)
+
+            solicitado = defaultdict(int)
+            for item_id, cantidad_vendida, _, _ in lineas:
+                solicitado[item_id] += cantidad_vendida
+
+            # Un mensaje por producto (con el total pedido), aunque venga en varias líneas
+            errores = []
+            for item_id, total_pedido in solicitado.items():
+                producto = productos_carrito.get(item_id)
                 if not producto:
-                    raise Exception(f"Producto con ID {item_id} no encontrado.")
-                
-                if producto.cantidad < cantidad_vendida:
-                    # Esto debería ser prevenido por el JS, pero es la validación final
-                    raise Exception(f"Stock insuficiente para {producto.nombre}. Disponible: {producto.cantidad}, Solicitado: {cantidad_vendida}")
-                
-                detalle = VentaDetalle(
+                    errores.append(f"Producto con ID {item_id} no encontrado.")
+                elif not producto.activo:
+                    errores.append(f"{producto.nombre} está inactivo y no se puede vender.")
+                elif (producto.cantidad or 0) < total_pedido:
+                    errores.append(
+                        f"Stock insuficiente para {producto.nombre}. "
+                        f"Disponible: {producto.cantidad or 0}, Solicitado: {total_pedido}"
+                    )
+            if errores:
+                raise StockInsuficienteError(errores)
+
+            db.session.add_all([
+                VentaDetalle(
                     venta_id=nueva_venta.id,
                     producto_id=item_id,
                     cantidad=cantidad_vendida,
                     precio_unitario=precio_unitario,
                     subtotal=subtotal
                 )
-                db.session.add(detalle)
-                
-                producto.cantidad -= cantidad_vendida
+                for item_id, cantidad_vendida, precio_unitario, subtotal in lineas
+            ])
+
+            # Descuento en un solo UPDATE condicional (nunca deja stock negativo)
+            aplicar_deltas_stock({pid: -cant for pid, cant in solicitado.items()}, 'venta', f'Venta #{nueva_venta.id}')
             
             db.session.commit()
             flash('Venta registrada exitosamente!', 'success')
             return redirect(url_for('imprimir_comprobante', venta_id=nueva_venta.id))
+        except StockInsuficienteError as e:
+            db.session.rollback()
+            for error in e.errores:
+                flash(f'No se pudo registrar la venta. {error}', 'danger')
+            return redirect(url_for('nueva_venta'))
         except Exception as e:
             db.session.rollback()
             flash(f'Ocurrió un error al procesar la venta: {e}', 'danger')
@@ -725,20 +2903,12 @@ def imprimir_comprobante(venta_id):
             detalles_agrupados[pid]['precio_unitario'] = d.precio_unitario
     detalles_finales = list(detalles_agrupados.values())
 
-    pagos_normalizados = {}
-    try:
-        detalle_pago_dict = json.loads(venta.detalle_pago) if venta.detalle_pago else {}
-        ref_cod = detalle_pago_dict.get('Ref_Codigo', '')
-        ref_fecha = detalle_pago_dict.get('Ref_Fecha', '')
-
-        for k, v in detalle_pago_dict.items():
-            if k not in ['Ref_Codigo', 'Ref_Fecha', 'Efectivo_Recibido', 'Vuelto'] and (isinstance(v, (int, float)) and v > 0):
-                if k in ['Nequi', 'Transferencia', 'Daviplata', 'Tarjeta/Bold']:
-                    pagos_normalizados[k] = {'monto': v, 'cod': ref_cod, 'fecha': ref_fecha}
-                else:
-                    pagos_normalizados[k] = {'monto': v, 'cod': '', 'fecha': ''}
-    except Exception:
-        pagos_normalizados = {}
+    orden_metodos = {metodo: i for i, metodo in enumerate(METODOS_PAGO)}
+    pagos_normalizados = {
+        p.metodo: {'monto': p.monto, 'cod': p.referencia or ''}
+        for p in sorted(venta.pagos, key=lambda p: orden_metodos.get(p.metodo, len(orden_metodos)))
+        if p.monto > 0
+    }
 
     return render_template(
         'comprobante.html',
@@ -757,7 +2927,7 @@ def ejecutar_cierre_caja():
         return redirect(url_for('reportes'))
 
     if request.method == 'POST':
-        fecha_comercial, inicio_utc, fin_utc = obtener_rango_turno_colombia()
+        fecha_comercial, _, _ = obtener_rango_turno_colombia()
 
         cierre_existente = CierreCaja.query.filter_by(fecha_cierre=fecha_comercial).first()
         
@@ -766,40 +2936,18 @@ def ejecutar_cierre_caja():
             flash(f'La caja del día {fecha_comercial} ya fue cerrada. No puedes modificarla.', 'warning')
             return redirect(url_for('reportes'))
         
-        ventas_turno = Venta.query.filter(
-            and_(Venta.fecha >= inicio_utc, Venta.fecha <= fin_utc)
-        ).all()
-
-        total_venta = 0.0
-        total_efectivo = 0.0
-        detalle_metodos = defaultdict(float)
-        detalle_vendedor = defaultdict(lambda: {'total': 0.0, 'efectivo': 0.0})
-
-        for v in ventas_turno:
-            total_venta += v.total
-            try:
-                pagos = json.loads(v.detalle_pago)
-                # Cálculo de efectivo
-                efectivo_v = float(pagos.get('Efectivo', 0) or 0)
-                total_efectivo += efectivo_v
-                
-                # Desglose de todos los métodos
-                for metodo, monto in pagos.items():
-                    if metodo not in ['Ref_Codigo', 'Ref_Fecha', 'Efectivo_Recibido', 'Vuelto'] and isinstance(monto, (int, float)):
-                        detalle_metodos[metodo] += float(monto or 0)
-                
-                # Desglose por vendedor
-                v_user = v.vendedor.username if v.vendedor else "N/A"
-                detalle_vendedor[v_user]['total'] += v.total
-                detalle_vendedor[v_user]['efectivo'] += efectivo_v
-            except:
-                pass
+        # Dos GROUP BY (métodos y vendedores) sin importar cuántas ventas tuvo el turno
+        detalle_metodos = totales_por_metodo(fecha_comercial)
+        detalle_vendedor = totales_por_vendedor(fecha_comercial)
 
+        total_venta = sum(v['total'] for v in detalle_vendedor.values())
+        total_efectivo = detalle_metodos.get('Efectivo', 0.0)
         total_electronico = total_venta - total_efectivo
         
         snapshot = {
-            'metodos': dict(detalle_metodos),
-            'vendedores': dict(detalle_vendedor),
+            'metodos': detalle_metodos,
+            'vendedores': detalle_vendedor,
+            'num_ventas': sum(v['ventas'] for v in detalle_vendedor.values()),
             'hora_cierre_real': obtener_hora_colombia().strftime('%I:%M %p')
         }
 
@@ -813,7 +2961,7 @@ def ejecutar_cierre_caja():
                 cierre.detalles_json = json.dumps(snapshot)
                 cierre.hora_ejecucion = datetime.utcnow() 
             else:
-                nuevo = CierreCaja(
+                cierre = CierreCaja(
                     fecha_cierre=fecha_comercial,
                     hora_ejecucion=datetime.utcnow(), 
                     usuario_id=current_user.id,
@@ -822,7 +2970,9 @@ def ejecutar_cierre_caja():
                     total_electronico=total_electronico,
                     detalles_json=json.dumps(snapshot)
                 )
-                db.session.add(nuevo)
+                db.session.add(cierre)
+            db.session.flush()
+            guardar_detalle_cierre(cierre.id, detalle_metodos, detalle_vendedor)
 
             db.session.commit()
             flash(f'✅ Cierre de Caja registrado ({fecha_comercial}). Total: ${total_venta:,.0f}', 'success')
@@ -842,50 +2992,66 @@ def historial_cierres():
         flash('Permiso denegado.', 'danger')
         return redirect(url_for('dashboard'))
         
-    cierres = CierreCaja.query.order_by(CierreCaja.fecha_cierre.desc()).all()
-    return render_template('historial_cierres.html', cierres=cierres)
+    despues = request.args.get('despues', type=int)
+    antes = request.args.get('antes', type=int)
+    try:
+        desde, hasta = _fecha_parametro('desde'), _fecha_parametro('hasta')
+    except ValueError:
+        flash('Fechas inválidas: usa el formato AAAA-MM-DD.', 'warning')
+        desde = hasta = None
+
+    # Cierres de la página con su usuario y su detalle en 3 consultas, sin leer detalles_json
+    query = CierreCaja.query.options(
+        joinedload(CierreCaja.usuario),
+        selectinload(CierreCaja.metodos),
+        selectinload(CierreCaja.vendedores)
+    ).filter(*filtro_rango_cierres(desde, hasta))
+    # Un cierre por fecha comercial y siempre del día en curso: el orden por ID es el orden por fecha
+    cierres = paginar_keyset(query, CierreCaja.id, POR_PAGINA_CIERRES, despues=despues, antes=antes)
+
+    return render_template('historial_cierres.html',
+                           cierres=cierres,
+                           resumen=resumen_cierres(desde, hasta),
+                           metodos_pago=METODOS_PAGO,
+                           desde=desde.isoformat() if desde else '',
+                           hasta=hasta.isoformat() if hasta else '')
 
 @app.route('/reportes')
 @login_required
 def reportes():
     if current_user.rol.lower() != 'administrador':
         flash('Permiso denegado.', 'danger')
-        return redirect(url_for('dashboard'))
-
-    fecha_comercial, inicio_utc, fin_utc = obtener_rango_turno_colombia()
-    
-    ventas_hoy = Venta.query.filter(and_(Venta.fecha >= inicio_utc, Venta.fecha <= fin_utc)).all()
-    total_diario = sum(v.total for v in ventas_hoy)
+        return redirect(url_for('dashboard'))
 
-    desglose_temp = defaultdict(float)
+    fecha_comercial, _, _ = obtener_rango_turno_colombia()
     
-    for v in ventas_hoy:
-        try:
-            pagos = json.loads(v.detalle_pago)
-            for metodo, valor in pagos.items():
-                if metodo not in ['Ref_Codigo', 'Ref_Fecha', 'change', 'Efectivo_Recibido', 'Vuelto'] and isinstance(valor, (int, float)):
-                    desglose_temp[metodo] += float(valor or 0)
-        except:
-            pass
+    filas_hoy = db.session.query(ResumenVentas.metodo, func.sum(ResumenVentas.monto)).filter(
+        ResumenVentas.fecha_comercial == fecha_comercial
+    ).group_by(ResumenVentas.metodo).all()
+    totales_hoy = {metodo: float(total or 0) for metodo, total in filas_hoy}
+    total_diario = totales_hoy.pop(RESUMEN_TOTAL, 0.0)
+
+    orden_metodos = {metodo: i for i, metodo in enumerate(METODOS_PAGO)}
+    desglose_temp = dict(sorted(totales_hoy.items(), key=lambda kv: orden_metodos.get(kv[0], len(orden_metodos))))
     
     informe_diario_list = []
     for metodo, total in desglose_temp.items():
         informe_diario_list.append(("General", metodo, total))
 
-    inicio_mes = datetime.utcnow().replace(day=1, hour=0, minute=0, second=0)
-    total_mensual = db.session.query(func.sum(Venta.total)).filter(Venta.fecha >= inicio_mes).scalar() or 0
+    # Semana (lunes) y mes según la fecha comercial, no la fecha UTC
+    inicio_mes = fecha_comercial.replace(day=1)
+    total_mensual = total_vendido_resumen(inicio_mes, fecha_comercial)
     
-    # Asegurando el inicio de semana (Lunes)
-    inicio_semana_utc = datetime.utcnow() - timedelta(days=datetime.utcnow().weekday())
-    inicio_semana_utc = inicio_semana_utc.replace(hour=0, minute=0, second=0, microsecond=0)
-    total_semanal = db.session.query(func.sum(Venta.total)).filter(Venta.fecha >= inicio_semana_utc).scalar() or 0
+    inicio_semana = fecha_comercial - timedelta(days=fecha_comercial.weekday())
+    total_semanal = total_vendido_resumen(inicio_semana, fecha_comercial)
 
     datos_vendedores_query = db.session.query(
-        Usuario.username, 
-        func.sum(Venta.total)
-    ).join(Venta).filter(
-        and_(Venta.fecha >= inicio_utc, Venta.fecha <= fin_utc)
-    ).group_by(Usuario.username).order_by(func.sum(Venta.total).desc()).all()
+        func.coalesce(Usuario.username, 'N/A'),
+        func.sum(ResumenVentas.monto)
+    ).outerjoin(Usuario, Usuario.id == ResumenVentas.usuario_id).filter(
+        ResumenVentas.fecha_comercial == fecha_comercial,
+        ResumenVentas.metodo == RESUMEN_TOTAL
+    ).group_by(Usuario.username).order_by(func.sum(ResumenVentas.monto).desc()).all()
 
     labels_vendedores = [row[0] for row in datos_vendedores_query]
     data_vendedores = [float(row[1]) for row in datos_vendedores_query]
@@ -899,9 +3065,11 @@ def reportes():
         "data": data_vendedores
     }
 
+    # Últimos 30 días comerciales; la página cambia de granularidad con api_series_ventas
+    tendencia = serie_ventas(fecha_comercial - timedelta(days=29), fecha_comercial)
     datos_tendencia = {
-        "labels": ["Semana Pasada", "Hoy"], 
-        "data": [0, total_diario] 
+        "labels": tendencia['labels'],
+        "data": tendencia['series'][0]['data']
     }
 
     caja_cerrada_hoy = CierreCaja.query.filter_by(fecha_cierre=fecha_comercial).first() is not None
@@ -918,6 +3086,109 @@ def reportes():
         datos_vendedores=datos_vendedores
     )
 
+@app.route('/api/reportes/series')
+@login_required
+def api_series_ventas():
+    """
+    Serie de ventas para gráficos: ?granularidad=dia|semana|mes|hora&desde=&hasta=&desglose=metodo|vendedor.
+    Sin fechas: 30 días, 12 semanas o 12 meses hasta hoy según la granularidad.
+    """
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+
+    granularidad = request.args.get('granularidad', 'dia')
+    desglose = request.args.get('desglose') or None
+    if granularidad not in GRANULARIDADES_SERIE:
+        return jsonify({'error': 'Granularidad no válida.'}), 400
+    if desglose and (desglose not in DESGLOSES_SERIE or granularidad == 'hora'):
+        return jsonify({'error': 'Desglose no válido para esta granularidad.'}), 400
+
+    try:
+        hoy, _, _ = obtener_rango_turno_colombia()
+        hasta = _fecha_parametro('hasta') or hoy
+        desde = _fecha_parametro('desde')
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas. Use el formato AAAA-MM-DD.'}), 400
+    if desde is None:
+        if granularidad == 'mes':
+            desde = restar_meses(hasta, 11)
+        elif granularidad == 'semana':
+            desde = inicio_periodo(hasta, 'semana') - timedelta(weeks=11)
+        else:
+            desde = hasta - timedelta(days=29)
+    if desde > hasta:
+        return jsonify({'error': 'La fecha inicial no puede ser posterior a la final.'}), 400
+    if (hasta - desde).days > MAX_DIAS_SERIE:
+        return jsonify({'error': f'El rango máximo es de {MAX_DIAS_SERIE} días.'}), 400
+
+    return jsonify(serie_ventas(desde, hasta, granularidad, desglose))
+
+@app.route('/reportes/productos')
+@login_required
+def reportes_productos():
+    if current_user.rol.lower() != 'administrador':
+        flash('Permiso denegado.', 'danger')
+        return redirect(url_for('dashboard'))
+
+    try:
+        desde, hasta = rango_analitica_desde_parametros()
+    except ValueError as e:
+        flash(f'Fechas inválidas: {e}', 'danger')
+        return redirect(url_for('reportes_productos'))
+
+    try:
+        resumen = resumen_analitica(*analitica_productos(desde, hasta))
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error al calcular el análisis de productos: {e}', 'danger')
+        return redirect(url_for('reportes'))
+    return render_template('reportes_productos.html', desde=desde, hasta=hasta, analisis=resumen)
+
+
+@app.route('/api/reportes/productos')
+@login_required
+def api_reportes_productos():
+    """Análisis por producto y marca en JSON (?desde=&hasta=&top=)."""
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+    try:
+        desde, hasta = rango_analitica_desde_parametros()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    top = min(max(request.args.get('top', TOP_ANALITICA, type=int), 1), 500)
+    resumen = resumen_analitica(*analitica_productos(desde, hasta), top=top)
+    return jsonify({'desde': desde.isoformat(), 'hasta': hasta.isoformat(), **resumen})
+
+
+@app.route('/reportes/productos/exportar')
+@login_required
+def exportar_reportes_productos():
+    """Descarga el análisis completo en Excel: una hoja por producto, otra por marca y el stock sin movimiento."""
+    if current_user.rol.lower() != 'administrador':
+        abort(403)
+    try:
+        desde, hasta = rango_analitica_desde_parametros()
+    except ValueError as e:
+        flash(f'Fechas inválidas: {e}', 'danger')
+        return redirect(url_for('reportes_productos'))
+
+    productos, marcas = analitica_productos(desde, hasta)
+    columnas = ['codigo', 'nombre', 'marca', 'clase_abc', 'unidades', 'num_ventas', 'ingresos', 'costo',
+                'margen', 'margen_pct', 'stock', 'valor_interno', 'valor_stock']
+    sin_movimiento = productos[(productos['unidades'] == 0) & (productos['stock'] > 0)]
+
+    archivo = BytesIO()
+    with pd.ExcelWriter(archivo, engine='openpyxl') as escritor:
+        productos[columnas].to_excel(escritor, sheet_name='Productos', index=False)
+        marcas.to_excel(escritor, sheet_name='Marcas', index=False)
+        sin_movimiento.sort_values('valor_stock', ascending=False)[columnas].to_excel(
+            escritor, sheet_name='Sin movimiento', index=False
+        )
+    archivo.seek(0)
+    return send_file(archivo, as_attachment=True,
+                     download_name=f'analisis_productos_{desde.isoformat()}_{hasta.isoformat()}.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
 # -------------------- RUTAS USUARIOS --------------------
 @app.route('/usuarios')
 @login_required
@@ -1014,41 +3285,69 @@ def gestion_ventas():
         flash('Permiso denegado.', 'danger')
         return redirect(url_for('clientes'))
     
-    page = request.args.get('page', 1, type=int)
+    despues = request.args.get('despues', type=int)
+    antes = request.args.get('antes', type=int)
     per_page = 50
 
     try:
-        ventas_paginadas = Venta.query.order_by(Venta.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
-        clientes_full = Cliente.query.all()
-        vendedores_full = Usuario.query.all()
+        # Cliente y vendedor en el mismo SELECT de la página; los selectores del modal
+        # buscan bajo demanda (api_buscar_clientes y api_buscar_usuarios)
+        query = Venta.query.options(joinedload(Venta.comprador), joinedload(Venta.vendedor))
+        ventas_paginadas = paginar_keyset(query, Venta.id, per_page, despues=despues, antes=antes)
     except OperationalError as e:
         flash(f'Error de Base de Datos al cargar ventas: {e}', 'danger')
-        ventas_paginadas = EmptyPagination()
-        clientes_full = []
-        vendedores_full = []
+        ventas_paginadas = PaginaKeyset(per_page=per_page)
     
     return render_template('gestion_ventas.html', 
-                            ventas_paginadas=ventas_paginadas,
-                            clientes_full=clientes_full,
-                            vendedores_full=vendedores_full)
+                            ventas_paginadas=ventas_paginadas)
+
+MAX_VENTAS_ANULACION = 1000
+
 
-@app.route('/ventas/eliminar/<int:venta_id>')
+def anular_ventas(venta_ids):
+    """
+    Anula las ventas indicadas dentro de la transacción en curso (sin commit): descuenta su aporte
+    del resumen, devuelve el stock con un solo UPDATE y borra pagos, detalles y ventas en lote.
+    El número de consultas no depende de cuántas ventas o líneas haya. Devuelve los IDs anulados.
+    Las ventas se bloquean (en orden de ID) antes de tocar resumen y stock: si dos anulaciones de
+    la misma venta coinciden, la segunda espera y ya no la encuentra.
+    """
+    ids = [vid for (vid,) in db.session.query(Venta.id).filter(
+        Venta.id.in_(set(venta_ids))
+    ).order_by(Venta.id).with_for_update()]
+    if not ids:
+        return []
+
+    acumular_resumen(aportes_resumen_ventas(ids), signo=-1)
+
+    # Unidades por venta y producto; los productos ya eliminados del catálogo no reciben stock
+    devoluciones = db.session.query(
+        VentaDetalle.venta_id, VentaDetalle.producto_id, func.sum(VentaDetalle.cantidad)
+    ).join(Producto, Producto.id == VentaDetalle.producto_id).filter(
+        VentaDetalle.venta_id.in_(ids)
+    ).group_by(VentaDetalle.venta_id, VentaDetalle.producto_id).all()
+    devueltos = defaultdict(int)
+    for _, producto_id, cantidad in devoluciones:
+        devueltos[producto_id] += int(cantidad or 0)
+    aplicar_deltas_stock(devueltos, 'anulacion_venta', movimientos=[
+        (producto_id, int(cantidad or 0), f'Venta #{venta_id}') for venta_id, producto_id, cantidad in devoluciones
+    ])
+
+    db.session.query(VentaPago).filter(VentaPago.venta_id.in_(ids)).delete(synchronize_session=False)
+    db.session.query(VentaDetalle).filter(VentaDetalle.venta_id.in_(ids)).delete(synchronize_session=False)
+    db.session.query(Venta).filter(Venta.id.in_(ids)).delete(synchronize_session='fetch')
+    return ids
+
+
+@app.route('/ventas/eliminar/<int:venta_id>', methods=['POST'])
 @login_required
 def eliminar_venta(venta_id):
     if current_user.rol.lower() != 'administrador':
         flash('Permiso denegado.', 'danger')
         return redirect(url_for('gestion_ventas'))
-    venta = Venta.query.get_or_404(venta_id)
+    Venta.query.get_or_404(venta_id)
     try:
-        # Revertir el stock antes de eliminar los detalles
-        detalles = VentaDetalle.query.filter_by(venta_id=venta.id).all()
-        for d in detalles:
-            p = Producto.query.get(d.producto_id)
-            if p: p.cantidad += d.cantidad
-        
-        # Eliminar detalles y luego la venta
-        VentaDetalle.query.filter_by(venta_id=venta.id).delete(synchronize_session='fetch')
-        db.session.delete(venta)
+        anular_ventas([venta_id])
         db.session.commit()
         flash(f'Venta {venta_id} anulada y stock recuperado.', 'success')
     except Exception as e:
@@ -1056,6 +3355,40 @@ def eliminar_venta(venta_id):
         flash(f'Error al anular venta: {e}', 'danger')
     return redirect(url_for('gestion_ventas'))
 
+
+@app.route('/api/ventas/anular', methods=['POST'])
+@login_required
+def api_anular_ventas():
+    """
+    Anulación masiva: recibe {"ventas": [ids]} y las anula todas en una sola transacción.
+    Los IDs que no existen (p. ej. ya anulados) se informan en `no_encontradas`.
+    """
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'success': False, 'message': 'Permiso denegado.'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        venta_ids = {int(vid) for vid in data.get('ventas') or []}
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'La lista de ventas debe contener solo números.'}), 400
+    if not venta_ids:
+        return jsonify({'success': False, 'message': 'No se indicaron ventas para anular.'}), 400
+    if len(venta_ids) > MAX_VENTAS_ANULACION:
+        return jsonify({'success': False, 'message': f'Máximo {MAX_VENTAS_ANULACION} ventas por solicitud.'}), 400
+
+    try:
+        anuladas = anular_ventas(venta_ids)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': f'Error al anular ventas: {e}'}), 500
+
+    return jsonify({
+        'success': True,
+        'anuladas': anuladas,
+        'no_encontradas': sorted(venta_ids - set(anuladas))
+    })
+
 @app.route('/ventas/editar_info/<int:venta_id>', methods=['POST'])
 @login_required
 def editar_informacion_venta(venta_id):
@@ -1066,6 +3399,9 @@ def editar_informacion_venta(venta_id):
     v = Venta.query.get_or_404(venta_id)
     
     try:
+        # Se descuenta el aporte anterior al resumen; el nuevo se suma al final
+        acumular_resumen(aportes_resumen(v), signo=-1)
+
         v.cliente_id = int(request.form.get('cliente_id')) if request.form.get('cliente_id') else None
         v.usuario_id = int(request.form.get('vendedor_id'))
         
@@ -1088,6 +3424,8 @@ def editar_informacion_venta(venta_id):
         
         v.tipo_pago = tipo_pago_general
         v.detalle_pago = json.dumps(detalle_pago_dict)
+        filas_pago = registrar_pagos_venta(v, detalle_pago_dict)
+        acumular_resumen(aportes_resumen(v, filas_pago))
         
         db.session.commit()
         flash('✅ Información de venta actualizada correctamente.', 'success')
@@ -1104,7 +3442,9 @@ def api_detalle_venta(venta_id):
     if current_user.rol.lower() != 'administrador': 
         return jsonify({'error':'403'}), 403
     
-    venta = Venta.query.get(venta_id)
+    venta = Venta.query.options(
+        joinedload(Venta.comprador), joinedload(Venta.vendedor)
+    ).filter(Venta.id == venta_id).first()
     if not venta: 
         return jsonify({'error':'404'}), 404
     
@@ -1113,11 +3453,14 @@ def api_detalle_venta(venta_id):
     try:
         # Consulta explícita a VentaDetalle, no implícita a la relación, para evitar lazy loading errors
         detalles = VentaDetalle.query.filter_by(venta_id=venta_id).all() 
+        # Todos los productos de la venta en una consulta (los eliminados simplemente no aparecen)
+        ids_productos = {d.producto_id for d in detalles}
+        productos = {
+            p.id: p for p in Producto.query.filter(Producto.id.in_(ids_productos)).all()
+        } if ids_productos else {}
 
         for d in detalles:
-            # Producto.query.get(d.producto_id) puede fallar si el producto fue eliminado
-            # Usaremos una consulta más simple para obtener el producto.
-            p = db.session.get(Producto, d.producto_id)
+            p = productos.get(d.producto_id)
             
             prod_data = {
                 'id': d.producto_id,
@@ -1144,7 +3487,9 @@ def api_detalle_venta(venta_id):
             'venta_id': venta.id,
             'total': venta.total,
             'cliente_id': venta.cliente_id,
+            'cliente_nombre': venta.comprador.nombre if venta.comprador else None,
             'vendedor_id': venta.usuario_id,
+            'vendedor_nombre': venta.vendedor.username if venta.vendedor else None,
             'tipo_pago': venta.tipo_pago,
             'productos': prods,
             'pagos': pagos,
@@ -1162,85 +3507,318 @@ def api_detalle_venta(venta_id):
         return jsonify({'error': 'Error inesperado al cargar el detalle.', 'detail': str(e), 'productos': [], 'trace': error_detail}), 500
 
 
+def _producto_json(p):
+    return {
+        'id': p.id,
+        'codigo': p.codigo or '',
+        'nombre': p.nombre,
+        'marca': p.marca or 'Sin marca',
+        'descripcion': p.descripcion or '',
+        'valor_venta': p.valor_venta,
+        'cantidad_stock': p.cantidad
+    }
+
+
+def _limite_api(defecto=20, maximo=50):
+    return max(1, min(request.args.get('limite', defecto, type=int), maximo))
+
+
+@app.route('/api/productos/buscar', methods=['GET'])
+@login_required
+def api_buscar_productos():
+    """Búsqueda de productos para selectores (inventario y pantalla de venta)."""
+    termino = request.args.get('q', '').strip()
+    if not termino:
+        return jsonify({'productos': []})
+
+    try:
+        query = buscar_productos(termino)
+        if not request.args.get('incluir_inactivos', type=int):
+            query = query.filter(Producto.activo.is_(True))
+        if request.args.get('con_stock', type=int):
+            query = query.filter(Producto.cantidad > 0)
+        productos_list = [_producto_json(p) for p in query.limit(_limite_api()).all()]
+        return jsonify({'productos': productos_list})
+    except OperationalError:
+        return jsonify({'productos': [], 'error': 'Error de base de datos.'}), 500
+
+
+@app.route('/api/productos/codigo/<path:codigo>', methods=['GET'])
+@login_required
+def api_producto_por_codigo(codigo):
+    """Lectura de escáner: búsqueda exacta por el índice único de `codigo`."""
+    try:
+        producto = Producto.query.filter_by(codigo=codigo.strip()).first()
+    except OperationalError:
+        return jsonify({'error': 'Error de base de datos.'}), 500
+    if not producto:
+        return jsonify({'error': f'Producto con código {codigo} no encontrado.'}), 404
+    if not producto.activo:
+        return jsonify({'error': f'El producto {producto.nombre} está inactivo.'}), 404
+    return jsonify({'producto': _producto_json(producto)})
+
+
+@app.route('/api/productos/prefijo', methods=['GET'])
+@login_required
+def api_productos_por_prefijo():
+    """Códigos que empiezan por `q`, como rango sobre el índice de `codigo` (sin escaneo completo)."""
+    prefijo = request.args.get('q', '').strip()
+    if not prefijo:
+        return jsonify({'productos': []})
+
+    try:
+        query = Producto.query.filter(
+            Producto.codigo >= prefijo,
+            Producto.codigo < prefijo + '\U0010ffff',
+            Producto.codigo.like(escapar_like(prefijo) + '%', escape='\\'),
+            Producto.activo.is_(True)
+        )
+        if request.args.get('con_stock', type=int):
+            query = query.filter(Producto.cantidad > 0)
+        productos_list = [_producto_json(p) for p in query.order_by(Producto.codigo).limit(_limite_api()).all()]
+        return jsonify({'productos': productos_list})
+    except OperationalError:
+        return jsonify({'productos': [], 'error': 'Error de base de datos.'}), 500
+
+
+@app.route('/api/clientes/buscar', methods=['GET'])
+@login_required
+def api_buscar_clientes():
+    """Typeahead de clientes por nombre o teléfono (resultados limitados)."""
+    termino = request.args.get('q', '').strip()
+    try:
+        query = Cliente.query
+        if termino:
+            query = query.filter(
+                (Cliente.nombre.ilike(f'%{termino}%')) |
+                (Cliente.telefono.ilike(f'%{termino}%'))
+            )
+        clientes_list = [{
+            'id': cli.id,
+            'nombre': cli.nombre,
+            'telefono': cli.telefono or ''
+        } for cli in query.order_by(Cliente.nombre).limit(_limite_api()).all()]
+        return jsonify({'clientes': clientes_list})
+    except OperationalError:
+        return jsonify({'clientes': [], 'error': 'Error de base de datos.'}), 500
+
+
+@app.route('/api/usuarios/buscar', methods=['GET'])
+@login_required
+def api_buscar_usuarios():
+    """Typeahead de vendedores por usuario, nombre o apellido (resultados limitados)."""
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'usuarios': [], 'error': 'Permiso denegado.'}), 403
+    termino = request.args.get('q', '').strip()
+    try:
+        query = Usuario.query
+        if termino:
+            query = query.filter(
+                (Usuario.username.ilike(f'%{termino}%')) |
+                (Usuario.nombre.ilike(f'%{termino}%')) |
+                (Usuario.apellido.ilike(f'%{termino}%'))
+            )
+        usuarios_list = [{
+            'id': u.id,
+            'username': u.username,
+            'nombre': f'{u.nombre} {u.apellido}'.strip()
+        } for u in query.order_by(Usuario.username).limit(_limite_api()).all()]
+        return jsonify({'usuarios': usuarios_list})
+    except OperationalError:
+        return jsonify({'usuarios': [], 'error': 'Error de base de datos.'}), 500
+
+def _producto_catalogo_json(p, con_costo=False):
+    datos = {
+        'id': p.id, 
+        'codigo': p.codigo or '',
+        'nombre': p.nombre, 
+        'marca': p.marca or 'Sin marca',
+        'valor_venta': p.valor_venta, 
+        'cantidad_stock': p.cantidad, 
+        'descripcion': p.descripcion or '',
+        'activo': p.activo,
+        'version': p.version
+    }
+    if con_costo:
+        datos['valor_interno'] = p.valor_interno
+    return datos
+
+
 @app.route('/api/productos/todos', methods=['GET'])
 @login_required
 def api_todos_los_productos():
+    """Catálogo completo; responde 304 si el cliente ya tiene la versión actual (ETag)."""
     try:
-        productos_list = [{
-            'id': p.id, 
-            'nombre': p.nombre, 
-            'marca': p.marca or 'Sin marca',
-            'valor_venta': p.valor_venta, 
-            'cantidad_stock': p.cantidad, 
-            'descripcion': p.descripcion or ''
-        } for p in Producto.query.all()]
-        return jsonify({'productos': productos_list})
+        version = version_catalogo_actual()
+        con_costo = current_user.rol.lower() == 'administrador'
+        etag = f'catalogo-{version}' + ('-c' if con_costo else '')
+        if request.if_none_match.contains(etag):
+            respuesta = app.response_class(status=304)
+        else:
+            productos_list = [_producto_catalogo_json(p, con_costo) for p in Producto.query.all()]
+            respuesta = jsonify({'productos': productos_list, 'version': version, 'epoca': epoca_catalogo_actual()})
+        respuesta.set_etag(etag)
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        return respuesta
     except OperationalError:
         return jsonify({'productos': [], 'error': 'Error de base de datos.'}), 500
 
+
+@app.route('/api/productos/cambios', methods=['GET'])
+@login_required
+def api_cambios_productos():
+    """
+    Productos modificados y eliminados después de la versión `desde`.
+    Contrato con el cliente:
+    - guarda la `version` y la `epoca` devueltas y las envía en la siguiente consulta (?desde=&epoca=);
+    - aplica primero `eliminados` y después `productos`: un mismo ID puede venir en ambas listas
+      si se borró y el ID se reutilizó;
+    - si la respuesta trae `recargar` (el catálogo se reemplazó entero), descarta su copia y
+      vuelve a pedir /api/productos/todos.
+    """
+    desde = request.args.get('desde', 0, type=int)
+    epoca_cliente = request.args.get('epoca', type=int)
+    try:
+        epoca = epoca_catalogo_actual()
+        if epoca_cliente is not None and epoca_cliente != epoca:
+            return jsonify({'recargar': True, 'epoca': epoca, 'version': version_catalogo_actual(),
+                            'productos': [], 'eliminados': []})
+
+        # La versión se lee primero: lo que se confirme después llegará en la siguiente consulta
+        version = version_catalogo_actual()
+        cambiados = Producto.query.filter(
+            Producto.version > desde, Producto.version <= version
+        ).order_by(Producto.version).all()
+        eliminados = db.session.query(ProductoBaja.producto_id).filter(
+            ProductoBaja.version > desde, ProductoBaja.version <= version
+        ).all()
+        con_costo = current_user.rol.lower() == 'administrador'
+        return jsonify({
+            'version': version,
+            'epoca': epoca,
+            'productos': [_producto_catalogo_json(p, con_costo) for p in cambiados],
+            'eliminados': sorted({pid for (pid,) in eliminados})
+        })
+    except OperationalError:
+        return jsonify({'productos': [], 'eliminados': [], 'error': 'Error de base de datos.'}), 500
+
+def diff_detalles_venta(detalles, lineas):
+    """
+    Compara los detalles guardados (filas con id, producto_id, cantidad y precio_unitario) con las
+    líneas nuevas [(producto_id, cantidad, precio)]. Las líneas se emparejan por producto en orden
+    de aparición. Devuelve (cambios, borrados, nuevas, deltas): `cambios` son dicts para un UPDATE
+    por clave primaria, `borrados` los IDs de detalle que sobran, `nuevas` las líneas sin detalle
+    previo y `deltas` {producto_id: unidades que vuelven (+) o salen (-) del stock}.
+    """
+    previos = defaultdict(list)
+    deltas = defaultdict(int)
+    for d in sorted(detalles, key=lambda d: d.id):
+        previos[d.producto_id].append(d)
+        deltas[d.producto_id] += d.cantidad
+
+    cambios, nuevas = [], []
+    for producto_id, cantidad, precio in lineas:
+        deltas[producto_id] -= cantidad
+        if previos.get(producto_id):
+            d = previos[producto_id].pop(0)
+            if d.cantidad != cantidad or d.precio_unitario != precio:
+                cambios.append({'id': d.id, 'cantidad': cantidad, 'precio_unitario': precio,
+                                'subtotal': cantidad * precio})
+        else:
+            nuevas.append((producto_id, cantidad, precio))
+
+    borrados = [d.id for sobrantes in previos.values() for d in sobrantes]
+    return cambios, borrados, nuevas, {pid: delta for pid, delta in deltas.items() if delta}
+
+
 @app.route('/api/ventas/detalle/editar/<int:venta_id>', methods=['POST'])
 @login_required
 def api_editar_detalle_venta(venta_id):
     """
-    API para editar el detalle de productos de una venta, revirtiendo el stock anterior
-    y actualizando el total de la venta (v.total).
+    API para editar el detalle de productos de una venta. Solo se escriben los detalles que
+    cambian y el stock se ajusta por la diferencia neta de cada producto; también actualiza
+    el total de la venta (v.total).
     """
     if current_user.rol.lower() != 'administrador': 
         return jsonify({'success':False}), 403
     
-    venta = Venta.query.get(venta_id)
-    if not venta:
-        return jsonify({'success': False, 'message': 'Venta no encontrada'}), 404
-    
-    data = request.get_json()
-    productos_nuevos = data.get('productos', [])
-    
+    data = request.get_json(silent=True) or {}
     try:
-        # 1. Revertir el stock de los detalles viejos
-        detalles_viejos = VentaDetalle.query.filter_by(venta_id=venta_id).all()
-        for d in detalles_viejos:
-            p = Producto.query.get(d.producto_id)
-            if p: 
-                p.cantidad += d.cantidad
-        
-        # 2. Eliminar los detalles viejos
-        VentaDetalle.query.filter_by(venta_id=venta.id).delete(synchronize_session='fetch')
-
-        # 3. Procesar y agregar los nuevos detalles
-        nuevo_total = 0.0
-        for item in productos_nuevos:
+        lineas = []
+        for item in data.get('productos', []):
             pid = int(item.get('id'))
             cant = int(item.get('cantidad'))
-            precio = float(item.get('precio_unitario')) 
-            
+            precio = float(item.get('precio_unitario'))
+            if precio < 0:
+                raise ValueError(precio)
             if cant > 0:
-                sub = cant * precio
-                nuevo_total += sub
-                p = Producto.query.get(pid)
-                
-                if p:
-                    if p.cantidad < cant:
-                        # Si esto falla, el stock ya está revertido, pero se debe revertir el total.
-                        raise Exception(f'Stock insuficiente para: {p.nombre}. Disponible: {p.cantidad}, Solicitado: {cant}')
-                    
-                    p.cantidad -= cant
-                    db.session.add(VentaDetalle(
-                        venta_id=venta.id, 
-                        producto_id=pid, 
-                        cantidad=cant, 
-                        precio_unitario=precio, 
-                        subtotal=sub
-                    ))
-        
-        # 4. Actualizar el total de la venta (CLAVE para sincronizar con la edición de pagos)
+                lineas.append((pid, cant, precio))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Hay líneas con producto, cantidad o precio inválidos.'}), 400
+    
+    # La venta se bloquea antes que sus productos (mismo orden que anular_ventas): una edición
+    # y una anulación simultáneas de la misma venta no se pisan
+    venta = db.session.get(Venta, venta_id, with_for_update=True)
+    if not venta:
+        return jsonify({'success': False, 'message': 'Venta no encontrada'}), 404
+
+    try:
+        detalles = db.session.query(
+            VentaDetalle.id, VentaDetalle.producto_id, VentaDetalle.cantidad, VentaDetalle.precio_unitario
+        ).filter(VentaDetalle.venta_id == venta.id).all()
+        cambios, borrados, nuevas, deltas = diff_detalles_venta(detalles, lineas)
+        if not (cambios or borrados or nuevas):
+            db.session.rollback()  # libera el bloqueo de la venta
+            return jsonify({'success': True, 'nuevo_total': venta.total})
+
+        # Una consulta bloquea solo los productos cuyo stock cambia o que entran a la venta
+        productos = bloquear_productos(set(deltas) | {pid for pid, _, _ in nuevas})
+        errores = []
+        for pid, _, _ in nuevas:
+            if pid not in productos:
+                errores.append(f'Producto con ID {pid} no encontrado.')
+            elif not productos[pid].activo:
+                errores.append(f'{productos[pid].nombre} está inactivo y no se puede vender.')
+        for pid, delta in deltas.items():
+            p = productos.get(pid)
+            if p and (p.cantidad or 0) + delta < 0:
+                errores.append(f'Stock insuficiente para: {p.nombre}. Disponible: {p.cantidad or 0}, Adicional solicitado: {-delta}')
+        if errores:
+            raise StockInsuficienteError(errores)
+
+        acumular_resumen(aportes_resumen(venta), signo=-1)
+
+        if borrados:
+            db.session.query(VentaDetalle).filter(VentaDetalle.id.in_(borrados)).delete(synchronize_session=False)
+        if cambios:
+            db.session.execute(update(VentaDetalle), cambios)
+        if nuevas:
+            db.session.execute(insert(VentaDetalle), [
+                {'venta_id': venta.id, 'producto_id': pid, 'cantidad': cant,
+                 'precio_unitario': precio, 'subtotal': cant * precio}
+                for pid, cant, precio in nuevas
+            ])
+
+        # Diferencia neta por producto en un solo UPDATE (también queda en el kardex);
+        # las líneas de productos ya eliminados del catálogo no mueven stock
+        aplicar_deltas_stock({pid: delta for pid, delta in deltas.items() if pid in productos},
+                             'edicion_venta', f'Venta #{venta.id}')
+
+        # Actualizar el total de la venta (CLAVE para sincronizar con la edición de pagos)
+        nuevo_total = sum(cant * precio for _, cant, precio in lineas)
         venta.total = nuevo_total
         
         if nuevo_total == 0:
             venta.tipo_pago = "Anulada/Sin Productos"
+
+        acumular_resumen(aportes_resumen(venta))
             
         db.session.commit()
         return jsonify({'success': True, 'nuevo_total': nuevo_total})
-        
+
+    except StockInsuficienteError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': str(e)}), 409
     except Exception as e:
         db.session.rollback() 
         return jsonify({'success': False, 'message': str(e)}), 500
@@ -1248,6 +3826,473 @@ def api_editar_detalle_venta(venta_id):
 # =================================================================
 # LÓGICA DE IMPORTACIÓN DESDE EXCEL (NUEVA RUTA ADMINISTRATIVA)
 # =================================================================
+COLUMNAS_IMPORTACION = ['codigo', 'nombre', 'descripcion', 'marca', 'cantidad',
+                        'valor_venta', 'valor_interno', 'stock_minimo']
+CARPETA_IMPORTACIONES = os.path.join(app.instance_path, 'importaciones')
+IMPORTACIONES_MAX_HORAS = 24
+
+
+def _texto_columna(serie):
+    """Texto limpio (None si está vacío). Los números enteros pierden el '.0' que agrega Excel."""
+    numeros = pd.to_numeric(serie, errors='coerce')
+    enteros = numeros.notna() & (numeros % 1 == 0)
+    texto = serie.astype('string').str.strip()
+    texto[enteros] = numeros[enteros].astype('int64').astype('string')
+    return texto.replace('', pd.NA)
+
+
+def normalizar_hoja_productos(df, fila_inicial=2):
+    """
+    Normaliza y valida la hoja 'Producto' con operaciones vectorizadas de pandas.
+    Devuelve (validos, rechazados): `validos` tiene exactamente COLUMNAS_IMPORTACION con tipos
+    finales y `rechazados` conserva los datos originales más 'fila' (número en Excel) y 'motivo'.
+    Con fila_inicial=None se respeta el índice de `df` como número de fila.
+    Lanza KeyError si falta una columna obligatoria.
+    """
+    df = df.rename(columns=lambda c: str(c).strip().lower())
+    df = df.loc[:, ~df.columns.duplicated()]
+    for obligatoria in ('nombre', 'valor_venta'):
+        if obligatoria not in df.columns:
+            raise KeyError(obligatoria)
+    presentes = [c for c in COLUMNAS_IMPORTACION if c in df.columns]
+    df = df.reindex(columns=COLUMNAS_IMPORTACION)
+    if fila_inicial is not None:
+        df.index = pd.RangeIndex(fila_inicial, fila_inicial + len(df))
+
+    datos = pd.DataFrame(index=df.index)
+    for columna in ('codigo', 'nombre', 'descripcion', 'marca'):
+        datos[columna] = _texto_columna(df[columna])
+    for columna in ('cantidad', 'valor_venta', 'valor_interno', 'stock_minimo'):
+        datos[columna] = pd.to_numeric(df[columna], errors='coerce')
+
+    # Cada regla marca sus filas; se reporta el primer motivo que aplique
+    reglas = [
+        ('Sin nombre', datos['nombre'].isna()),
+        ('valor_venta vacío o no numérico', datos['valor_venta'].isna()),
+        ('valor_venta negativo', datos['valor_venta'] < 0),
+        ('cantidad no numérica', df['cantidad'].notna() & datos['cantidad'].isna()),
+        ('valor_interno no numérico', df['valor_interno'].notna() & datos['valor_interno'].isna()),
+        ('stock_minimo no numérico', df['stock_minimo'].notna() & datos['stock_minimo'].isna()),
+        ('Código repetido en el archivo', datos['codigo'].notna() & datos['codigo'].duplicated(keep='first')),
+    ]
+    motivo = pd.Series(pd.NA, index=df.index, dtype='string')
+    for texto, mascara in reglas:
+        motivo = motivo.mask(motivo.isna() & mascara.fillna(False), texto)
+
+    rechazados = df[motivo.notna()].assign(motivo=motivo[motivo.notna()])
+    rechazados.insert(0, 'fila', rechazados.index)
+
+    validos = datos[motivo.isna()].copy()
+    validos['cantidad'] = validos['cantidad'].fillna(0).astype('int64')
+    validos['valor_interno'] = validos['valor_interno'].fillna(0.0).astype(float)
+    validos['valor_venta'] = validos['valor_venta'].astype(float)
+    validos['stock_minimo'] = validos['stock_minimo'].fillna(5).astype('int64')
+    validos = validos.astype(object).where(validos.notna(), None)
+    # La sincronización solo compara las columnas que vienen en el archivo
+    validos.attrs['columnas'] = presentes
+    return validos, rechazados
+
+
+def insertar_productos_en_lote(validos, referencia=None, usuario_id=None):
+    """
+    Inserta los productos normalizados en un solo INSERT ejecutado como executemany
+    (SQLAlchemy agrupa las filas en INSERTs de varios VALUES). Devuelve la cantidad insertada.
+    """
+    if validos.empty:
+        return 0
+    registros = validos.to_dict('records')
+    version = version_catalogo()
+    for registro in registros:
+        registro['version'] = version
+    # RETURNING en lote (PostgreSQL y SQLite 3.35+) para dejar el stock inicial en el kardex
+    creados = db.session.execute(insert(Producto).returning(Producto.id, Producto.cantidad), registros)
+    registrar_movimientos({pid: cantidad for pid, cantidad in creados}, 'importacion', referencia, usuario_id)
+    return len(registros)
+
+
+def _preparar_carpeta_importaciones():
+    """Crea la carpeta de archivos temporales de importación y borra los vencidos."""
+    os.makedirs(CARPETA_IMPORTACIONES, exist_ok=True)
+    limite = datetime.now().timestamp() - IMPORTACIONES_MAX_HORAS * 3600
+    for nombre in os.listdir(CARPETA_IMPORTACIONES):
+        ruta = os.path.join(CARPETA_IMPORTACIONES, nombre)
+        if os.path.getmtime(ruta) < limite:
+            os.remove(ruta)
+
+
+def guardar_archivo_importacion(archivo_subido):
+    """Copia el Excel subido a disco (sin cargarlo en memoria) y devuelve su identificador."""
+    _preparar_carpeta_importaciones()
+    token = uuid.uuid4().hex
+    archivo_subido.save(os.path.join(CARPETA_IMPORTACIONES, f'pendiente_{token}.xlsx'))
+    return token
+
+
+def ruta_archivo_importacion(token):
+    """Ruta del Excel pendiente de `token`, o None si el identificador no es válido o ya venció."""
+    if not token or not re.fullmatch(r'[0-9a-f]{32}', token):
+        return None
+    ruta = os.path.join(CARPETA_IMPORTACIONES, f'pendiente_{token}.xlsx')
+    return ruta if os.path.exists(ruta) else None
+
+
+CAMPOS_SINCRONIZABLES = ['nombre', 'descripcion', 'marca', 'cantidad',
+                         'valor_venta', 'valor_interno', 'stock_minimo']
+CAMPOS_NUMERICOS = {'cantidad', 'valor_venta', 'valor_interno', 'stock_minimo'}
+MUESTRA_DIFF = 50
+
+
+def separar_sin_codigo(validos, rechazados):
+    """Sin `codigo` no hay con qué emparejar: esas filas pasan a los rechazados."""
+    sin_codigo = validos['codigo'].isna()
+    if not sin_codigo.any():
+        return validos, rechazados
+    extra = validos[sin_codigo].assign(motivo='Sin código (obligatorio para sincronizar)')
+    extra.insert(0, 'fila', extra.index)
+    columnas = validos.attrs.get('columnas')
+    validos = validos[~sin_codigo].copy()
+    validos.attrs['columnas'] = columnas
+    return validos, pd.concat([rechazados, extra]).sort_values('fila')
+
+
+def calcular_diff_catalogo(validos, desactivar_faltantes=False):
+    """
+    Compara la hoja (ya normalizada y con código) contra el catálogo por `codigo`.
+    Devuelve un dict con los productos nuevos, los cambios agrupados por conjunto de columnas
+    modificadas (para un UPDATE por lote), los IDs a desactivar y una muestra para la vista previa.
+    """
+    campos = [c for c in CAMPOS_SINCRONIZABLES if c in validos.attrs.get('columnas', CAMPOS_SINCRONIZABLES)]
+    consulta = select(Producto.id, Producto.codigo, Producto.activo, *[getattr(Producto, c) for c in campos])
+    if not desactivar_faltantes:
+        # Solo hace falta leer los productos de este archivo (o de este lote)
+        consulta = consulta.where(Producto.codigo.in_(validos['codigo'].tolist()))
+    existentes = pd.DataFrame(db.session.execute(consulta).all(), columns=['id', 'codigo', 'activo', *campos])
+
+    unidos = validos.merge(existentes, on='codigo', how='left', suffixes=('', '_actual'), indicator=True)
+    nuevos = unidos.loc[unidos['_merge'] == 'left_only', COLUMNAS_IMPORTACION]
+    coinciden = unidos[unidos['_merge'] == 'both']
+
+    cambiados = pd.DataFrame(index=coinciden.index)
+    for campo in campos:
+        nuevo, actual = coinciden[campo], coinciden[f'{campo}_actual']
+        if campo in CAMPOS_NUMERICOS:
+            nuevo, actual = pd.to_numeric(nuevo), pd.to_numeric(actual)
+            cambiados[campo] = (nuevo - actual).abs().gt(1e-6) | (nuevo.isna() != actual.isna())
+        else:
+            cambiados[campo] = nuevo.fillna('').astype(str) != actual.fillna('').astype(str)
+    cambiados['activo'] = ~coinciden['activo'].astype(bool)
+    con_cambios = cambiados[cambiados.any(axis=1)]
+
+    # Los cambios de stock también van al kardex (solo si la hoja trae la columna cantidad)
+    deltas_stock = {}
+    if 'cantidad' in cambiados:
+        con_stock = coinciden[cambiados['cantidad']]
+        deltas_stock = dict(zip(
+            con_stock['id'].astype('int64').tolist(),
+            (pd.to_numeric(con_stock['cantidad']) - pd.to_numeric(con_stock['cantidad_actual']).fillna(0)).astype('int64').tolist()
+        ))
+
+    actualizaciones = []
+    for clave, grupo in con_cambios.groupby(list(con_cambios.columns), sort=False):
+        columnas = [c for c, cambio in zip(con_cambios.columns, clave) if cambio]
+        datos = coinciden.loc[grupo.index, ['id', *[c for c in columnas if c != 'activo']]].copy()
+        datos['id'] = datos['id'].astype('int64')
+        if 'activo' in columnas:
+            datos['activo'] = True
+        actualizaciones.append((columnas, datos))
+
+    desactivar = []
+    if desactivar_faltantes:
+        faltantes = existentes['activo'].astype(bool) & ~existentes['codigo'].isin(validos['codigo'])
+        desactivar = existentes.loc[faltantes, 'id'].astype('int64').tolist()
+
+    muestra = []
+    for indice in con_cambios.index[:MUESTRA_DIFF]:
+        fila = coinciden.loc[indice]
+        detalle = [
+            f"{c}: {fila[c + '_actual']} → {fila[c]}" if c != 'activo' else 'reactivado'
+            for c in con_cambios.columns if con_cambios.at[indice, c]
+        ]
+        muestra.append({'codigo': fila['codigo'], 'nombre': fila['nombre'], 'cambios': ', '.join(detalle)})
+
+    return {
+        'nuevos': nuevos,
+        'actualizaciones': actualizaciones,
+        'deltas_stock': deltas_stock,
+        'desactivar': desactivar,
+        'resumen': {
+            'nuevos': len(nuevos),
+            'modificados': len(con_cambios),
+            'sin_cambios': len(coinciden) - len(con_cambios),
+            'desactivados': len(desactivar),
+        },
+        'muestra_nuevos': nuevos.head(MUESTRA_DIFF)[['codigo', 'nombre', 'valor_venta']].to_dict('records'),
+        'muestra_cambios': muestra,
+        'muestra_desactivar': [
+            {'codigo': p.codigo, 'nombre': p.nombre}
+            for p in Producto.query.filter(Producto.id.in_(desactivar[:MUESTRA_DIFF])).all()
+        ] if desactivar else [],
+    }
+
+
+def aplicar_diff_catalogo(diff, lote=500, referencia=None, usuario_id=None):
+    """Escribe el diff: INSERT de los nuevos y un UPDATE por lote por cada conjunto de columnas cambiadas."""
+    insertar_productos_en_lote(diff['nuevos'], referencia, usuario_id)
+    registrar_movimientos(diff['deltas_stock'], 'importacion', referencia, usuario_id)
+    version = version_catalogo()
+    for _, datos in diff['actualizaciones']:
+        registros = datos.to_dict('records')
+        for registro in registros:
+            registro['version'] = version
+        # UPDATE masivo por clave primaria (executemany), solo con las columnas que cambiaron
+        db.session.execute(update(Producto), registros)
+    desactivar_productos(diff['desactivar'], lote)
+    return diff['resumen']
+
+
+def desactivar_productos(ids, lote=500):
+    for inicio in range(0, len(ids), lote):
+        db.session.execute(
+            update(Producto)
+            .where(Producto.id.in_(ids[inicio:inicio + lote]))
+            .values(activo=False, version=version_catalogo())
+        )
+
+
+def ids_productos_faltantes(codigos_vistos):
+    """IDs de los productos activos cuyo código no apareció en el archivo."""
+    return [
+        pid for pid, codigo in db.session.query(Producto.id, Producto.codigo).filter(Producto.activo.is_(True))
+        if codigo not in codigos_vistos
+    ]
+
+
+TAMANO_LOTE_IMPORTACION = 500
+
+
+def leer_hoja_en_lotes(ruta, tamano=TAMANO_LOTE_IMPORTACION):
+    """
+    Recorre la hoja 'Producto' fila por fila (openpyxl en modo solo lectura) y entrega
+    DataFrames de `tamano` filas indexados por número de fila de Excel. La memoria no crece con el archivo.
+    """
+    libro = openpyxl.load_workbook(ruta, read_only=True, data_only=True)
+    try:
+        if 'Producto' not in libro.sheetnames:
+            raise ValueError('El archivo no tiene una hoja llamada "Producto".')
+        filas = libro['Producto'].iter_rows(values_only=True)
+        encabezado = next(filas, None)
+        if not encabezado:
+            return
+        columnas = [str(c) if c is not None else f'_vacia_{i}' for i, c in enumerate(encabezado)]
+
+        valores, numeros = [], []
+        for numero, fila in enumerate(filas, start=2):
+            if all(v is None for v in fila):
+                continue
+            valores.append(fila[:len(columnas)])
+            numeros.append(numero)
+            if len(valores) == tamano:
+                yield pd.DataFrame(valores, index=numeros, columns=columnas)
+                valores, numeros = [], []
+        if valores:
+            yield pd.DataFrame(valores, index=numeros, columns=columnas)
+    finally:
+        libro.close()
+
+
+def filas_estimadas_hoja(ruta):
+    libro = openpyxl.load_workbook(ruta, read_only=True)
+    try:
+        hoja = libro['Producto'] if 'Producto' in libro.sheetnames else None
+        return max((hoja.max_row or 1) - 1, 0) if hoja is not None else None
+    finally:
+        libro.close()
+
+
+def _quitar_codigos_repetidos(validos, rechazados, codigos_vistos):
+    """Rechaza los códigos que ya aparecieron en lotes anteriores del mismo archivo."""
+    repetidos = validos['codigo'].isin(codigos_vistos)
+    if repetidos.any():
+        extra = validos[repetidos].assign(motivo='Código repetido en el archivo')
+        extra.insert(0, 'fila', extra.index)
+        rechazados = pd.concat([rechazados, extra])
+        columnas = validos.attrs.get('columnas')
+        validos = validos[~repetidos].copy()
+        validos.attrs['columnas'] = columnas
+    codigos_vistos.update(validos['codigo'].dropna())
+    return validos, rechazados
+
+
+def borrar_inventario_y_ventas():
+    """Limpieza del modo 'reemplazar': ventas, cierres y productos (en ese orden por las claves foráneas)."""
+    db.session.query(VentaDetalle).delete()
+    db.session.query(VentaPago).delete()
+    db.session.query(ResumenVentas).delete()
+    db.session.query(Venta).delete()
+    db.session.query(CierreCajaMetodo).delete()
+    db.session.query(CierreCajaVendedor).delete()
+    db.session.query(CierreCaja).delete()
+    registrar_bajas_productos(db.session.query(Producto))
+    db.session.query(Producto).delete()
+    # Los IDs borrados pueden volver a usarse (SQLite): los terminales deben recargar todo
+    nueva_epoca_catalogo()
+    # El historial de stock y los conteos pertenecen a los productos borrados
+    db.session.query(MovimientoInventario).delete()
+    db.session.query(SaldoInventario).delete()
+    db.session.query(ConteoInventarioLinea).delete()
+    db.session.query(ConteoInventarioEnvio).delete()
+    db.session.query(ConteoInventario).delete()
+
+
+IMPORTACION_SIN_AVANCE_MINUTOS = 15
+CAMPOS_AVANCE_IMPORTACION = ('filas_procesadas', 'filas_rechazadas', 'nuevos', 'modificados', 'sin_cambios')
+
+
+def marcar_importaciones_interrumpidas():
+    """
+    Pasa a 'error' los trabajos pendientes o en proceso sin avance en IMPORTACION_SIN_AVANCE_MINUTOS:
+    el hilo murió con su proceso (p. ej. gunicorn recicló el worker). Devuelve cuántos marcó.
+    """
+    limite = datetime.utcnow() - timedelta(minutes=IMPORTACION_SIN_AVANCE_MINUTOS)
+    ultimo_avance = func.coalesce(TrabajoImportacion.actualizado, TrabajoImportacion.inicio, TrabajoImportacion.creado)
+    marcados = TrabajoImportacion.query.filter(
+        TrabajoImportacion.estado.in_(('pendiente', 'procesando')), ultimo_avance < limite
+    ).update({
+        'estado': 'error',
+        'mensaje': 'La importación se interrumpió (el servidor se reinició). Revise el inventario y vuelva a importar.',
+        'fin': datetime.utcnow()
+    }, synchronize_session=False)
+    db.session.commit()
+    return marcados
+
+
+def _publicar_avance_importacion(trabajo_id, avance):
+    """
+    Guarda el avance por una conexión aparte, sin confirmar la transacción del trabajo
+    (modo 'reemplazar'). No se usa en SQLite: admite un solo escritor y ahí el avance
+    aparece al terminar.
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return
+    with db.engine.begin() as conexion:
+        conexion.execute(
+            update(TrabajoImportacion.__table__)
+            .where(TrabajoImportacion.__table__.c.id == trabajo_id)
+            .values(actualizado=datetime.utcnow(), **avance)
+        )
+
+
+def iniciar_trabajo_importacion(ruta, modo, desactivar_faltantes):
+    """
+    Registra el trabajo y lo lanza en un hilo; la petición web responde de inmediato.
+    Lanza zipfile.BadZipFile o InvalidFileException si el archivo no es un .xlsx válido.
+    """
+    trabajo = TrabajoImportacion(
+        id=uuid.uuid4().hex, usuario_id=current_user.id, modo=modo,
+        filas_totales=filas_estimadas_hoja(ruta)
+    )
+    db.session.add(trabajo)
+    db.session.commit()
+    threading.Thread(
+        target=ejecutar_trabajo_importacion,
+        args=(trabajo.id, ruta, modo, desactivar_faltantes),
+        name=f'importacion-{trabajo.id[:8]}',
+        daemon=True
+    ).start()
+    return trabajo
+
+
+def ejecutar_trabajo_importacion(trabajo_id, ruta, modo, desactivar_faltantes):
+    """
+    Procesa el archivo por lotes con el avance guardado en TrabajoImportacion.
+    - 'sincronizar': un commit por lote; si falla a mitad de camino, los lotes ya confirmados
+      quedan aplicados (volver a importar el archivo completa el resto) y el error queda registrado.
+    - 'reemplazar': borrado y carga en una sola transacción; si algo falla no se borra nada.
+      Mientras tanto la fila del trabajo no se toca en esa transacción: el avance se publica
+      por otra conexión (_publicar_avance_importacion).
+    """
+    with app.app_context():
+        trabajo = db.session.get(TrabajoImportacion, trabajo_id)
+        trabajo.estado = 'procesando'
+        trabajo.inicio = trabajo.actualizado = datetime.utcnow()
+        trabajo.version_inicial = version_catalogo_actual()
+        usuario_id = trabajo.usuario_id
+        db.session.commit()
+
+        rechazos, codigos_vistos = [], set()
+        avance = dict.fromkeys(CAMPOS_AVANCE_IMPORTACION, 0)
+        borrado = False
+        referencia = f'Importación {trabajo_id[:8]}'
+        try:
+            for lote in leer_hoja_en_lotes(ruta):
+                validos, rechazados = normalizar_hoja_productos(lote, fila_inicial=None)
+
+                if modo == 'reemplazar':
+                    if not borrado:
+                        # Se borra solo cuando el encabezado ya pasó la validación
+                        borrar_inventario_y_ventas()
+                        borrado = True
+                    sin_codigo = validos[validos['codigo'].isna()]
+                    con_codigo, rechazados = _quitar_codigos_repetidos(
+                        validos[validos['codigo'].notna()], rechazados, codigos_vistos
+                    )
+                    avance['nuevos'] += insertar_productos_en_lote(pd.concat([sin_codigo, con_codigo]), referencia, usuario_id)
+                else:
+                    validos, rechazados = separar_sin_codigo(validos, rechazados)
+                    validos, rechazados = _quitar_codigos_repetidos(validos, rechazados, codigos_vistos)
+                    resumen = aplicar_diff_catalogo(calcular_diff_catalogo(validos), referencia=referencia,
+                                                    usuario_id=usuario_id)
+                    for campo in ('nuevos', 'modificados', 'sin_cambios'):
+                        avance[campo] += resumen[campo]
+
+                if not rechazados.empty:
+                    rechazos.append(rechazados)
+                    avance['filas_rechazadas'] += len(rechazados)
+                avance['filas_procesadas'] += len(lote)
+
+                if modo == 'reemplazar':
+                    _publicar_avance_importacion(trabajo_id, avance)
+                else:
+                    for campo, valor in avance.items():
+                        setattr(trabajo, campo, valor)
+                    trabajo.actualizado = datetime.utcnow()
+                    db.session.commit()
+
+            for campo, valor in avance.items():
+                setattr(trabajo, campo, valor)
+            if modo != 'reemplazar' and desactivar_faltantes:
+                ids = ids_productos_faltantes(codigos_vistos)  # desactivar no cambia el stock
+                desactivar_productos(ids)
+                trabajo.desactivados = len(ids)
+            if rechazos:
+                trabajo.rechazos = guardar_reporte_rechazos(pd.concat(rechazos).sort_values('fila'))
+            trabajo.estado = 'completado'
+        except Exception as e:
+            db.session.rollback()
+            trabajo = db.session.get(TrabajoImportacion, trabajo_id)
+            trabajo.estado = 'error'
+            if isinstance(e, KeyError):
+                trabajo.mensaje = f'Columna "{e.args[0]}" no encontrada. Las columnas deben estar en minúsculas (ej: codigo, nombre, valor_venta).'
+            else:
+                trabajo.mensaje = str(e)
+            if modo == 'reemplazar':
+                trabajo.mensaje += ' No se aplicó ningún cambio: el inventario y las ventas quedaron como estaban.'
+        finally:
+            trabajo.fin = datetime.utcnow()
+            trabajo.version_final = version_catalogo_actual()
+            db.session.commit()
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+
+def guardar_reporte_rechazos(rechazados):
+    """Guarda las filas rechazadas en un .xlsx descargable y devuelve su identificador."""
+    _preparar_carpeta_importaciones()
+    token = uuid.uuid4().hex
+    rechazados.to_excel(os.path.join(CARPETA_IMPORTACIONES, f'rechazos_{token}.xlsx'),
+                        sheet_name='Rechazados', index=False)
+    return token
+
 
 @app.route('/importar')
 @login_required
@@ -1256,221 +4301,347 @@ def vista_importar():
     if current_user.rol.lower() != 'administrador':
         flash('Acceso denegado.', 'danger')
         return redirect(url_for('dashboard'))
-    return render_template('importar_datos.html')
+    rechazos = request.args.get('rechazos')
+    if rechazos and not re.fullmatch(r'[0-9a-f]{32}', rechazos):
+        rechazos = None
+    trabajo = request.args.get('trabajo')
+    if trabajo and not re.fullmatch(r'[0-9a-f]{32}', trabajo):
+        trabajo = None
+    return render_template('importar_datos.html', rechazos=rechazos, trabajo=trabajo)
+
+
+@app.route('/importar/rechazos/<token>')
+@login_required
+def descargar_rechazos_importacion(token):
+    """Descarga el reporte de filas rechazadas de una importación."""
+    if current_user.rol.lower() != 'administrador':
+        abort(403)
+    if not re.fullmatch(r'[0-9a-f]{32}', token):
+        abort(404)
+    ruta = os.path.join(CARPETA_IMPORTACIONES, f'rechazos_{token}.xlsx')
+    if not os.path.exists(ruta):
+        abort(404)
+    return send_file(ruta, as_attachment=True, download_name='filas_rechazadas.xlsx')
 
 
 @app.route('/admin/importar_productos', methods=['POST'])
 @login_required
 def importar_productos_excel():
     """
-    Ruta que permite a los administradores subir un archivo Excel (.xlsx) 
-    y volcar los datos de la hoja 'Producto' a la base de datos, 
-    sobrescribiendo los datos existentes para una limpieza masiva.
+    Ruta que permite a los administradores subir un archivo Excel (.xlsx) con la hoja 'Producto'.
+    - modo 'sincronizar' (por defecto): compara por `codigo`, inserta los nuevos, actualiza solo
+      lo que cambió y, si se pide, desactiva los productos que no vienen en el archivo.
+    - modo 'reemplazar': borra inventario, ventas y cierres y vuelve a cargar todo (limpieza masiva).
+    Con 'simular' solo se muestra la vista previa; el archivo queda guardado para aplicarlo luego.
+    La importación real corre en segundo plano (ver TrabajoImportacion) y la pantalla consulta su avance.
     """
     if current_user.rol.lower() != 'administrador':
         flash('Permiso denegado. Solo administradores pueden importar datos.', 'danger')
         return redirect(url_for('inventario'))
 
-    if 'excel_file' not in request.files:
-        flash('Error: No se encontró el archivo en la solicitud.', 'danger')
-        return redirect(url_for('vista_importar'))
+    modo = 'reemplazar' if request.form.get('modo') == 'reemplazar' else 'sincronizar'
+    desactivar_faltantes = bool(request.form.get('desactivar_faltantes'))
+    simular = bool(request.form.get('simular'))
+    token = request.form.get('archivo')
+
+    if token:
+        # Aplicar un archivo ya revisado en la vista previa
+        ruta = ruta_archivo_importacion(token)
+        if not ruta:
+            flash('El archivo de la vista previa ya no está disponible. Súbalo de nuevo.', 'danger')
+            return redirect(url_for('vista_importar'))
+    else:
+        if 'excel_file' not in request.files:
+            flash('Error: No se encontró el archivo en la solicitud.', 'danger')
+            return redirect(url_for('vista_importar'))
+
+        file = request.files['excel_file']
+        if file.filename == '':
+            flash('Error: Archivo no seleccionado.', 'danger')
+            return redirect(url_for('vista_importar'))
+        if not file.filename.endswith('.xlsx'):
+            flash('Error: El archivo debe ser un Excel (.xlsx).', 'danger')
+            return redirect(url_for('vista_importar'))
+        token = guardar_archivo_importacion(file)
+        ruta = ruta_archivo_importacion(token)
+
+    if not simular:
+        try:
+            trabajo = iniciar_trabajo_importacion(ruta, modo, desactivar_faltantes)
+        except (zipfile.BadZipFile, InvalidFileException):
+            db.session.rollback()
+            os.remove(ruta)
+            flash('Error: El archivo no es un Excel (.xlsx) válido o está dañado.', 'danger')
+            return redirect(url_for('vista_importar'))
+        return redirect(url_for('vista_importar', trabajo=trabajo.id))
+
+    try:
+        # Vista previa: se valida la hoja completa con pandas sin escribir nada
+        df_productos = pd.read_excel(ruta, sheet_name='Producto')
+        validos, rechazados = normalizar_hoja_productos(df_productos)
+
+        if modo == 'reemplazar':
+            vista_previa = {'modo': modo, 'resumen': {
+                'nuevos': len(validos), 'modificados': 0, 'sin_cambios': 0,
+                'desactivados': Producto.query.count()
+            }}
+        else:
+            validos, rechazados = separar_sin_codigo(validos, rechazados)
+            vista_previa = dict(calcular_diff_catalogo(validos, desactivar_faltantes), modo=modo)
 
-    file = request.files['excel_file']
-    if file.filename == '':
-        flash('Error: Archivo no seleccionado.', 'danger')
-        return redirect(url_for('vista_importar'))
+        return render_template(
+            'importar_datos.html', vista_previa=vista_previa, archivo=token,
+            desactivar_faltantes=desactivar_faltantes,
+            rechazos=guardar_reporte_rechazos(rechazados) if not rechazados.empty else None
+        )
+    except (zipfile.BadZipFile, InvalidFileException):
+        flash('Error: El archivo no es un Excel (.xlsx) válido o está dañado.', 'danger')
+    except KeyError as e:
+        db.session.rollback()
+        # Este error indica que faltó alguna columna en minúsculas (ej: 'codigo' en lugar de 'Codigo')
+        flash(f'Error en el Excel: Columna "{e.args[0]}" no encontrada. Asegúrese de que el nombre de la hoja sea "Producto" y las columnas estén en minúsculas (ej: codigo, nombre, valor_venta).', 'danger')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error grave al procesar el Excel: {e}', 'danger')
 
-    if file and file.filename.endswith('.xlsx'):
-        try:
-            # Leer el archivo Excel directamente desde la memoria (BytesIO)
-            excel_data = BytesIO(file.read())
-            
-            # Usar pandas para leer la hoja 'Producto'
-            df_productos = pd.read_excel(excel_data, sheet_name='Producto')
-            
-            # Comienza la transacción de base de datos
-            db.session.begin_nested() 
-            
-            # --- BORRADO EN CASCADA PARA EVITAR FOREIGN KEY VIOLATION (CORRECCIÓN) ---
-            # 1. Borrar todos los detalles de venta (para liberar los productos)
-            db.session.query(VentaDetalle).delete()
-            # 2. Borrar todas las ventas (para liberar a los clientes/vendedores de esas ventas)
-            db.session.query(Venta).delete()
-            # 3. Borrar todos los cierres de caja (son registros de ventas ya borradas)
-            db.session.query(CierreCaja).delete()
-            
-            # 4. Eliminar productos existentes (esto ahora funciona porque ya no hay referencias)
-            db.session.query(Producto).delete() 
-            db.session.commit() # Commit para los DELETEs
+    return redirect(url_for('vista_importar'))
 
-            filas_importadas = 0
-            for index, row in df_productos.iterrows():
-                
-                # Convertir todas las claves de la fila a minúsculas
-                row_lower = {str(k).lower(): v for k, v in row.items()}
-                
-                # Validación básica de campos obligatorios, usando claves en minúsculas
-                if pd.isna(row_lower.get('nombre')) or pd.isna(row_lower.get('valor_venta')):
-                    continue
-                
-                # Asegura que las columnas opcionales que faltan usen None/0
-                
-                # Valor de venta y costo interno deben ser números. Usar .get() con valores por defecto.
-                valor_venta_limpio = row_lower.get('valor_venta')
-                valor_interno_limpio = row_lower.get('valor_interno')
-
-                # Si el valor de venta es una cadena o NaN, intenta convertirlo a float.
-                try:
-                    valor_venta_final = float(valor_venta_limpio)
-                except (ValueError, TypeError):
-                    valor_venta_final = 0.0
-                
-                try:
-                    valor_interno_final = float(valor_interno_limpio)
-                except (ValueError, TypeError):
-                    valor_interno_final = 0.0
 
-                
-                nuevo_producto = Producto(
-                    codigo=str(row_lower.get('codigo')) if pd.notna(row_lower.get('codigo')) else None,
-                    nombre=str(row_lower.get('nombre')),
-                    descripcion=str(row_lower.get('descripcion')) if pd.notna(row_lower.get('descripcion')) else None,
-                    marca=str(row_lower.get('marca')) if pd.notna(row_lower.get('marca')) else None,
-                    cantidad=int(row_lower.get('cantidad') if pd.notna(row_lower.get('cantidad')) else 0),
-                    valor_venta=valor_venta_final,
-                    valor_interno=valor_interno_final,
-                    stock_minimo=int(row_lower.get('stock_minimo') if pd.notna(row_lower.get('stock_minimo')) else 5)
-                )
-                db.session.add(nuevo_producto)
-                filas_importadas += 1
-            
-            db.session.commit()
-            flash(f'✅ ¡Éxito! {filas_importadas} productos importados desde Excel (Hoja Producto).', 'success')
-            
-        except KeyError as e:
-            db.session.rollback()
-            # Este error indica que faltó alguna columna en minúsculas (ej: 'codigo' en lugar de 'Codigo')
-            flash(f'Error en el Excel: Columna "{e.args[0]}" no encontrada. Asegúrese de que el nombre de la hoja sea "Producto" y las columnas estén en minúsculas (ej: codigo, nombre, valor_venta).', 'danger')
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Error grave al procesar el Excel: {e}', 'danger')
-    else:
-        flash('Error: El archivo debe ser un Excel (.xlsx).', 'danger')
+@app.route('/api/importaciones/<trabajo_id>', methods=['GET'])
+@login_required
+def api_estado_importacion(trabajo_id):
+    """Avance de una importación en segundo plano (la pantalla de importación lo consulta cada segundo)."""
+    if current_user.rol.lower() != 'administrador':
+        return jsonify({'error': 'Permiso denegado.'}), 403
+    trabajo = db.session.get(TrabajoImportacion, trabajo_id)
+    if not trabajo:
+        return jsonify({'error': 'Importación no encontrada.'}), 404
+    if trabajo.estado in ('pendiente', 'procesando') and marcar_importaciones_interrumpidas():
+        db.session.refresh(trabajo)
+
+    fin = trabajo.fin or datetime.utcnow()
+    segundos = (fin - trabajo.inicio).total_seconds() if trabajo.inicio else 0
+    return jsonify({
+        'id': trabajo.id,
+        'modo': trabajo.modo,
+        'estado': trabajo.estado,
+        'filas_totales': trabajo.filas_totales,
+        'filas_procesadas': trabajo.filas_procesadas,
+        'filas_rechazadas': trabajo.filas_rechazadas,
+        'nuevos': trabajo.nuevos,
+        'modificados': trabajo.modificados,
+        'sin_cambios': trabajo.sin_cambios,
+        'desactivados': trabajo.desactivados,
+        'filas_por_segundo': round(trabajo.filas_procesadas / segundos, 1) if segundos > 0 else None,
+        'segundos': round(segundos, 1),
+        'mensaje': trabajo.mensaje,
+        'rechazos_url': url_for('descargar_rechazos_importacion', token=trabajo.rechazos) if trabajo.rechazos else None,
+        'etiquetas_url': url_for('etiquetas_pdf', importacion=trabajo.id) if trabajo.estado == 'completado' else None,
+    })
 
-    return redirect(url_for('inventario'))
+# =================================================================
+# MIGRACIONES LIGERAS (COLUMNAS NUEVAS EN TABLAS EXISTENTES)
+# =================================================================
+def agregar_columna_si_falta(tabla, columna, definicion_sql, indice=False):
+    """
+    db.create_all() no altera tablas existentes: agrega la columna (y su índice) si no está.
+    Devuelve True si la columna se creó en esta ejecución.
+    """
+    columnas = {c['name'] for c in sa_inspect(db.engine).get_columns(tabla)}
+    creada = columna not in columnas
+    with db.engine.begin() as conn:
+        if creada:
+            conn.execute(text(f'ALTER TABLE {tabla} ADD COLUMN {columna} {definicion_sql}'))
+        if indice:
+            conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{tabla}_{columna} ON {tabla} ({columna})'))
+    return creada
+
+
+def crear_indice_si_falta(tabla, columna):
+    """Índice ix_<tabla>_<columna> (el mismo nombre que usa index=True en el modelo) sobre una tabla existente."""
+    with db.engine.begin() as conn:
+        conn.execute(text(f'CREATE INDEX IF NOT EXISTS ix_{tabla}_{columna} ON {tabla} ({columna})'))
+
+
+def migrar_esquema():
+    """Cambios de esquema posteriores a la creación original de las tablas (idempotente)."""
+    agregar_columna_si_falta('producto', 'version', 'BIGINT NOT NULL DEFAULT 0', indice=True)
+    agregar_columna_si_falta('producto', 'activo', 'BOOLEAN NOT NULL DEFAULT TRUE')
+    agregar_columna_si_falta('trabajo_importacion', 'version_inicial', 'BIGINT')
+    agregar_columna_si_falta('trabajo_importacion', 'version_final', 'BIGINT')
+    agregar_columna_si_falta('venta', 'fecha_comercial', 'DATE', indice=True)
+    agregar_columna_si_falta('trabajo_importacion', 'actualizado', 'TIMESTAMP')
+
+    # Claves foráneas y columnas de filtro de las tablas originales
+    for tabla, columna in (('venta', 'fecha'), ('venta', 'usuario_id'), ('venta', 'cliente_id'),
+                           ('venta_detalle', 'venta_id'), ('venta_detalle', 'producto_id'),
+                           ('cierre_caja', 'fecha_cierre')):
+        crear_indice_si_falta(tabla, columna)
+
+    if db.session.get(ContadorVersion, CONTADOR_CATALOGO) is None:
+        maxima = db.session.query(func.max(Producto.version)).scalar() or 0
+        db.session.add(ContadorVersion(nombre=CONTADOR_CATALOGO, valor=maxima))
+        db.session.commit()
+    if db.session.get(ContadorVersion, CONTADOR_EPOCA) is None:
+        db.session.add(ContadorVersion(nombre=CONTADOR_EPOCA, valor=0))
+        db.session.commit()
 
 # =================================================================
 # EJECUCIÓN E INICIALIZACIÓN PARA PRODUCCIÓN (RENDER)
 # =================================================================
 
 # Este bloque es CRUCIAL para que Render cree las tablas usando la URL de PostgreSQL.
-with app.app_context():
-    # Parche de estabilidad para el locale, crucial en algunos servidores Linux como Render
-    try:
-        # Intenta establecer el locale de Colombia
-        locale.setlocale(locale.LC_ALL, 'es_CO.UTF-8')
-    except locale.Error as le:
-        # Si falla, intenta con un locale más genérico que soporte UTF-8
+def inicializar_base_de_datos():
+    """Crea/migra el esquema y carga los datos base. Se ejecuta una vez al importar la aplicación."""
+    with app.app_context():
+        # Parche de estabilidad para el locale, crucial en algunos servidores Linux como Render
         try:
-            locale.setlocale(locale.LC_ALL, 'C.UTF-8')
-        except locale.Error:
-            print(f"❌ Advertencia: Fallo al establecer el locale, usando el predeterminado. Error: {le}")
+            # Intenta establecer el locale de Colombia
+            locale.setlocale(locale.LC_ALL, 'es_CO.UTF-8')
+        except locale.Error as le:
+            # Si falla, intenta con un locale más genérico que soporte UTF-8
+            try:
+                locale.setlocale(locale.LC_ALL, 'C.UTF-8')
+            except locale.Error:
+                print(f"❌ Advertencia: Fallo al establecer el locale, usando el predeterminado. Error: {le}")
     
-    try:
-        # 1. Crear todas las tablas: SOLUCIÓN AL ERROR UndefinedTable
-        db.create_all() 
-        print("✅ Tablas creadas (o verificadas) correctamente en PostgreSQL de Render.")
+        try:
+            # 1. Crear todas las tablas: SOLUCIÓN AL ERROR UndefinedTable
+            db.create_all() 
+            migrar_esquema()
+            print("✅ Tablas creadas (o verificadas) correctamente en PostgreSQL de Render.")
+            preparar_busqueda_productos()
+
+            # Ventas anteriores a la columna fecha_comercial
+            fechas_asignadas = backfill_fecha_comercial_ventas()
+            if fechas_asignadas:
+                print(f"✅ Fecha comercial asignada a {fechas_asignadas} ventas.")
+
+            # Migración de pagos: JSON detalle_pago -> tabla VentaPago (solo ventas pendientes)
+            pagos_migrados = backfill_venta_pagos()
+            if pagos_migrados:
+                print(f"✅ {pagos_migrados} pagos migrados desde detalle_pago a VentaPago.")
+
+            # Cierres anteriores a las tablas de detalle: JSON detalles_json -> filas consultables
+            cierres_migrados = backfill_detalle_cierres()
+            if cierres_migrados:
+                print(f"✅ Detalle de {cierres_migrados} cierres de caja migrado a tablas.")
+
+            # Importaciones cuyo hilo murió con un proceso anterior
+            interrumpidas = marcar_importaciones_interrumpidas()
+            if interrumpidas:
+                print(f"⚠️ {interrumpidas} importaciones interrumpidas marcadas con error.")
+
+            # Primer arranque con la tabla de resumen: se construye desde el historial
+            if ResumenVentas.query.first() is None and Venta.query.first() is not None:
+                filas_resumen = reconstruir_resumen_ventas()
+                print(f"✅ Resumen de ventas construido ({filas_resumen} filas).")
         
-        # 2. Inicialización de Usuario Admin
-        admin = Usuario.query.filter_by(username='admin').first()
-        if not admin:
-            admin = Usuario(
-                username='admin', 
-                nombre='Admin', 
-                apellido='G', 
-                cedula='123', 
-                rol='Administrador'
-            )
-            admin.set_password('admin123')
-            db.session.add(admin)
-            print("✅ Usuario admin creado: admin / admin123")
+            # 2. Inicialización de Usuario Admin
+            admin = Usuario.query.filter_by(username='admin').first()
+            if not admin:
+                admin = Usuario(
+                    username='admin', 
+                    nombre='Admin', 
+                    apellido='G', 
+                    cedula='123', 
+                    rol='Administrador'
+                )
+                admin.set_password('admin123')
+                db.session.add(admin)
+                print("✅ Usuario admin creado: admin / admin123")
         
-        # 3. Inicialización de Cliente Genérico
-        generico = Cliente.query.get(1)
-        if not generico:
-            # Creamos el cliente genérico con ID=1
-            generico = Cliente(
-                id=1, 
-                nombre='Contado / Genérico', 
-                telefono='N/A', 
-                direccion='N/A', 
-                email='N/A'
-            )
-            db.session.add(generico)
-            print("✅ Cliente genérico creado.")
-
-        # 4. Inicialización de Datos de Prueba (Opcional)
-        if Producto.query.count() == 0:
-            # Para evitar errores si el usuario va a importar datos desde Excel.
-            prod_labial = Producto(
-                codigo='LBL001', 
-                nombre='Labial Rojo Mate', 
-                descripcion='Larga duración, tono 45', 
-                marca='Macareana',
-                cantidad=20, 
-                valor_venta=35000.00, 
-                valor_interno=15000.00
-            )
-            prod_polvo = Producto(
-                codigo='PLV002', 
-                nombre='Polvo Compacto', 
-                descripcion='Tono claro, protector solar', 
-                marca='Bella Piel',
-                cantidad=10, 
-                valor_venta=50000.00, 
-                valor_interno=25000.00
-            )
-            db.session.add_all([prod_labial, prod_polvo])
-            print("✅ Productos de prueba creados.")
-
-            # Crear una venta de prueba
-            venta_prueba = Venta(
-                fecha=datetime.utcnow(),
-                total=85000.00, 
-                usuario_id=admin.id,
-                cliente_id=generico.id,
-                detalle_pago=json.dumps({'Efectivo': 85000.00, 'Nequi': 0, 'Transferencia': 0, 'Daviplata': 0, 'Tarjeta/Bold': 0, 'Ref_Codigo': '', 'Ref_Fecha': ''})
-            )
-            db.session.add(venta_prueba)
-            db.session.flush()
-
-            db.session.add(VentaDetalle(
-                venta_id=venta_prueba.id, 
-                producto_id=prod_labial.id, 
-                cantidad=1, 
-                precio_unitario=35000.00, 
-                subtotal=35000.00
-            ))
-            db.session.add(VentaDetalle(
-                venta_id=venta_prueba.id, 
-                producto_id=prod_polvo.id, 
-                cantidad=1, 
-                precio_unitario=50000.00, 
-                subtotal=50000.00
-            ))
+            # 3. Inicialización de Cliente Genérico
+            generico = Cliente.query.get(1)
+            if not generico:
+                # Creamos el cliente genérico con ID=1
+                generico = Cliente(
+                    id=1, 
+                    nombre='Contado / Genérico', 
+                    telefono='N/A', 
+                    direccion='N/A', 
+                    email='N/A'
+                )
+                db.session.add(generico)
+                print("✅ Cliente genérico creado.")
+
+            # 4. Inicialización de Datos de Prueba (Opcional)
+            if Producto.query.count() == 0:
+                # Para evitar errores si el usuario va a importar datos desde Excel.
+                prod_labial = Producto(
+                    codigo='LBL001', 
+                    nombre='Labial Rojo Mate', 
+                    descripcion='Larga duración, tono 45', 
+                    marca='Macareana',
+                    cantidad=20, 
+                    valor_venta=35000.00, 
+                    valor_interno=15000.00
+                )
+                prod_polvo = Producto(
+                    codigo='PLV002', 
+                    nombre='Polvo Compacto', 
+                    descripcion='Tono claro, protector solar', 
+                    marca='Bella Piel',
+                    cantidad=10, 
+                    valor_venta=50000.00, 
+                    valor_interno=25000.00
+                )
+                db.session.add_all([prod_labial, prod_polvo])
+                print("✅ Productos de prueba creados.")
+
+                # Crear una venta de prueba
+                pagos_prueba = {'Efectivo': 85000.00, 'Nequi': 0, 'Transferencia': 0, 'Daviplata': 0, 'Tarjeta/Bold': 0, 'Ref_Codigo': '', 'Ref_Fecha': ''}
+                venta_prueba = Venta(
+                    fecha=datetime.utcnow(),
+                    total=85000.00, 
+                    usuario_id=admin.id,
+                    cliente_id=generico.id,
+                    detalle_pago=json.dumps(pagos_prueba)
+                )
+                db.session.add(venta_prueba)
+                db.session.flush()
+                filas_pago_prueba = registrar_pagos_venta(venta_prueba, pagos_prueba, reemplazar=False)
+                # El resumen ya no está vacío después de esta venta: se acumula aquí y no en el próximo arranque
+                acumular_resumen(aportes_resumen(venta_prueba, filas_pago_prueba))
+
+                db.session.add(VentaDetalle(
+                    venta_id=venta_prueba.id, 
+                    producto_id=prod_labial.id, 
+                    cantidad=1, 
+                    precio_unitario=35000.00, 
+                    subtotal=35000.00
+                ))
+                db.session.add(VentaDetalle(
+                    venta_id=venta_prueba.id, 
+                    producto_id=prod_polvo.id, 
+                    cantidad=1, 
+                    precio_unitario=50000.00, 
+                    subtotal=50000.00
+                ))
             
-            prod_labial.cantidad -= 1
-            prod_polvo.cantidad -= 1
-            print(f"✅ Venta de prueba N° {venta_prueba.id} creada para depuración.")
+                prod_labial.cantidad -= 1
+                prod_polvo.cantidad -= 1
+                registrar_movimientos({prod_labial.id: 20, prod_polvo.id: 10}, 'alta_producto', usuario_id=admin.id)
+                registrar_movimientos({prod_labial.id: -1, prod_polvo.id: -1}, 'venta', f'Venta #{venta_prueba.id}', usuario_id=admin.id)
+                print(f"✅ Venta de prueba N° {venta_prueba.id} creada para depuración.")
 
-        # Commit final para guardar todas las inicializaciones
-        db.session.commit()
+            # Commit final para guardar todas las inicializaciones
+            db.session.commit()
+
+            # Fotos diarias de saldo pendientes (también: flask snapshot-inventario)
+            tomar_snapshots_inventario()
         
-    except Exception as e:
-        # Este bloque te ayudará a diagnosticar si Render no puede conectar con la DB
-        print(f"❌ ¡ERROR CRÍTICO DURANTE LA INICIALIZACIÓN DE DB!: {e}")
-        print("Asegúrese de que la URL de la base de datos sea accesible.")
-        db.session.rollback()
+        except Exception as e:
+            # Este bloque te ayudará a diagnosticar si Render no puede conectar con la DB
+            print(f"❌ ¡ERROR CRÍTICO DURANTE LA INICIALIZACIÓN DE DB!: {e}")
+            print("Asegúrese de que la URL de la base de datos sea accesible.")
+            db.session.rollback()
+
+
+# Con `python app.py` los hijos 'spawn' del pool de etiquetas re-ejecutan este archivo como
+# __mp_main__: ellos solo dibujan códigos de barras y no deben tocar la base de datos.
+if __name__ != '__mp_main__':
+    inicializar_base_de_datos()
 
 
 # Bloque para ejecución local de desarrollo (opcional, puede quedar vacío)
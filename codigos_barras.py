@@ -0,0 +1,244 @@
+"""
+Generación de códigos de barras Code128 (PNG y SVG) con caché en memoria y en disco,
+y armado de hojas de etiquetas en PDF.
+
+No depende de Flask ni de la base de datos: lo usan las rutas de app.py y también
+los procesos del pool que dibuja los códigos de las hojas de etiquetas.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from io import BytesIO
+from itertools import repeat
+
+import barcode
+from barcode.writer import ImageWriter, SVGWriter
+from reportlab import rl_config
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from reportlab.pdfgen import canvas
+
+# Tipos MIME de los formatos soportados
+FORMATOS = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+# Cambiar este valor invalida las imágenes ya cacheadas (p. ej. si cambian las opciones del writer)
+VERSION_RENDER = '2'
+MAX_EN_MEMORIA = 512
+
+_memoria = OrderedDict()
+_memoria_lock = threading.Lock()
+_carpeta_disco = None
+
+
+def configurar_cache_disco(carpeta):
+    """Activa la caché en disco en `carpeta` (se crea si no existe)."""
+    global _carpeta_disco
+    os.makedirs(carpeta, exist_ok=True)
+    _carpeta_disco = carpeta
+
+
+def clave_barcode(codigo, formato='png'):
+    """Identificador estable de la imagen; sirve también como ETag."""
+    return hashlib.sha1(f'{VERSION_RENDER}:{formato}:{codigo}'.encode('utf-8')).hexdigest()
+
+
+def renderizar_barcode(codigo, formato='png'):
+    """Dibuja el código sin pasar por la caché. Lanza ValueError si el formato o el código no son válidos."""
+    if formato not in FORMATOS:
+        raise ValueError(f'Formato de código de barras no soportado: {formato}')
+    # PNG en escala de grises: un tercio del tamaño y mucho más rápido de incrustar en PDF
+    writer = ImageWriter(mode='L') if formato == 'png' else SVGWriter()
+    buffer = BytesIO()
+    try:
+        barcode.get_barcode_class('code128')(str(codigo), writer=writer).write(buffer)
+    except barcode.errors.BarcodeError as e:
+        raise ValueError(f'No se puede generar el código de barras para "{codigo}": {e}')
+    return buffer.getvalue()
+
+
+def _leer_disco(clave, formato):
+    if not _carpeta_disco:
+        return None
+    try:
+        with open(os.path.join(_carpeta_disco, f'{clave}.{formato}'), 'rb') as archivo:
+            return archivo.read()
+    except OSError:
+        return None
+
+
+def _escribir_disco(clave, formato, datos):
+    if not _carpeta_disco:
+        return
+    ruta = os.path.join(_carpeta_disco, f'{clave}.{formato}')
+    temporal = f'{ruta}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(temporal, 'wb') as archivo:
+            archivo.write(datos)
+        # Reemplazo atómico: otro proceso nunca lee un archivo a medio escribir
+        os.replace(temporal, ruta)
+    except OSError:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+
+
+def _buscar_en_cache(clave, formato):
+    with _memoria_lock:
+        datos = _memoria.get(clave)
+        if datos is not None:
+            _memoria.move_to_end(clave)
+            return datos
+    datos = _leer_disco(clave, formato)
+    if datos is not None:
+        _guardar_en_memoria(clave, datos)
+    return datos
+
+
+def _guardar_en_memoria(clave, datos):
+    with _memoria_lock:
+        _memoria[clave] = datos
+        _memoria.move_to_end(clave)
+        while len(_memoria) > MAX_EN_MEMORIA:
+            _memoria.popitem(last=False)
+
+
+def obtener_barcode(codigo, formato='png'):
+    """
+    Devuelve (bytes, clave) de la imagen del código. Busca primero en la LRU en memoria,
+    luego en disco, y solo dibuja con python-barcode si no está en ninguna de las dos.
+    """
+    clave = clave_barcode(codigo, formato)
+    datos = _buscar_en_cache(clave, formato)
+    if datos is None:
+        datos = renderizar_barcode(codigo, formato)
+        _escribir_disco(clave, formato, datos)
+        _guardar_en_memoria(clave, datos)
+    return datos, clave
+
+
+def _renderizar_varios(codigos, formato):
+    """Tarea del pool de procesos: dibuja varios códigos (None para los que no son válidos)."""
+    imagenes = []
+    for codigo in codigos:
+        try:
+            imagenes.append(renderizar_barcode(codigo, formato))
+        except ValueError:
+            imagenes.append(None)
+    return imagenes
+
+
+def obtener_barcodes(codigos, formato='png', pool=None, tamano_tarea=25):
+    """
+    Devuelve {codigo: bytes o None} para muchos códigos. Los que no están en caché se dibujan
+    en `pool` (un ProcessPoolExecutor) repartidos en tareas de `tamano_tarea` códigos.
+    """
+    resultado, faltantes = {}, []
+    for codigo in dict.fromkeys(codigos):
+        datos = _buscar_en_cache(clave_barcode(codigo, formato), formato)
+        if datos is None:
+            faltantes.append(codigo)
+        else:
+            resultado[codigo] = datos
+
+    tareas = [faltantes[i:i + tamano_tarea] for i in range(0, len(faltantes), tamano_tarea)]
+    if pool is not None and len(tareas) > 1:
+        lotes = pool.map(_renderizar_varios, tareas, repeat(formato))
+    else:
+        lotes = map(_renderizar_varios, tareas, repeat(formato))
+
+    for tarea, imagenes in zip(tareas, lotes):
+        for codigo, datos in zip(tarea, imagenes):
+            resultado[codigo] = datos
+            if datos is not None:
+                clave = clave_barcode(codigo, formato)
+                _escribir_disco(clave, formato, datos)
+                _guardar_en_memoria(clave, datos)
+    return resultado
+
+
+# Hoja A4 de 3 x 8 etiquetas de 70 x 37 mm (formato comercial tipo Avery 3474)
+COLUMNAS_HOJA, FILAS_HOJA = 3, 8
+ANCHO_ETIQUETA, ALTO_ETIQUETA = 70 * mm, 37 * mm
+TITULO_ETIQUETA = 'LA COSMETIQUERA DE GABI'
+
+_a85_lock = threading.Lock()
+
+
+@contextmanager
+def _sin_ascii85():
+    """
+    Desactiva la codificación ASCII85 de reportlab (Python puro, domina el tiempo con imágenes)
+    mientras se arma la hoja de etiquetas. reportlab solo la expone en rl_config, así que se
+    restaura al salir y el lock evita que dos hojas simultáneas se pisen el valor.
+    """
+    with _a85_lock:
+        anterior = rl_config.useA85
+        rl_config.useA85 = 0
+        try:
+            yield
+        finally:
+            rl_config.useA85 = anterior
+
+
+def _recortar(texto, fuente, tamano, ancho):
+    texto = texto or ''
+    if stringWidth(texto, fuente, tamano) <= ancho:
+        return texto
+    while texto and stringWidth(texto + '…', fuente, tamano) > ancho:
+        texto = texto[:-1]
+    return texto + '…'
+
+
+def generar_pdf_etiquetas(etiquetas, imagenes, destino):
+    """
+    Escribe en `destino` (archivo o buffer) la hoja de etiquetas.
+    `etiquetas` es una lista de dicts con nombre, codigo y precio; `imagenes` es {codigo: png}.
+    """
+    with _sin_ascii85():
+        _dibujar_etiquetas(etiquetas, imagenes, destino)
+
+
+def _dibujar_etiquetas(etiquetas, imagenes, destino):
+    pdf = canvas.Canvas(destino, pagesize=A4)
+    pdf.setTitle('Etiquetas de productos')
+    ancho_pagina, alto_pagina = A4
+    margen_x = (ancho_pagina - COLUMNAS_HOJA * ANCHO_ETIQUETA) / 2
+    margen_y = (alto_pagina - FILAS_HOJA * ALTO_ETIQUETA) / 2
+    por_hoja = COLUMNAS_HOJA * FILAS_HOJA
+    lectores = {}
+
+    for posicion, etiqueta in enumerate(etiquetas):
+        if posicion and posicion % por_hoja == 0:
+            pdf.showPage()
+        celda = posicion % por_hoja
+        x = margen_x + (celda % COLUMNAS_HOJA) * ANCHO_ETIQUETA
+        y = alto_pagina - margen_y - (celda // COLUMNAS_HOJA + 1) * ALTO_ETIQUETA
+        centro, util = x + ANCHO_ETIQUETA / 2, ANCHO_ETIQUETA - 6 * mm
+
+        pdf.setFont('Helvetica-Bold', 6)
+        pdf.drawCentredString(centro, y + ALTO_ETIQUETA - 5 * mm, TITULO_ETIQUETA)
+        pdf.setFont('Helvetica', 7)
+        pdf.drawCentredString(centro, y + ALTO_ETIQUETA - 9 * mm,
+                              _recortar(etiqueta['nombre'], 'Helvetica', 7, util))
+
+        png = imagenes.get(etiqueta['codigo'])
+        if png:
+            # Un ImageReader por código: reportlab incrusta la imagen una sola vez aunque se repita
+            if etiqueta['codigo'] not in lectores:
+                lectores[etiqueta['codigo']] = ImageReader(BytesIO(png))
+            pdf.drawImage(lectores[etiqueta['codigo']], x + 3 * mm, y + 7 * mm, width=util,
+                          height=ALTO_ETIQUETA - 17 * mm, preserveAspectRatio=True, anchor='c')
+        else:
+            pdf.drawCentredString(centro, y + ALTO_ETIQUETA / 2, etiqueta['codigo'])
+
+        pdf.setFont('Helvetica-Bold', 10)
+        precio = f"$ {etiqueta['precio'] or 0:,.0f}".replace(',', '.')
+        pdf.drawCentredString(centro, y + 2.5 * mm, precio)
+
+    pdf.save()
@@ -0,0 +1,80 @@
+"""
+Fixtures de pytest: la aplicación sobre una base SQLite temporal (creada y sembrada por la
+inicialización normal de app.py), un cliente con sesión de administrador y ayudas para crear
+productos e importar hojas de Excel.
+"""
+import os
+import sys
+import uuid
+
+import openpyxl
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+@pytest.fixture(scope='session')
+def modulo_app(tmp_path_factory):
+    # app.py lee DATABASE_URL al importarse, así que debe fijarse antes del import
+    ruta_db = tmp_path_factory.mktemp('db') / 'pruebas.db'
+    os.environ['DATABASE_URL'] = f'sqlite:///{ruta_db}'
+    import app as modulo
+    modulo.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+    return modulo
+
+
+@pytest.fixture
+def db(modulo_app):
+    with modulo_app.app.app_context():
+        yield modulo_app.db
+        modulo_app.db.session.remove()
+
+
+@pytest.fixture
+def cliente(modulo_app):
+    cliente = modulo_app.app.test_client()
+    respuesta = cliente.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    assert respuesta.status_code == 302
+    return cliente
+
+
+@pytest.fixture
+def crear_producto(modulo_app, db):
+    """Crea un producto activo con código único y devuelve su ID."""
+    def crear(cantidad, precio=1000.0):
+        producto = modulo_app.Producto(
+            codigo=f'T-{uuid.uuid4().hex[:12]}', nombre='Producto de prueba',
+            cantidad=cantidad, valor_venta=precio, valor_interno=precio / 2, activo=True
+        )
+        db.session.add(producto)
+        db.session.commit()
+        return producto.id
+    return crear
+
+
+ENCABEZADO_IMPORTACION = ['codigo', 'nombre', 'marca', 'cantidad', 'valor_venta', 'valor_interno']
+
+
+@pytest.fixture
+def importar(modulo_app, db, tmp_path, monkeypatch):
+    """Escribe las filas en un .xlsx y ejecuta la importación en este hilo; devuelve el trabajo."""
+    monkeypatch.setattr(modulo_app, 'CARPETA_IMPORTACIONES', str(tmp_path / 'importaciones'))
+    admin_id = db.session.query(modulo_app.Usuario.id).filter_by(username='admin').scalar()
+
+    def ejecutar(filas, modo='sincronizar', desactivar_faltantes=False, encabezado=ENCABEZADO_IMPORTACION):
+        libro = openpyxl.Workbook()
+        hoja = libro.active
+        hoja.title = 'Producto'
+        hoja.append(encabezado)
+        for fila in filas:
+            hoja.append(list(fila))
+        ruta = str(tmp_path / f'{uuid.uuid4().hex}.xlsx')
+        libro.save(ruta)
+
+        trabajo = modulo_app.TrabajoImportacion(id=uuid.uuid4().hex, usuario_id=admin_id, modo=modo)
+        db.session.add(trabajo)
+        db.session.commit()
+        modulo_app.ejecutar_trabajo_importacion(trabajo.id, ruta, modo, desactivar_faltantes)
+        db.session.expire_all()
+        return db.session.get(modulo_app.TrabajoImportacion, trabajo.id)
+    return ejecutar
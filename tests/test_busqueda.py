@@ -0,0 +1,85 @@
+"""Búsqueda de productos: comodines literales, código exacto primero y paginado del inventario."""
+import uuid
+from contextlib import contextmanager
+
+import pytest
+from flask import template_rendered
+from sqlalchemy.dialects import postgresql
+
+
+@contextmanager
+def contexto_plantilla(aplicacion):
+    capturas = []
+
+    def guardar(sender, template, context, **extra):
+        capturas.append(context)
+    template_rendered.connect(guardar, aplicacion)
+    try:
+        yield capturas
+    finally:
+        template_rendered.disconnect(guardar, aplicacion)
+
+
+def crear_productos(modulo_app, db, nombres_codigos):
+    productos = [modulo_app.Producto(codigo=codigo, nombre=nombre, cantidad=1, valor_venta=1000, activo=True)
+                 for nombre, codigo in nombres_codigos]
+    db.session.add_all(productos)
+    db.session.commit()
+    return [p.id for p in productos]
+
+
+def test_inventario_muestra_codigo_exacto_en_primera_pagina(modulo_app, db, cliente):
+    marca = uuid.uuid4().hex[:10]
+    # El producto del código exacto es el más antiguo: por ID caería en la última página
+    [exacto] = crear_productos(modulo_app, db, [(f'Base {marca}', marca)])
+    crear_productos(modulo_app, db, [(f'Variante {marca} {i}', f'{marca}-{i}') for i in range(60)])
+
+    with contexto_plantilla(modulo_app.app) as capturas:
+        cliente.get(f'/inventario?search={marca}')
+    primera = capturas[-1]['productos_paginados']
+    assert primera.items[0].id == exacto and primera.has_next
+
+    with contexto_plantilla(modulo_app.app) as capturas:
+        cliente.get(f'/inventario?search={marca}&despues={primera.next_cursor}')
+    segunda = capturas[-1]['productos_paginados']
+    assert exacto not in [p.id for p in segunda.items]
+    assert len(primera.items) + len(segunda.items) == 61
+
+    # Al volver a la primera página con el cursor `antes`, el exacto sigue arriba
+    with contexto_plantilla(modulo_app.app) as capturas:
+        cliente.get(f'/inventario?search={marca}&antes={segunda.prev_cursor}')
+    assert capturas[-1]['productos_paginados'].items[0].id == exacto
+
+
+@pytest.mark.parametrize('motor', ['fts5', 'ilike'])
+def test_codigo_exacto_va_primero(modulo_app, db, monkeypatch, motor):
+    monkeypatch.setitem(modulo_app._busqueda_productos, 'motor', motor)
+    marca = uuid.uuid4().hex[:10]
+    # El exacto es el más antiguo y su nombre no repite el término: sin prioridad quedaría último
+    [exacto] = crear_productos(modulo_app, db, [('Otro nombre', marca)])
+    crear_productos(modulo_app, db, [(f'{marca} {marca} estuche {i}', f'{marca}-{i}') for i in range(5)])
+
+    resultado = [p.id for p in modulo_app.buscar_productos(marca).all()]
+    assert resultado[0] == exacto and len(resultado) == 6
+
+
+def test_comodines_like_se_buscan_literalmente(modulo_app, db, monkeypatch):
+    monkeypatch.setitem(modulo_app._busqueda_productos, 'motor', 'ilike')
+    marca = uuid.uuid4().hex[:10]
+    ids = crear_productos(modulo_app, db, [
+        (f'Descuento {marca}% especial', f'{marca}-a'),
+        (f'Descuento {marca}9 especial', f'{marca}-b'),
+        (f'Kit {marca}_x', f'{marca}-c'),
+        (f'Kit {marca}yx', f'{marca}-d'),
+    ])
+
+    assert [p.id for p in modulo_app.buscar_productos(f'{marca}%').all()] == [ids[0]]
+    assert [p.id for p in modulo_app.buscar_productos(f'{marca}_x').all()] == [ids[2]]
+
+
+def test_pg_trgm_escapa_comodines(modulo_app, db, monkeypatch):
+    monkeypatch.setitem(modulo_app._busqueda_productos, 'motor', 'pg_trgm')
+    consulta = modulo_app.buscar_productos('50% a_b').statement.compile(dialect=postgresql.dialect())
+    assert str(consulta).count('ILIKE') == str(consulta).count('ESCAPE') == 2
+    patrones = {v for v in consulta.params.values() if isinstance(v, str) and v.startswith('%')}
+    assert patrones == {'%50\\%%', '%a\\_b%'}
@@ -0,0 +1,62 @@
+"""Sincronización del catálogo por deltas: versiones, bajas, época y ETag."""
+import uuid
+
+
+def catalogo(cliente):
+    datos = cliente.get('/api/productos/todos').get_json()
+    return datos['version'], datos['epoca']
+
+
+def cambios(cliente, desde, epoca):
+    return cliente.get(f'/api/productos/cambios?desde={desde}&epoca={epoca}').get_json()
+
+
+def test_edicion_aparece_en_cambios(modulo_app, db, cliente, crear_producto):
+    pid = crear_producto(3)
+    version, epoca = catalogo(cliente)
+    assert cambios(cliente, version, epoca)['productos'] == []
+
+    producto = db.session.get(modulo_app.Producto, pid)
+    producto.nombre = 'Nombre editado'
+    db.session.commit()
+
+    datos = cambios(cliente, version, epoca)
+    assert datos['version'] == version + 1
+    assert [(p['id'], p['nombre']) for p in datos['productos']] == [(pid, 'Nombre editado')]
+    # La versión provisional de la transacción se reemplazó al confirmar
+    assert db.session.get(modulo_app.Producto, pid).version == version + 1
+
+
+def test_eliminacion_deja_producto_baja(modulo_app, db, cliente, crear_producto):
+    pid = crear_producto(0)
+    version, epoca = catalogo(cliente)
+
+    cliente.get(f'/inventario/eliminar/{pid}')
+
+    baja = db.session.query(modulo_app.ProductoBaja).filter_by(producto_id=pid).one()
+    assert baja.version > version
+    datos = cambios(cliente, version, epoca)
+    assert datos['eliminados'] == [pid] and datos['productos'] == []
+
+
+def test_etag_sin_cambios_responde_304(modulo_app, db, cliente, crear_producto):
+    primera = cliente.get('/api/productos/todos')
+    etag = primera.headers['ETag']
+    assert cliente.get('/api/productos/todos', headers={'If-None-Match': etag}).status_code == 304
+
+    crear_producto(1)
+    segunda = cliente.get('/api/productos/todos', headers={'If-None-Match': etag})
+    assert segunda.status_code == 200 and segunda.headers['ETag'] != etag
+
+
+def test_reemplazo_pide_recargar(modulo_app, db, cliente, importar):
+    version, epoca = catalogo(cliente)
+
+    trabajo = importar([(f'E-{uuid.uuid4().hex[:10]}', 'Catálogo nuevo', None, 2, 1000, 500)], modo='reemplazar')
+    assert trabajo.estado == 'completado', trabajo.mensaje
+
+    datos = cambios(cliente, version, epoca)
+    assert datos['recargar'] is True and datos['epoca'] == epoca + 1
+    nuevo_version, nueva_epoca = catalogo(cliente)
+    assert nueva_epoca == epoca + 1
+    assert 'recargar' not in cambios(cliente, nuevo_version, nueva_epoca)
@@ -0,0 +1,109 @@
+"""Importación de Excel en segundo plano: sincronizar, rechazos, desactivar faltantes, reemplazar e interrupciones."""
+import uuid
+from datetime import datetime, timedelta
+
+import openpyxl
+
+
+def producto_por_codigo(modulo_app, db, codigo):
+    return db.session.query(modulo_app.Producto).filter_by(codigo=codigo).one_or_none()
+
+
+def test_sincronizar_inserta_actualiza_y_rechaza(modulo_app, db, importar, crear_producto):
+    existente = db.session.get(modulo_app.Producto, crear_producto(5, precio=1000.0))
+    nuevo = f'N-{uuid.uuid4().hex[:10]}'
+    trabajo = importar([
+        (existente.codigo, 'Producto de prueba', None, 8, 1500, 500),   # cambia stock y precio
+        (nuevo, 'Producto nuevo', 'Marca', 3, 2000, 900),
+        (f'R-{uuid.uuid4().hex[:8]}', None, None, 1, 1000, 0),          # sin nombre
+        (f'R-{uuid.uuid4().hex[:8]}', 'Precio negativo', None, 1, -5, 0),
+        (nuevo, 'Código repetido', None, 1, 1000, 0),
+        (None, 'Sin código', None, 1, 1000, 0),
+    ])
+
+    assert trabajo.estado == 'completado', trabajo.mensaje
+    assert (trabajo.nuevos, trabajo.modificados, trabajo.filas_rechazadas) == (1, 1, 4)
+    assert trabajo.filas_procesadas == 6 and trabajo.rechazos
+
+    actualizado = producto_por_codigo(modulo_app, db, existente.codigo)
+    assert (actualizado.cantidad, actualizado.valor_venta) == (8, 1500)
+    creado = producto_por_codigo(modulo_app, db, nuevo)
+    assert (creado.nombre, creado.cantidad, creado.marca) == ('Producto nuevo', 3, 'Marca')
+    # Los cambios de stock de la importación quedan en el kardex
+    M = modulo_app.MovimientoInventario
+    assert db.session.query(M.delta).filter_by(producto_id=actualizado.id, motivo='importacion').scalar() == 3
+
+    rechazos = openpyxl.load_workbook(
+        f'{modulo_app.CARPETA_IMPORTACIONES}/rechazos_{trabajo.rechazos}.xlsx', read_only=True)
+    motivos = [fila[-1] for fila in rechazos.active.iter_rows(min_row=2, values_only=True)]
+    assert motivos == ['Sin nombre', 'valor_venta negativo', 'Código repetido en el archivo',
+                       'Sin código (obligatorio para sincronizar)']
+
+
+def test_sincronizar_desactiva_faltantes(modulo_app, db, importar, crear_producto):
+    en_archivo = db.session.get(modulo_app.Producto, crear_producto(2))
+    faltante = crear_producto(4)
+    activos_antes = [pid for (pid,) in db.session.query(modulo_app.Producto.id).filter_by(activo=True)]
+
+    trabajo = importar([(en_archivo.codigo, 'Producto de prueba', None, 2, 1000, 500)], desactivar_faltantes=True)
+    try:
+        assert trabajo.estado == 'completado', trabajo.mensaje
+        assert trabajo.desactivados == len(activos_antes) - 1
+        faltante = db.session.get(modulo_app.Producto, faltante)
+        assert faltante.activo is False and faltante.cantidad == 4  # desactivar no toca el stock
+        assert db.session.get(modulo_app.Producto, en_archivo.id).activo is True
+    finally:
+        # Los demás productos de la base de pruebas vuelven a estar activos
+        db.session.query(modulo_app.Producto).filter(modulo_app.Producto.id.in_(activos_antes)).update(
+            {'activo': True}, synchronize_session=False)
+        db.session.commit()
+
+
+def test_reemplazar_con_error_a_mitad_no_cambia_nada(modulo_app, db, importar, crear_producto, monkeypatch):
+    crear_producto(7)
+    tablas = (modulo_app.Producto, modulo_app.Venta, modulo_app.VentaDetalle, modulo_app.MovimientoInventario)
+    conteos = [db.session.query(t).count() for t in tablas]
+    epoca = modulo_app.epoca_catalogo_actual()
+
+    # Lotes de 2 filas; el segundo lote falla después del borrado y de la primera carga
+    leer_original, insertar_original = modulo_app.leer_hoja_en_lotes, modulo_app.insertar_productos_en_lote
+    monkeypatch.setattr(modulo_app, 'leer_hoja_en_lotes', lambda ruta: leer_original(ruta, tamano=2))
+    llamadas = []
+
+    def insertar_y_fallar(*args, **kwargs):
+        llamadas.append(1)
+        if len(llamadas) == 2:
+            raise RuntimeError('fallo simulado')
+        return insertar_original(*args, **kwargs)
+    monkeypatch.setattr(modulo_app, 'insertar_productos_en_lote', insertar_y_fallar)
+
+    trabajo = importar([(f'Z-{i}-{uuid.uuid4().hex[:6]}', f'Reemplazo {i}', None, 1, 1000, 0) for i in range(4)],
+                       modo='reemplazar')
+
+    assert trabajo.estado == 'error'
+    assert 'fallo simulado' in trabajo.mensaje and 'No se aplicó ningún cambio' in trabajo.mensaje
+    assert len(llamadas) == 2
+    assert [db.session.query(t).count() for t in tablas] == conteos
+    assert modulo_app.epoca_catalogo_actual() == epoca
+
+
+def test_columna_faltante_marca_error(modulo_app, db, importar):
+    trabajo = importar([('X1', 'Sin precio', None, 1, 0)], encabezado=['codigo', 'nombre', 'marca', 'cantidad', 'precio'])
+    assert trabajo.estado == 'error' and 'valor_venta' in trabajo.mensaje
+
+
+def test_marcar_importaciones_interrumpidas(modulo_app, db, cliente):
+    admin_id = db.session.query(modulo_app.Usuario.id).filter_by(username='admin').scalar()
+    hace_rato = datetime.utcnow() - timedelta(minutes=modulo_app.IMPORTACION_SIN_AVANCE_MINUTOS + 5)
+    colgado = modulo_app.TrabajoImportacion(id=uuid.uuid4().hex, usuario_id=admin_id, modo='sincronizar',
+                                            estado='procesando', inicio=hace_rato, actualizado=hace_rato)
+    activo = modulo_app.TrabajoImportacion(id=uuid.uuid4().hex, usuario_id=admin_id, modo='sincronizar',
+                                           estado='procesando', inicio=hace_rato, actualizado=datetime.utcnow())
+    db.session.add_all([colgado, activo])
+    db.session.commit()
+
+    # La consulta de avance detecta el trabajo sin latido reciente
+    datos = cliente.get(f'/api/importaciones/{colgado.id}').get_json()
+    assert datos['estado'] == 'error' and 'interrumpió' in datos['mensaje']
+    assert cliente.get(f'/api/importaciones/{activo.id}').get_json()['estado'] == 'procesando'
+    assert modulo_app.marcar_importaciones_interrumpidas() == 0
@@ -0,0 +1,196 @@
+"""Stock y resumen de ventas en la venta, la edición por diferencia, la anulación y la recepción."""
+import json
+import uuid
+
+
+def stock(modulo_app, db, producto_id):
+    return db.session.query(modulo_app.Producto.cantidad).filter_by(id=producto_id).scalar()
+
+
+def vender(cliente, lineas, precio=1000.0):
+    """Registra una venta en efectivo por `lineas` [(producto_id, cantidad)]; devuelve la respuesta."""
+    productos = [{'id': pid, 'cantidad': cant, 'precio': precio, 'subtotal': cant * precio} for pid, cant in lineas]
+    total = sum(p['subtotal'] for p in productos)
+    return cliente.post('/ventas/nueva', data={
+        'total_venta': total,
+        'pago_efectivo': total,
+        'cliente_id': 1,
+        'productos_vendidos_json': json.dumps(productos),
+    })
+
+
+def id_venta(respuesta):
+    assert respuesta.status_code == 302 and '/ventas/comprobante/' in respuesta.location
+    return int(respuesta.location.rstrip('/').rsplit('/', 1)[1])
+
+
+def resumen_actual(modulo_app, db):
+    R = modulo_app.ResumenVentas
+    return {
+        (r.fecha_comercial, r.usuario_id, r.metodo): (round(r.monto, 2), r.num_ventas)
+        for r in db.session.query(R) if r.monto or r.num_ventas
+    }
+
+
+def test_venta_rechaza_sobreventa(modulo_app, db, cliente, crear_producto):
+    pid = crear_producto(3)
+    ventas_antes = db.session.query(modulo_app.Venta).count()
+
+    respuesta = vender(cliente, [(pid, 5)])
+    assert respuesta.status_code == 302 and respuesta.location.endswith('/ventas/nueva')
+    # Dos líneas del mismo producto se validan por su suma, con un solo mensaje para el producto
+    with cliente.session_transaction() as sesion:
+        sesion.pop('_flashes', None)
+    respuesta = vender(cliente, [(pid, 2), (pid, 2)])
+    assert respuesta.location.endswith('/ventas/nueva')
+    with cliente.session_transaction() as sesion:
+        errores = [m for categoria, m in sesion.get('_flashes', []) if categoria == 'danger']
+    assert len(errores) == 1 and 'Solicitado: 4' in errores[0]
+    assert stock(modulo_app, db, pid) == 3
+    assert db.session.query(modulo_app.Venta).count() == ventas_antes
+
+    id_venta(vender(cliente, [(pid, 3)]))
+    assert stock(modulo_app, db, pid) == 0
+
+
+def test_editar_detalle_ajusta_stock_por_diferencia(modulo_app, db, cliente, crear_producto):
+    p1, p2, p3 = crear_producto(10), crear_producto(10), crear_producto(6)
+    venta_id = id_venta(vender(cliente, [(p1, 2), (p2, 1)]))
+    assert (stock(modulo_app, db, p1), stock(modulo_app, db, p2)) == (8, 9)
+
+    respuesta = cliente.post(f'/api/ventas/detalle/editar/{venta_id}', json={'productos': [
+        {'id': p1, 'cantidad': 5, 'precio_unitario': 1000},
+        {'id': p3, 'cantidad': 4, 'precio_unitario': 500},
+    ]})
+    assert respuesta.status_code == 200 and respuesta.get_json()['nuevo_total'] == 7000
+    assert [stock(modulo_app, db, p) for p in (p1, p2, p3)] == [5, 10, 2]
+
+    # Pedir más de lo disponible no cambia nada
+    respuesta = cliente.post(f'/api/ventas/detalle/editar/{venta_id}', json={'productos': [
+        {'id': p1, 'cantidad': 5, 'precio_unitario': 1000},
+        {'id': p3, 'cantidad': 100, 'precio_unitario': 500},
+    ]})
+    assert respuesta.status_code == 409
+    assert [stock(modulo_app, db, p) for p in (p1, p2, p3)] == [5, 10, 2]
+    cantidades = dict(db.session.query(modulo_app.VentaDetalle.producto_id, modulo_app.VentaDetalle.cantidad)
+                      .filter_by(venta_id=venta_id))
+    assert cantidades == {p1: 5, p3: 4}
+
+
+def test_anulacion_masiva_devuelve_stock_y_resumen(modulo_app, db, cliente, crear_producto):
+    p1, p2 = crear_producto(10), crear_producto(10)
+    ventas = [id_venta(vender(cliente, [(p1, 2), (p2, 3)])), id_venta(vender(cliente, [(p1, 4)]))]
+    assert (stock(modulo_app, db, p1), stock(modulo_app, db, p2)) == (4, 7)
+
+    respuesta = cliente.post('/api/ventas/anular', json={'ventas': ventas})
+    assert respuesta.status_code == 200
+    assert sorted(respuesta.get_json()['anuladas']) == sorted(ventas)
+    assert (stock(modulo_app, db, p1), stock(modulo_app, db, p2)) == (10, 10)
+    assert db.session.query(modulo_app.Venta).filter(modulo_app.Venta.id.in_(ventas)).count() == 0
+
+    # El resumen incremental coincide con el reconstruido desde el historial
+    incremental = resumen_actual(modulo_app, db)
+    modulo_app.reconstruir_resumen_ventas()
+    assert incremental == resumen_actual(modulo_app, db)
+    db.session.rollback()
+
+    respuesta = cliente.post('/api/ventas/anular', json={'ventas': ventas})
+    assert respuesta.get_json()['no_encontradas'] == sorted(ventas)
+    assert stock(modulo_app, db, p1) == 10
+
+
+def test_recepcion_ignora_id_envio_repetido(modulo_app, db, cliente, crear_producto):
+    pid = crear_producto(1)
+    codigo = db.session.get(modulo_app.Producto, pid).codigo
+    cuerpo = {'id_envio': str(uuid.uuid4()), 'items': [{'codigo': codigo, 'cantidad': 3}]}
+
+    respuesta = cliente.post('/api/inventario/recepcion', json=cuerpo)
+    assert respuesta.status_code == 200 and respuesta.get_json()['unidades'] == 3
+    for _ in range(2):
+        respuesta = cliente.post('/api/inventario/recepcion', json=cuerpo)
+        assert respuesta.status_code == 409
+    assert stock(modulo_app, db, pid) == 4
+    assert db.session.query(modulo_app.RecepcionInventario).filter_by(id_envio=cuerpo['id_envio']).count() == 1
+
+
+def test_anular_dos_veces_no_duplica_devolucion(modulo_app, db, cliente, crear_producto):
+    pid = crear_producto(10)
+    venta_id = id_venta(vender(cliente, [(pid, 4)]))
+
+    assert cliente.get(f'/ventas/eliminar/{venta_id}').status_code == 405
+    assert cliente.post(f'/ventas/eliminar/{venta_id}').status_code == 302
+    stock_anulada, resumen_anulada = stock(modulo_app, db, pid), resumen_actual(modulo_app, db)
+    assert stock_anulada == 10
+
+    assert cliente.post(f'/ventas/eliminar/{venta_id}').status_code == 404
+    respuesta = cliente.post('/api/ventas/anular', json={'ventas': [venta_id]})
+    assert respuesta.get_json()['anuladas'] == []
+    assert stock(modulo_app, db, pid) == stock_anulada
+    assert resumen_actual(modulo_app, db) == resumen_anulada
+    movimientos = db.session.query(modulo_app.MovimientoInventario).filter_by(
+        producto_id=pid, motivo='anulacion_venta').count()
+    assert movimientos == 1
+
+
+def suma_kardex(modulo_app, db, producto_id):
+    M = modulo_app.MovimientoInventario
+    return db.session.query(modulo_app.db.func.coalesce(modulo_app.db.func.sum(M.delta), 0)).filter(
+        M.producto_id == producto_id).scalar()
+
+
+def alta_producto(modulo_app, db, cliente, cantidad):
+    codigo = f'K-{uuid.uuid4().hex[:12]}'
+    cliente.post('/inventario/agregar', data={'codigo': codigo, 'nombre': 'Producto kardex',
+                                              'cantidad': cantidad, 'valor_venta': 1000, 'valor_interno': 500})
+    return db.session.query(modulo_app.Producto.id).filter_by(codigo=codigo).scalar()
+
+
+def test_editar_producto_conserva_ventas_y_kardex(modulo_app, db, cliente):
+    pid = alta_producto(modulo_app, db, cliente, 10)
+    codigo = db.session.get(modulo_app.Producto, pid).codigo
+    formulario = {'codigo': codigo, 'nombre': 'Producto kardex', 'descripcion': '', 'marca': '',
+                  'cantidad': 15, 'cantidad_original': 10, 'valor_venta': 1000, 'valor_interno': 500}
+
+    # Una venta se confirma mientras el formulario (que mostró 10 unidades) está abierto
+    id_venta(vender(cliente, [(pid, 3)]))
+    assert cliente.post(f'/inventario/editar/{pid}', data=formulario).status_code == 302
+
+    assert stock(modulo_app, db, pid) == 12
+    assert suma_kardex(modulo_app, db, pid) == 12
+    ajuste = db.session.query(modulo_app.MovimientoInventario.delta).filter_by(
+        producto_id=pid, motivo='ajuste_manual').scalar()
+    assert ajuste == 5
+
+
+def test_eliminar_producto_con_ventas_lo_desactiva(modulo_app, db, cliente):
+    con_ventas = alta_producto(modulo_app, db, cliente, 5)
+    sin_ventas = alta_producto(modulo_app, db, cliente, 4)
+    id_venta(vender(cliente, [(con_ventas, 1)]))
+
+    cliente.get(f'/inventario/eliminar/{con_ventas}')
+    producto = db.session.get(modulo_app.Producto, con_ventas)
+    db.session.refresh(producto)
+    assert producto.activo is False and producto.cantidad == 4
+    assert suma_kardex(modulo_app, db, con_ventas) == 4
+
+    version = modulo_app.version_catalogo_actual()
+    cliente.get(f'/inventario/eliminar/{sin_ventas}')
+    assert db.session.get(modulo_app.Producto, sin_ventas) is None
+    assert suma_kardex(modulo_app, db, sin_ventas) == 0
+    # Filtra por versión: tras un reemplazo del catálogo el mismo ID puede tener bajas anteriores
+    B = modulo_app.ProductoBaja
+    assert db.session.query(B).filter(B.producto_id == sin_ventas, B.version > version).count() == 1
+
+
+def test_editar_detalle_rechaza_producto_inactivo(modulo_app, db, cliente, crear_producto):
+    p1, inactivo = crear_producto(10), crear_producto(10)
+    venta_id = id_venta(vender(cliente, [(p1, 1)]))
+    db.session.get(modulo_app.Producto, inactivo).activo = False
+    db.session.commit()
+
+    respuesta = cliente.post(f'/api/ventas/detalle/editar/{venta_id}', json={'productos': [
+        {'id': p1, 'cantidad': 1, 'precio_unitario': 1000},
+        {'id': inactivo, 'cantidad': 2, 'precio_unitario': 1000},
+    ]})
+    assert respuesta.status_code == 409 and 'inactivo' in respuesta.get_json()['message']
+    assert stock(modulo_app, db, inactivo) == 10